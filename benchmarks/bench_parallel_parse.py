@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark :func:`pytwine.parallel.parse_parallel` against a
+sequential :meth:`MarkdownParser.parse() <pytwine.parsers.Parser.parse>`
+for increasing numbers of processes.
+
+usage: bench_parallel_parse.py [SIZE_MB [MAX_PROCESSES]]
+"""
+
+import os
+import sys
+
+from pytwine.parallel import parse_parallel
+from pytwine.parsers import MarkdownParser
+
+from corpus import CorpusSpec, generate_string
+from run_benchmarks import best_time
+
+def main(argv):
+  """run the benchmark"""
+
+  size_mb = float(argv[1]) if len(argv) > 1 else 64
+  max_procs = int(argv[2]) if len(argv) > 2 else (os.cpu_count() or 1)
+
+  doc = generate_string(CorpusSpec(size=int(size_mb * 1024 * 1024), options=2))
+  print(f"document: {len(doc) / 2**20:.1f} MiB, "
+        f"{doc.count(chr(10))} lines", file=sys.stderr)
+
+  sequential = best_time(lambda: MarkdownParser(string=doc).parse())
+  print(f"{'processes':>9} {'seconds':>9} {'speedup':>8}")
+  print(f"{'seq':>9} {sequential:9.3f} {1.0:8.2f}")
+
+  procs = 1
+  while procs <= max_procs:
+    elapsed = best_time(lambda: parse_parallel(doc, processes=procs,
+                                               min_segment_size=1))
+    print(f"{procs:9d} {elapsed:9.3f} {sequential / elapsed:8.2f}")
+    procs *= 2
+
+if __name__ == "__main__":
+  main(sys.argv)
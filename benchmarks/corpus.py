@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+"""
+Generate synthetic pytwine documents for benchmarking.
+
+Documents alternate doc chunks of markdown prose with Python code
+chunks, and can be tuned by total size, number of code chunks, the
+share of the document that is code, the fence styles used and how
+many options code block start lines carry. They are written
+incrementally, so very large (e.g. 1 GB) documents can be produced
+without holding them in memory.
+
+usage: corpus.py SIZE OUTFILE [--chunks N] [--code-ratio R]
+                 [--fences STYLES] [--options N] [--seed N]
+"""
+
+import argparse
+import io
+import random
+import sys
+
+from typing import List, NamedTuple, Optional, TextIO
+
+PROSE_WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+               "eiusmod tempor incididunt ut labore et dolore magna aliqua "
+               "`inline` *emphasis* **strong** [link](http://example.com)").split()
+
+FENCE_STYLES = {
+  "backtick": ("```", "python"),
+  "tilde":    ("~~~", "python"),
+  "long":     ("`````", "python"),
+  "dotted":   ("```", ".python"),
+  "braced":   ("```", "python {"),
+}
+
+class CorpusSpec(NamedTuple):
+  """parameters for a synthetic document"""
+
+  size: int
+  "approximate size of the document, in characters"
+
+  chunks: Optional[int] = None
+  "number of code chunks (default: about one per 2 KB)"
+
+  code_ratio: float = 0.2
+  "approximate fraction of the document made up of code chunks"
+
+  fences: List[str] = ["backtick"]
+  "fence styles (keys of FENCE_STYLES), used in rotation"
+
+  options: int = 0
+  "number of options on each code block start line"
+
+  seed: int = 0
+  "random seed"
+
+def parse_size(text : str) -> int:
+  """parse a size like "64", "1K", "16M" or "1G" into bytes"""
+
+  multipliers = {"K": 2**10, "M": 2**20, "G": 2**30}
+  text = text.strip().upper().rstrip("B")
+  if text and text[-1] in multipliers:
+    return int(float(text[:-1]) * multipliers[text[-1]])
+  return int(text)
+
+def _prose(rng : random.Random, size : int) -> str:
+  """about ``size`` characters of markdown prose, ending in a newline"""
+
+  out : List[str] = []
+  length = 0
+  line_length = 0
+  while length < size:
+    word = rng.choice(PROSE_WORDS)
+    out.append(word)
+    length += len(word) + 1
+    line_length += len(word) + 1
+    if line_length > 70:
+      out.append("\n")
+      line_length = 0
+    else:
+      out.append(" ")
+  out.append("\n\n")
+  return "".join(out)
+
+def _code(rng : random.Random, size : int, chunk_no : int) -> str:
+  """about ``size`` characters of cheap-to-run Python code"""
+
+  lines = [f"x{chunk_no} = {rng.randint(0, 1000)}\n"]
+  length = len(lines[0])
+  while length < size:
+    line = f"y = [i * x{chunk_no} for i in range({rng.randint(1, 5)})]\n"
+    lines.append(line)
+    length += len(line)
+  lines.append(f"print('chunk {chunk_no}:', x{chunk_no})\n")
+  return "".join(lines)
+
+def _start_line(spec : CorpusSpec, chunk_no : int) -> str:
+  """code block start line for chunk ``chunk_no``"""
+
+  fence, marker = FENCE_STYLES[spec.fences[chunk_no % len(spec.fences)]]
+  options = "".join(f" .class{i} key{i}=\"value {i}\"" for i in range(spec.options))
+  closer = "}" if marker.endswith("{") else ""
+  return f"{fence}{marker}{options}{closer}\n"
+
+def generate(spec : CorpusSpec, out : TextIO) -> None:
+  """write a document as described by ``spec`` to ``out``"""
+
+  rng = random.Random(spec.seed)
+  num_chunks = spec.chunks if spec.chunks is not None else max(spec.size // 2048, 1)
+  code_size = max(int(spec.size * spec.code_ratio / num_chunks), 1)
+  prose_size = max(int(spec.size * (1 - spec.code_ratio) / num_chunks), 1)
+
+  # pieces are generated once and reused, so generating
+  # large documents is quick.
+  prose_pieces = [_prose(rng, prose_size) for _ in range(8)]
+
+  for chunk_no in range(num_chunks):
+    out.write(prose_pieces[chunk_no % len(prose_pieces)])
+    start_line = _start_line(spec, chunk_no)
+    out.write(start_line)
+    out.write(_code(rng, code_size, chunk_no))
+    out.write(start_line[:len(start_line) - len(start_line.lstrip("`~"))] + "\n")
+
+def generate_string(spec : CorpusSpec) -> str:
+  """return a document as described by ``spec``"""
+
+  out = io.StringIO()
+  generate(spec, out)
+  return out.getvalue()
+
+def main(argv : List[str]) -> None:
+  """command-line entry point"""
+
+  parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+  parser.add_argument("size", type=parse_size,
+                      help="approximate size, e.g. 1K, 16M, 1G")
+  parser.add_argument("outfile", help="file to write ('-' for stdout)")
+  parser.add_argument("--chunks", type=int, default=None,
+                      help="number of code chunks")
+  parser.add_argument("--code-ratio", type=float, default=0.2,
+                      help="fraction of document that is code")
+  parser.add_argument("--fences", default="backtick",
+                      help="comma-separated fence styles, from: " +
+                           ", ".join(FENCE_STYLES))
+  parser.add_argument("--options", type=int, default=0,
+                      help="options per code block start line")
+  parser.add_argument("--seed", type=int, default=0)
+  args = parser.parse_args(argv[1:])
+
+  spec = CorpusSpec(size=args.size, chunks=args.chunks,
+                    code_ratio=args.code_ratio,
+                    fences=args.fences.split(","), options=args.options,
+                    seed=args.seed)
+  if args.outfile == "-":
+    generate(spec, sys.stdout)
+  else:
+    with open(args.outfile, "w", encoding="utf8") as ofp:
+      generate(spec, ofp)
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+"""
+Time pytwine's parser, processors and command-line script on synthetic
+documents (see ``corpus.py``), and compare results against a baseline.
+
+``run`` writes results as JSON, keyed by benchmark name and document
+size; ``compare`` reports the ratio of each current time to its
+baseline time, and exits with status 1 if any benchmark got slower by
+more than the threshold.
+
+usage: run_benchmarks.py run [--sizes SIZES] [--repeats N] [-o FILE] ...
+       run_benchmarks.py compare BASELINE CURRENT [--threshold FRACTION]
+"""
+
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from typing import Callable, Dict, List
+
+import pytwine
+from pytwine.parsers import MarkdownParser
+from pytwine.processors import IdentityProcessor, PythonProcessor
+
+from corpus import CorpusSpec, FENCE_STYLES, generate, parse_size
+
+DEFAULT_SIZES = "1K,64K,1M"
+DEFAULT_THRESHOLD = 0.1
+DEFAULT_MIN_SECONDS = 0.001
+
+def best_time(func : Callable[[], object], repeats : int = 3) -> float:
+  """best wall-clock time of ``repeats`` calls to ``func``"""
+
+  times = []
+  for _ in range(repeats):
+    start = time.perf_counter()
+    func()
+    times.append(time.perf_counter() - start)
+  return min(times)
+
+def _parse(doc : str) -> None:
+  MarkdownParser(string=doc).parse()
+
+def _identity_twine(chunks) -> None:
+  IdentityProcessor(io.StringIO()).twine(chunks)
+
+def _python_twine(chunks) -> None:
+  PythonProcessor(io.StringIO(), log=io.StringIO()).twine(chunks)
+
+def _cli(infile : str) -> None:
+  """run the ``pytwine`` script in a fresh interpreter"""
+
+  with tempfile.TemporaryDirectory() as tmpdir:
+    outfile = os.path.join(tmpdir, "out.md")
+    subprocess.run([sys.executable, "-c",
+                    "from pytwine.scripts import pytwine_script; "
+                    "pytwine_script()",
+                    infile, outfile],
+                   check=True, stderr=subprocess.DEVNULL)
+
+def run_suite(spec_template : CorpusSpec, sizes : List[int],
+              repeats : int, cli_max_size : int) -> Dict[str, dict]:
+  """
+  Run every benchmark for each of ``sizes``, returning a dict mapping
+  benchmark names (e.g. ``"parse/1M"``) to results. The cold-start CLI
+  benchmark is only run for sizes up to ``cli_max_size``.
+  """
+
+  results : Dict[str, dict] = {}
+
+  def record(name : str, size_label : str, func : Callable[[], object]) -> None:
+    seconds = best_time(func, repeats)
+    results[f"{name}/{size_label}"] = {"seconds": seconds, "repeats": repeats}
+    print(f"{name + '/' + size_label:>24} {seconds:10.6f}s", file=sys.stderr)
+
+  with tempfile.TemporaryDirectory() as tmpdir:
+    for size in sizes:
+      label = _size_label(size)
+      path = os.path.join(tmpdir, f"doc-{label}.md")
+      with open(path, "w", encoding="utf8") as ofp:
+        generate(spec_template._replace(size=size), ofp)
+      with open(path, encoding="utf8") as ifp:
+        doc = ifp.read()
+
+      chunks = MarkdownParser(string=doc).parse()
+      record("parse", label, lambda: _parse(doc))
+      record("identity-twine", label, lambda: _identity_twine(chunks))
+      record("python-twine", label, lambda: _python_twine(chunks))
+      if size <= cli_max_size:
+        record("cli", label, lambda: _cli(path))
+      del doc, chunks
+
+  return results
+
+def _size_label(size : int) -> str:
+  """inverse of :func:`corpus.parse_size`, for exact multiples"""
+
+  for suffix, multiplier in (("G", 2**30), ("M", 2**20), ("K", 2**10)):
+    if size >= multiplier and size % multiplier == 0:
+      return f"{size // multiplier}{suffix}"
+  return str(size)
+
+def compare(baseline : Dict[str, dict], current : Dict[str, dict],
+            threshold : float,
+            min_seconds : float = DEFAULT_MIN_SECONDS) -> List[str]:
+  """
+  Print a comparison of ``current`` results against ``baseline``,
+  and return the names of benchmarks that are slower by more than
+  ``threshold`` (a fraction, e.g. 0.1 for 10%). Benchmarks taking
+  less than ``min_seconds`` are too noisy to count as regressions.
+  """
+
+  regressions = []
+  print(f"{'benchmark':>24} {'baseline':>10} {'current':>10} {'ratio':>7}")
+  for name in sorted(set(baseline) & set(current)):
+    before = baseline[name]["seconds"]
+    after = current[name]["seconds"]
+    ratio = after / before if before > 0 else float("inf")
+    flag = ""
+    if ratio > 1 + threshold and after >= min_seconds:
+      regressions.append(name)
+      flag = "  REGRESSION"
+    print(f"{name:>24} {before:10.6f} {after:10.6f} {ratio:7.2f}{flag}")
+  for name in sorted(set(baseline) ^ set(current)):
+    print(f"{name:>24} (only in {'baseline' if name in baseline else 'current'})")
+  return regressions
+
+def _metadata() -> dict:
+  return {
+    "pytwine_version": pytwine.__version__,
+    "python": platform.python_version(),
+    "implementation": platform.python_implementation(),
+    "platform": platform.platform(),
+    "date": datetime.datetime.now().isoformat(timespec="seconds"),
+  }
+
+def main(argv : List[str]) -> int:
+  """command-line entry point; returns an exit status"""
+
+  parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+  subparsers = parser.add_subparsers(dest="command", required=True)
+
+  run_parser = subparsers.add_parser("run", help="run the benchmarks")
+  run_parser.add_argument("--sizes", default=DEFAULT_SIZES,
+                          help="comma-separated document sizes "
+                               f"(default: {DEFAULT_SIZES}; up to 1G)")
+  run_parser.add_argument("--chunks", type=int, default=None,
+                          help="number of code chunks per document")
+  run_parser.add_argument("--code-ratio", type=float, default=0.2)
+  run_parser.add_argument("--fences", default=",".join(FENCE_STYLES),
+                          help="comma-separated fence styles")
+  run_parser.add_argument("--options", type=int, default=4,
+                          help="options per code block start line")
+  run_parser.add_argument("--repeats", type=int, default=3)
+  run_parser.add_argument("--cli-max-size", type=parse_size, default="1M",
+                          help="largest size to run the CLI benchmark on")
+  run_parser.add_argument("-o", "--output", default="-",
+                          help="JSON file to write results to")
+
+  compare_parser = subparsers.add_parser("compare",
+                                         help="compare results to a baseline")
+  compare_parser.add_argument("baseline")
+  compare_parser.add_argument("current")
+  compare_parser.add_argument("--threshold", type=float,
+                              default=DEFAULT_THRESHOLD,
+                              help="slowdown treated as a regression "
+                                   f"(default: {DEFAULT_THRESHOLD})")
+  compare_parser.add_argument("--min-seconds", type=float,
+                              default=DEFAULT_MIN_SECONDS,
+                              help="ignore timings shorter than this")
+
+  args = parser.parse_args(argv[1:])
+
+  if args.command == "compare":
+    with open(args.baseline, encoding="utf8") as ifp:
+      baseline = json.load(ifp)
+    with open(args.current, encoding="utf8") as ifp:
+      current = json.load(ifp)
+    regressions = compare(baseline["results"], current["results"],
+                          args.threshold, args.min_seconds)
+    if regressions:
+      print(f"{len(regressions)} regression(s): {', '.join(regressions)}",
+            file=sys.stderr)
+      return 1
+    return 0
+
+  spec = CorpusSpec(size=0, chunks=args.chunks, code_ratio=args.code_ratio,
+                    fences=args.fences.split(","), options=args.options)
+  sizes = [parse_size(size) for size in args.sizes.split(",")]
+  results = run_suite(spec, sizes, args.repeats, args.cli_max_size)
+  report = {"metadata": _metadata(), "corpus": spec._asdict(),
+            "results": results}
+  del report["corpus"]["size"]
+
+  if args.output == "-":
+    json.dump(report, sys.stdout, indent=2)
+    print()
+  else:
+    with open(args.output, "w", encoding="utf8") as ofp:
+      json.dump(report, ofp, indent=2)
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
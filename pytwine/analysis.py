@@ -0,0 +1,556 @@
+r"""
+Static analysis of the names code chunks read and write, and the
+dependencies between chunks that follow from it.
+
+Each chunk is parsed with :mod:`ast`, and the global names it
+**reads**, **binds** (assigns, deletes, defines or imports) and may
+**mutate** (assigns attributes or items of, calls methods on, or passes
+as arguments) are collected. Function and class definitions record the
+globals their bodies read and write, and a chunk referring to a
+function or class is taken to read and write those too. Assignments
+(and ``for`` and ``with`` targets) note which names may be left
+referring to the same objects -- conservatively, those assigned
+anything computed from them -- and modifying an object counts as
+writing every name it may have.
+
+One chunk depends on an earlier one if either may write a name the
+other reads or writes. Names that are only ever bound by importing
+the same thing are treated specially: importing them again doesn't
+count as a write, so chunks that each import a module (and only read
+its attributes) are independent. Modifying a module in place --
+assigning its attributes or items, or calling its functions and
+methods (e.g. ``random.seed(0)``, ``plt.savefig(...)``), including
+functions imported from it (``from random import seed``) -- does
+count as a write, as such calls may change the module's state. Chunks whose
+effects can't be determined statically -- those calling ``exec()``, ``eval()``,
+``globals()``, ``locals()``, ``vars()`` or ``__import__()``, or
+using star-imports -- are **barriers**: they depend on every chunk
+before them, and every chunk after them depends on them.
+
+The analysis can't see side effects outside the namespace (such as
+one chunk writing a file another reads), so it is only used when
+asked for (see :class:`PythonProcessor
+<pytwine.processors.PythonProcessor>`'s ``chunk_jobs``).
+
+>>> graph = dependency_graph([analyse_code("import csv\na = load('a.csv')"),
+...                          analyse_code("b = load('b.csv')"),
+...                          analyse_code("print(a, b)"),
+...                          analyse_code("exec('c = 1')")])
+>>> [sorted(preds) for preds in graph]
+[[], [], [0, 1], [0, 1, 2]]
+"""
+
+import ast
+
+from functools import lru_cache
+from typing import (Any, Dict, FrozenSet, Iterable, List, NamedTuple, Optional,
+                    Set, Tuple)
+
+_BARRIER_CALLS = frozenset(["exec", "eval", "globals", "locals", "vars",
+                            "__import__"])
+
+# assignment expressions are new in Python 3.8
+_NAMED_EXPR = getattr(ast, "NamedExpr", ())
+
+class ChunkNames(NamedTuple):
+  """the global names a chunk of code uses"""
+
+  reads: FrozenSet[str]
+  "names read"
+
+  binds: FrozenSet[str]
+  "names assigned, deleted, defined or imported"
+
+  mutates: FrozenSet[str]
+  "names whose values may be modified in place"
+
+  imports: FrozenSet[Tuple[str, str]]
+  "(name, module or module attribute) pairs bound by import statements"
+
+  deferred_reads: Dict[str, FrozenSet[str]]
+  "for each function or class defined, the globals its body reads"
+
+  deferred_writes: Dict[str, FrozenSet[str]]
+  "for each function or class defined, the globals its body may write"
+
+  barrier: bool
+  "whether the chunk's effects can't be determined"
+
+  early_reads: FrozenSet[str]
+  "names read before the chunk itself binds them"
+
+  aliases: FrozenSet[Tuple[str, str]]
+  "pairs of names that may be left referring to the same object"
+
+  calls: FrozenSet[str]
+  "names called as functions"
+
+  deferred_calls: Dict[str, FrozenSet[str]]
+  "for each function or class defined, the globals its body calls"
+
+def _root_name(node : ast.AST):
+  """the name at the root of an attribute/subscript chain, if any
+  (call results are taken to be new objects)"""
+
+  while isinstance(node, (ast.Attribute, ast.Subscript, ast.Starred)):
+    node = node.value
+  return node.id if isinstance(node, ast.Name) else None
+
+
+def _value_roots(node : Optional[ast.AST]) -> Set[str]:
+  """
+  the names whose objects the value of the expression ``node`` may
+  be, or refer to -- conservatively, anything passed to a call (or
+  a method's receiver) may end up in its result
+  """
+
+  if isinstance(node, ast.Name):
+    return {node.id}
+  if isinstance(node, (ast.Attribute, ast.Subscript, ast.Starred, ast.Await,
+                       _NAMED_EXPR)):
+    return _value_roots(node.value)
+  parts : List[Any]
+  if isinstance(node, ast.Call):
+    parts = node.args + [keyword.value for keyword in node.keywords]
+    if isinstance(node.func, ast.Attribute):
+      parts.append(node.func.value)
+  elif isinstance(node, (ast.Tuple, ast.List, ast.Set)):
+    parts = node.elts
+  elif isinstance(node, ast.Dict):
+    parts = [key for key in node.keys if key is not None] + node.values
+  elif isinstance(node, ast.IfExp):
+    parts = [node.body, node.orelse]
+  elif isinstance(node, ast.BoolOp):
+    parts = node.values
+  elif isinstance(node, (ast.ListComp, ast.SetComp, ast.GeneratorExp,
+                         ast.DictComp)):
+    parts = [generator.iter for generator in node.generators]
+  else:
+    return set()
+  return set().union(*map(_value_roots, parts))
+
+def _target_roots(node : ast.AST) -> Set[str]:
+  """the names assigning to the target ``node`` binds or modifies"""
+
+  if isinstance(node, (ast.Tuple, ast.List)):
+    return set().union(*map(_target_roots, node.elts))
+  name = _root_name(node)
+  return set() if name is None else {name}
+
+def _aliased(names : Iterable[str], aliases : Iterable[Tuple[str, str]]
+            ) -> Set[str]:
+  """``names``, and the names that may refer to the same objects as
+  them (directly or indirectly), given pairs of ``aliases``"""
+
+  linked : Dict[str, Set[str]] = {}
+  for first, second in aliases:
+    linked.setdefault(first, set()).add(second)
+    linked.setdefault(second, set()).add(first)
+  result = set(names)
+  todo = list(result)
+  while todo:
+    for other in linked.get(todo.pop(), ()):
+      if other not in result:
+        result.add(other)
+        todo.append(other)
+  return result
+
+
+class _ScopeCollector(ast.NodeVisitor):
+  """
+  Collects the names used in a body of code, as for a
+  :class:`ChunkNames`. Nested scopes (functions, classes, lambdas and
+  comprehensions) are analysed by :meth:`_nested`.
+  """
+
+  def __init__(self):
+    self.reads   : Set[str] = set()
+    self.early_reads : Set[str] = set()
+    self.binds   : Set[str] = set()
+    self.mutates : Set[str] = set()
+    self.imports : Set[Tuple[str, str]] = set()
+    self.aliases : Set[Tuple[str, str]] = set()
+    self.calls   : Set[str] = set()
+    self.globals_declared : Set[str] = set()
+    self.deferred_reads  : Dict[str, FrozenSet[str]] = {}
+    self.deferred_writes : Dict[str, FrozenSet[str]] = {}
+    self.deferred_calls  : Dict[str, FrozenSet[str]] = {}
+    self.barrier = False
+
+  def _alias(self, targets : Iterable[ast.AST], value : Optional[ast.AST]
+            ) -> None:
+    """note that ``targets`` may be left referring to the objects
+    ``value`` refers to"""
+
+    sources = _value_roots(value)
+    for target in targets:
+      for name in _target_roots(target):
+        self.aliases.update((name, source) for source in sources
+                            if source != name)
+
+  def _read(self, names : Iterable[str]) -> None:
+    for name in names:
+      self.reads.add(name)
+      if name not in self.binds:
+        self.early_reads.add(name)
+
+  def visit_Name(self, node : ast.Name):
+    """a name read, or bound"""
+    if isinstance(node.ctx, ast.Load):
+      self._read([node.id])
+    else:
+      self.binds.add(node.id)
+
+  # (values are evaluated before the targets they are assigned to)
+
+  def visit_Assign(self, node : ast.Assign):
+    """an assignment, which may alias its value"""
+    self._alias(node.targets, node.value)
+    self.visit(node.value)
+    for target in node.targets:
+      self.visit(target)
+
+  def visit_AnnAssign(self, node : ast.AnnAssign):
+    """an annotated assignment"""
+    self._alias([node.target], node.value)
+    for child in [node.annotation, node.value, node.target]:
+      if child is not None:
+        self.visit(child)
+
+  def visit_For(self, node):
+    """a ``for`` loop, whose target may alias items of what it iterates over"""
+    self._alias([node.target], node.iter)
+    self.visit(node.iter)
+    self.visit(node.target)
+    for stmt in node.body + node.orelse:
+      self.visit(stmt)
+
+  visit_AsyncFor = visit_For
+
+  def visit_NamedExpr(self, node):
+    """an assignment expression (``:=``)"""
+    self._alias([node.target], node.value)
+    self.visit(node.value)
+    self.visit(node.target)
+
+  def visit_withitem(self, node : ast.withitem):
+    """a ``with`` item, whose target may alias its context manager"""
+    if node.optional_vars is not None:
+      self._alias([node.optional_vars], node.context_expr)
+    self.generic_visit(node)
+
+  def _mutated(self, node : ast.AST) -> None:
+    name = _root_name(node)
+    if name is not None:
+      self.mutates.add(name)
+
+  def visit_Attribute(self, node : ast.Attribute):
+    """an attribute: assigning or deleting it mutates its object"""
+    if not isinstance(node.ctx, ast.Load):
+      self._mutated(node.value)
+    self.generic_visit(node)
+
+  visit_Subscript = visit_Attribute
+
+  def visit_AugAssign(self, node : ast.AugAssign):
+    """an augmented assignment, which reads and may mutate its target"""
+    if isinstance(node.target, ast.Name):
+      self._read([node.target.id])
+    # (e.g. += extends lists in place)
+    self._mutated(node.target)
+    self._alias([node.target], node.value)
+    self.generic_visit(node)
+
+  def visit_Call(self, node : ast.Call):
+    """a call, which may mutate its arguments (and a method's receiver)"""
+    if isinstance(node.func, ast.Name):
+      if node.func.id in _BARRIER_CALLS:
+        self.barrier = True
+      self.calls.add(node.func.id)
+    if isinstance(node.func, ast.Attribute):
+      # method calls may modify their receiver
+      self._mutated(node.func.value)
+    for arg in node.args + [keyword.value for keyword in node.keywords]:
+      self._mutated(arg)
+    self.generic_visit(node)
+
+  def visit_Import(self, node : ast.Import):
+    """an import, binding a module"""
+    for alias in node.names:
+      if alias.asname:
+        name, source = alias.asname, alias.name
+      else:
+        name = source = alias.name.split(".")[0]
+      self.binds.add(name)
+      self.imports.add((name, source))
+
+  def visit_ImportFrom(self, node : ast.ImportFrom):
+    """a ``from`` import, binding names from a module"""
+    for alias in node.names:
+      if alias.name == "*":
+        self.barrier = True
+      else:
+        name = alias.asname or alias.name
+        self.binds.add(name)
+        self.imports.add((name, "." * node.level + (node.module or "") +
+                                ":" + alias.name))
+
+  def visit_Global(self, node : ast.Global):
+    """a ``global`` declaration"""
+    self.globals_declared.update(node.names)
+
+  def visit_ExceptHandler(self, node : ast.ExceptHandler):
+    """an ``except`` clause, which may bind the exception"""
+    if node.name:
+      self.binds.add(node.name)
+    self.generic_visit(node)
+
+  def _visit_match_name(self, node):
+    name = getattr(node, "name", None) or getattr(node, "rest", None)
+    if name:
+      self.binds.add(name)
+    self.generic_visit(node)
+
+  visit_MatchAs = visit_MatchStar = visit_MatchMapping = _visit_match_name
+
+  def _nested(self, node : ast.AST, params : Iterable[str] = ()) -> "_ScopeCollector":
+    """analyse the body of a nested scope, returning its collector"""
+
+    inner = _ScopeCollector()
+    inner.binds.update(params)
+    for child in ast.iter_child_nodes(node):
+      inner.visit(child)
+    self.barrier = self.barrier or inner.barrier
+    return inner
+
+  @staticmethod
+  def _free(inner : "_ScopeCollector"):
+    """the globals a nested scope reads, writes and calls"""
+
+    local = inner.binds - inner.globals_declared
+    nested_reads = set().union(*inner.deferred_reads.values())
+    nested_writes = set().union(*inner.deferred_writes.values())
+    nested_calls = set().union(*inner.deferred_calls.values())
+    # modifying a local may modify the global it refers to
+    mutated = _aliased(inner.mutates | nested_writes, inner.aliases)
+    reads = frozenset((inner.reads | nested_reads) - local)
+    writes = frozenset((inner.binds & inner.globals_declared) |
+                       (mutated - local))
+    calls = frozenset((inner.calls | nested_calls) - local)
+    return reads, writes, calls
+
+  def _visit_definition(self, node, params : Iterable[str] = ()):
+    """a function or class definition: its body runs later (or, for
+    classes, now -- either way, its reads count now as well as later)"""
+
+    self.binds.add(node.name)
+    for expr in node.decorator_list:
+      self.visit(expr)
+
+    body = ast.Module(body=node.body, type_ignores=[])
+    inner = self._nested(body, params)
+    reads, writes, calls = self._free(inner)
+    self.deferred_reads[node.name] = reads
+    self.deferred_writes[node.name] = writes
+    self.deferred_calls[node.name] = calls
+    if isinstance(node, ast.ClassDef):
+      self._read(reads)
+      self.mutates.update(writes)
+      self.calls.update(calls)
+
+  def _visit_arguments(self, args : ast.arguments) -> List[str]:
+    """visit default values, and return parameter names"""
+
+    for default in args.defaults + [d for d in args.kw_defaults if d is not None]:
+      self.visit(default)
+    # (positional-only parameters are new in Python 3.8)
+    return [arg.arg for arg in
+            getattr(args, "posonlyargs", []) + args.args + args.kwonlyargs +
+            [a for a in [args.vararg, args.kwarg] if a is not None]]
+
+  def visit_FunctionDef(self, node):
+    """a function definition"""
+    params = self._visit_arguments(node.args)
+    self._visit_definition(node, params)
+
+  visit_AsyncFunctionDef = visit_FunctionDef
+
+  def visit_ClassDef(self, node : ast.ClassDef):
+    """a class definition, whose bases are evaluated now"""
+    for expr in node.bases + [keyword.value for keyword in node.keywords]:
+      self.visit(expr)
+    self._visit_definition(node)
+
+  def _visit_expression_scope(self, node, params : Iterable[str] = ()):
+    """lambdas and comprehensions: treated as reading (and writing)
+    their free names straight away"""
+
+    inner = self._nested(node, params)
+    reads, writes, calls = self._free(inner)
+    self._read(reads)
+    self.mutates.update(writes)
+    self.calls.update(calls)
+    # walrus targets bind in the enclosing scope
+    for child in ast.walk(node):
+      if isinstance(child, _NAMED_EXPR) and isinstance(child.target, ast.Name):
+        self.binds.add(child.target.id)
+
+  def visit_Lambda(self, node : ast.Lambda):
+    """a lambda, whose defaults are evaluated now"""
+    params = self._visit_arguments(node.args)
+    self._visit_expression_scope(node, params)
+
+  def visit_ListComp(self, node):
+    """a comprehension (or generator expression)"""
+    self._visit_expression_scope(node)
+
+  visit_SetComp = visit_GeneratorExp = visit_DictComp = visit_ListComp
+
+
+@lru_cache(maxsize=1024)
+def analyse_code(source : str) -> ChunkNames:
+  r"""
+  Return the names used by ``source``, a chunk of Python code. Code
+  that can't be parsed uses no names (it will fail to compile, and so
+  have no effects).
+
+  >>> names = analyse_code("import os\nx = os.getcwd()\ny.append(x)")
+  >>> sorted(names.reads), sorted(names.binds), sorted(names.mutates)
+  (['os', 'x', 'y'], ['os', 'x'], ['os', 'x', 'y'])
+  """
+
+  try:
+    tree = ast.parse(source)
+  except (SyntaxError, ValueError):
+    empty : FrozenSet[str] = frozenset()
+    return ChunkNames(empty, empty, empty, empty, {}, {}, False, empty,
+                      frozenset(), empty, {})
+
+  collector = _ScopeCollector()
+  collector.visit(tree)
+  return ChunkNames(frozenset(collector.reads), frozenset(collector.binds),
+                    frozenset(collector.mutates), frozenset(collector.imports),
+                    collector.deferred_reads, collector.deferred_writes,
+                    collector.barrier, frozenset(collector.early_reads),
+                    frozenset(collector.aliases), frozenset(collector.calls),
+                    collector.deferred_calls)
+
+def _expand(names : FrozenSet[str], deferred : Dict[str, Set[str]]) -> Set[str]:
+  """the globals used via the functions and classes in ``names``"""
+
+  result : Set[str] = set()
+  seen : Set[str] = set()
+  todo = [name for name in names if name in deferred]
+  while todo:
+    name = todo.pop()
+    if name in seen:
+      continue
+    seen.add(name)
+    for used in deferred[name]:
+      result.add(used)
+      if used in deferred:
+        todo.append(used)
+  return result
+
+def _module_state(names : Iterable[str], import_sources : Dict[str, Set[str]]
+                 ) -> Set[str]:
+  """names standing for the state of the (top-level) modules that
+  those of ``names`` bound by imports come from"""
+
+  return {"<module " + source.split(":")[0].lstrip(".").split(".")[0] + ">"
+          for name in names for source in import_sources.get(name, ())}
+
+def dependency_graph(chunk_names : List[ChunkNames]) -> List[FrozenSet[int]]:
+  """
+  Given the names used by each of a document's code chunks (in
+  order), return for each chunk the set of indexes of earlier chunks
+  it depends on.
+  """
+
+  # names only ever bound by imports of the same thing
+  import_sources : Dict[str, Set[str]] = {}
+  bound_otherwise : Set[str] = set()
+  deferred_reads  : Dict[str, Set[str]] = {}
+  deferred_writes : Dict[str, Set[str]] = {}
+  deferred_calls  : Dict[str, Set[str]] = {}
+  aliases : Set[Tuple[str, str]] = set()
+  for names in chunk_names:
+    for name, source in names.imports:
+      import_sources.setdefault(name, set()).add(source)
+    bound_otherwise |= names.binds - {name for name, _ in names.imports}
+    for name, used in names.deferred_reads.items():
+      deferred_reads.setdefault(name, set()).update(used)
+    for name, used in names.deferred_writes.items():
+      deferred_writes.setdefault(name, set()).update(used)
+    for name, used in names.deferred_calls.items():
+      deferred_calls.setdefault(name, set()).update(used)
+    aliases |= names.aliases
+  stable_imports = {name for name, sources in import_sources.items()
+                    if len(sources) == 1 and name not in bound_otherwise}
+  # (modules are accounted for by _module_state)
+  aliases = {(first, second) for first, second in aliases
+             if first not in import_sources and second not in import_sources}
+
+  reads    : List[Set[str]] = []
+  writes   : List[Set[str]] = []
+  provides : List[Set[str]] = []
+  for names in chunk_names:
+    # referring to a function or class counts as using what it uses
+    referenced = names.reads | names.mutates
+    chunk_reads = set(names.reads) | _expand(referenced, deferred_reads)
+    reads.append(chunk_reads | _module_state(chunk_reads, import_sources))
+    # modifying an object modifies it under all the names it may have
+    mutated = _aliased(set(names.mutates) | _expand(referenced, deferred_writes),
+                       aliases)
+    # calling anything imported from a module (or a method of it) may
+    # change the module's state
+    called = set(names.calls) | _expand(referenced, deferred_calls)
+    # (re-importing a stable import isn't a write; modifying it is)
+    writes.append((set(names.binds) - stable_imports) | mutated |
+                  _module_state(mutated | called, import_sources))
+    provides.append({name for name, _ in names.imports} & stable_imports)
+
+  graph : List[FrozenSet[int]] = []
+  last_barrier = -1
+  for j, names in enumerate(chunk_names):
+    if names.barrier:
+      preds = frozenset(range(j))
+      last_barrier = j
+    else:
+      preds = frozenset(
+        i for i in range(j)
+        if i == last_barrier or
+           writes[i] & (reads[j] | writes[j]) or reads[i] & writes[j] or
+           provides[i] & (reads[j] - provides[j]))
+    graph.append(preds)
+  return graph
+
+def read_before_bound(chunk_names : List[ChunkNames],
+                      names : Iterable[str]) -> Set[str]:
+  """
+  Of ``names``, those that chunks using ``chunk_names``, run in
+  order, may read before binding them -- which must therefore
+  already be defined when they start. Calling a function or class
+  counts as reading the globals it uses, and a barrier chunk may read
+  any name not yet bound.
+
+  >>> sorted(read_before_bound([analyse_code("x = 1\\nprint(y)"),
+  ...                           analyse_code("print(x, z)\\nz = 0")], "xyz"))
+  ['y', 'z']
+  """
+
+  deferred_reads : Dict[str, Set[str]] = {}
+  for chunk in chunk_names:
+    for name, used in chunk.deferred_reads.items():
+      deferred_reads.setdefault(name, set()).update(used)
+
+  unbound = set(names)
+  needed : Set[str] = set()
+  for chunk in chunk_names:
+    if chunk.barrier:
+      return needed | unbound
+    used = set(chunk.early_reads) | _expand(chunk.reads | chunk.mutates,
+                                            deferred_reads)
+    needed |= unbound & used
+    unbound -= chunk.binds | needed
+  return needed
@@ -0,0 +1,139 @@
+"""
+A processor running code chunks in an asyncio event loop, so they can
+use ``await`` at top level.
+"""
+
+import ast
+import asyncio
+import inspect
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+from types import CodeType
+
+from typing import IO, Iterable, Optional, TextIO, Union, cast
+
+try:
+  import contextvars
+except ImportError: # Python 3.6
+  contextvars = None # type: ignore
+
+from .core import Chunk, ChunkTable, TwineExitStatus
+from .processors import ProcessorOptions, PythonProcessor
+
+# top-level await is new in Python 3.8
+_ALLOW_TOP_LEVEL_AWAIT = getattr(ast, "PyCF_ALLOW_TOP_LEVEL_AWAIT", 0)
+# (inspect sets its CO_* flags dynamically, which pylint can't see)
+_CO_COROUTINE = getattr(inspect, "CO_COROUTINE", 0x80)
+
+class _ContextThreadPoolExecutor(ThreadPoolExecutor):
+  """a thread pool running each task in a copy of the context it was
+  submitted from -- so what a task prints goes where its submitter's
+  output would"""
+
+  def submit(self, fn, *args, **kwargs): # pylint: disable=arguments-differ
+    context = contextvars.copy_context()
+    return super().submit(context.run, fn, *args, **kwargs)
+
+
+class AsyncPythonProcessor(PythonProcessor):
+  r"""
+  A :class:`PythonProcessor <pytwine.processors.PythonProcessor>`
+  whose code chunks may use ``await`` (and ``async for`` and
+  ``async with``) at top level.
+
+  All chunks run in a single event loop, which lasts for the whole
+  document: a chunk can start tasks (e.g. with
+  :func:`asyncio.create_task`) whose results later chunks await, so
+  I/O can overlap across chunks. Chunks themselves still run one
+  after another, and their output appears in document order; tasks
+  run whenever a chunk awaits, and anything they (or functions they
+  run with ``run_in_executor``) print appears in the output of that
+  chunk. Tasks still pending at the end of the
+  document are cancelled, as by :func:`asyncio.run`.
+
+  Requires Python 3.8 or later, and can't be used with ``chunk_jobs``.
+
+  For example, this document prints ``done``::
+
+    ```python
+    import asyncio
+    task = asyncio.create_task(asyncio.sleep(0, result='done'))
+    ```
+    ```python
+    print(await task)
+    ```
+  """
+
+  COMPILE_FLAGS = _ALLOW_TOP_LEVEL_AWAIT
+
+  def __init__(self, sink: IO, log: TextIO = sys.stderr,
+               options: Optional[ProcessorOptions] = None, **kwargs):
+    """
+    Arguments are as for :class:`PythonProcessor
+    <pytwine.processors.PythonProcessor>`.
+    """
+
+    if not _ALLOW_TOP_LEVEL_AWAIT:
+      raise RuntimeError("top-level await requires Python 3.8 or later")
+    super().__init__(sink, log, options, **kwargs)
+    if self.options.chunk_jobs > 1:
+      raise ValueError("concurrent chunks can't be used with an event loop")
+    self.loop : Optional[asyncio.AbstractEventLoop] = None
+
+  def _exec(self, code_obj : CodeType) -> None:
+    """execute ``code_obj`` in our globals, in our event loop (even if
+    it doesn't await, so it can start tasks)"""
+
+    async def run():
+      # pylint: disable=eval-used
+      result = eval(code_obj, self.globals)
+      if code_obj.co_flags & _CO_COROUTINE:
+        await result
+
+    assert self.loop is not None
+    task = self.loop.create_task(run())
+    try:
+      self.loop.run_until_complete(task)
+    except BaseException:
+      # if interrupted (e.g. by a resource limit), the chunk mustn't
+      # resume while later ones run
+      task.cancel()
+      try:
+        self.loop.run_until_complete(task)
+      except BaseException: # pylint: disable=broad-except
+        pass
+      raise
+
+  def twine(self, chunks : Union[Iterable[Chunk], ChunkTable] ) -> TwineExitStatus:
+    """
+    As for :meth:`PythonProcessor.twine
+    <pytwine.processors.PythonProcessor.twine>`, but running code chunks
+    in a new event loop, which is closed afterwards.
+    """
+
+    self.loop = asyncio.new_event_loop()
+    # (for run_in_executor)
+    self.loop.set_default_executor(_ContextThreadPoolExecutor())
+    asyncio.set_event_loop(self.loop)
+    try:
+      return super().twine(chunks)
+    finally:
+      self._close_loop()
+
+  def _close_loop(self) -> None:
+    """cancel any pending tasks, and close our event loop"""
+
+    loop = cast(asyncio.AbstractEventLoop, self.loop)
+    try:
+      pending = asyncio.all_tasks(loop)
+      for task in pending:
+        task.cancel()
+      if pending:
+        loop.run_until_complete(
+          asyncio.gather(*pending, return_exceptions=True))
+      loop.run_until_complete(loop.shutdown_asyncgens())
+    finally:
+      asyncio.set_event_loop(None)
+      loop.close()
+      self.loop = None
@@ -0,0 +1,245 @@
+"""
+Process many documents in one invocation, concurrently, using a pool
+of worker processes.
+
+Each document is processed as by :func:`cli_twine
+<pytwine.cli.cli_twine>`, with its output written to an output
+directory and its progress and error messages to a log file next to
+the output.
+"""
+
+import glob
+import os
+import sys
+import time
+import traceback
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, TextIO, Tuple
+
+from .cli    import cli_twine
+from .core   import TwineExitStatus
+from .events import merge_traces
+
+DEFAULT_GLOB = "*.pmd"
+"pattern matching the documents to process in directories"
+
+OUTPUT_SUFFIX = ".md"
+"suffix given to output files (replacing that of the document)"
+
+LOG_SUFFIX = ".log"
+"suffix given to log files (replacing that of the document)"
+
+PROFILE_SUFFIX = ".profile.json"
+"suffix given to profile reports, if asked for (replacing that of the document)"
+
+TRACE_SUFFIX = ".trace.json"
+"suffix given to traces, if asked for (replacing that of the document)"
+
+class DocumentResult(NamedTuple):
+  """the result of processing one document"""
+
+  source: str
+  "path of the document"
+
+  output: str
+  "path output was written to"
+
+  log: str
+  "path progress and errors were logged to"
+
+  status: Optional[TwineExitStatus]
+  "exit status, or None if processing failed with an exception"
+
+  seconds: float
+  "wall-clock time taken"
+
+  error: Optional[str] = None
+  "if processing failed with an exception, a description of it"
+
+
+def find_documents(paths : Iterable[str], pattern : str = DEFAULT_GLOB
+                  ) -> List[Tuple[str, str]]:
+  """
+  Return ``(path, name)`` pairs for the documents in ``paths``: files
+  are taken as they are (named by their base name), and directories
+  are searched for files matching the glob ``pattern`` (which may use
+  ``**``), named by their path relative to the directory.
+  """
+
+  documents = []
+  for path in paths:
+    if os.path.isdir(path):
+      matches = glob.glob(os.path.join(glob.escape(path), pattern),
+                          recursive=True)
+      documents.extend((match, os.path.relpath(match, path))
+                       for match in sorted(matches) if os.path.isfile(match))
+    else:
+      documents.append((path, os.path.basename(path)))
+  return documents
+
+def output_paths(name : str, output_dir : str) -> Tuple[str, str]:
+  """the output and log file paths for a document called ``name``"""
+
+  stem = os.path.join(output_dir, os.path.splitext(name)[0])
+  return stem + OUTPUT_SUFFIX, stem + LOG_SUFFIX
+
+def _twine_document(source : str, output : str, log_path : str,
+                    options : Dict[str, Any]) -> DocumentResult:
+  """process one document (in a worker process)"""
+
+  start = time.perf_counter()
+  binary = options.get("binary", False)
+  os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+  status : Optional[TwineExitStatus] = None
+  error = None
+  with open(log_path, "w", encoding="utf8") as log:
+    try:
+      with open(source, "rb" if binary else "r",
+                encoding=None if binary else "utf8") as ifp:
+        with open(output, "wb" if binary else "w",
+                  encoding=None if binary else "utf8") as ofp:
+          status = cli_twine(ifp, ofp, log=log, **options)
+    # (code chunks calling sys.exit() mustn't end the batch)
+    except (Exception, SystemExit) as ex: # pylint: disable=broad-except
+      traceback.print_exc(file=log)
+      error = _error(ex)
+  return DocumentResult(source, output, log_path, status,
+                        time.perf_counter() - start, error)
+
+def _error(ex : BaseException) -> str:
+  """a description of ``ex``, for :attr:`DocumentResult.error`"""
+
+  return f"{type(ex).__name__}: {ex}"
+
+def _worker_failed(task : Tuple[str, str, str, Dict[str, Any]],
+                   ex : BaseException, seconds : float) -> DocumentResult:
+  """the result of a document whose worker process failed to return
+  one (e.g. because it died), noting ``ex`` in its log"""
+
+  source, output, log_path, _ = task
+  with open(log_path, "a", encoding="utf8") as log:
+    print("processing failed:", _error(ex), file=log)
+  return DocumentResult(source, output, log_path, None, seconds, _error(ex))
+
+def _describe(result : DocumentResult) -> str:
+  if result.error is not None:
+    outcome = f"failed ({result.error})"
+  elif result.status == TwineExitStatus.SUCCESS:
+    outcome = "ok"
+  else:
+    outcome = result.status.name.lower().replace("_", " ") # type: ignore
+  return f"{result.source}: {outcome} ({result.seconds:.2f}s)"
+
+def _twine_in_pool(tasks : List[Tuple[str, str, str, Dict[str, Any]]],
+                   jobs : int,
+                   report : Callable[[int, DocumentResult], None]) -> None:
+  """process ``tasks`` in ``jobs`` worker processes, passing each
+  result to ``report`` (with its task's index) as it comes in"""
+
+  started = time.perf_counter()
+  with ProcessPoolExecutor(max_workers=jobs) as pool:
+    futures = {pool.submit(_twine_document, *task): index
+               for index, task in enumerate(tasks)}
+    for future in as_completed(futures):
+      index = futures[future]
+      try:
+        result = future.result()
+      # e.g. BrokenProcessPool, if a worker died
+      except (Exception, SystemExit) as ex: # pylint: disable=broad-except
+        result = _worker_failed(tasks[index], ex,
+                                time.perf_counter() - started)
+      report(index, result)
+
+def batch_twine(documents : List[Tuple[str, str]], output_dir : str,
+                jobs : Optional[int] = None, log : TextIO = sys.stderr,
+                **options) -> List[DocumentResult]:
+  """
+  Process ``documents`` (``(path, name)`` pairs, as returned by
+  :func:`find_documents`), writing output and log files to
+  ``output_dir`` (see :func:`output_paths`). Up to ``jobs``
+  documents (default: one per CPU) are processed at once, in worker
+  processes; if ``jobs`` is 1, they are processed in this process.
+
+  A line is written to ``log`` as each document finishes, followed by
+  a summary. ``options`` are passed on to :func:`cli_twine
+  <pytwine.cli.cli_twine>` -- except that if ``profile_report`` is
+  set, each document's profile is written next to its output, and if
+  ``trace`` is, so is each document's trace, and then they are merged
+  (see :func:`pytwine.events.merge_traces`) into a timeline of the
+  whole batch, written to ``trace``.
+
+  Returns the results, in the order of ``documents``. Raises
+  :class:`ValueError` if two documents would have the same output
+  file.
+  """
+
+  tasks = []
+  seen : Dict[str, str] = {}
+  for source, name in documents:
+    output, log_path = output_paths(name, output_dir)
+    if output in seen:
+      raise ValueError(f"{source} and {seen[output]} would both be "
+                       f"written to {output}")
+    seen[output] = source
+    task_options = dict(options)
+    stem = os.path.splitext(output)[0]
+    if options.get("profile_report"):
+      task_options["profile_report"] = stem + PROFILE_SUFFIX
+    if options.get("trace"):
+      task_options["trace"] = stem + TRACE_SUFFIX
+    tasks.append((source, output, log_path, task_options))
+
+  if jobs is None:
+    jobs = os.cpu_count() or 1
+  results : List[Optional[DocumentResult]] = [None] * len(tasks)
+
+  def report(index : int, result : DocumentResult) -> None:
+    results[index] = result
+    done = sum(1 for res in results if res is not None)
+    print(f"[{done}/{len(tasks)}] {_describe(result)}", file=log, flush=True)
+
+  if jobs <= 1 or len(tasks) <= 1:
+    for index, task in enumerate(tasks):
+      report(index, _twine_document(*task))
+  else:
+    _twine_in_pool(tasks, min(jobs, len(tasks)), report)
+
+  final = [result for result in results if result is not None]
+  if options.get("trace"):
+    traces = [task[3]["trace"] for task in tasks]
+    with open(options["trace"], "w", encoding="utf8") as trace_fp:
+      merge_traces([path for path in traces if os.path.exists(path)], trace_fp)
+  print(summarise(final), file=log)
+  return final
+
+def summarise(results : List[DocumentResult]) -> str:
+  """a one-line summary of ``results``"""
+
+  succeeded = sum(1 for result in results
+                  if result.status == TwineExitStatus.SUCCESS and
+                     result.error is None)
+  errors = sum(1 for result in results
+               if result.status == TwineExitStatus.BLOCK_COMPILATION_ERROR)
+  failed = len(results) - succeeded - errors
+  return (f"{len(results)} documents: {succeeded} succeeded, "
+          f"{errors} with compilation errors, {failed} failed")
+
+def batch_exit_status(results : List[DocumentResult]) -> TwineExitStatus:
+  """
+  The exit status for a batch: ``BLOCK_COMPILATION_ERROR`` if any
+  document hit one, otherwise the status of the first document that
+  didn't succeed -- with ``BAD_SCRIPT_ARGS`` for one that failed with
+  an exception (as the ``pytwine`` script would then exit with
+  status 1) -- otherwise ``SUCCESS``.
+  """
+
+  statuses = [result.status for result in results]
+  if TwineExitStatus.BLOCK_COMPILATION_ERROR in statuses:
+    return TwineExitStatus.BLOCK_COMPILATION_ERROR
+  for result in results:
+    if result.error is not None:
+      return TwineExitStatus.BAD_SCRIPT_ARGS
+    if result.status != TwineExitStatus.SUCCESS:
+      return result.status # type: ignore
+  return TwineExitStatus.SUCCESS
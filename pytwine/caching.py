@@ -0,0 +1,562 @@
+"""
+On-disk caches, for reusing work across runs of pytwine.
+"""
+
+import hashlib
+import importlib
+import importlib.util
+import io
+import marshal
+import os
+import pickle
+import tempfile
+import types
+
+from typing import IO, Any, Callable, Dict, List, Optional, Tuple
+
+from .core import Chunk, CodeChunk, DocChunk
+from .options import BlockOptions
+from .parsers import Parser
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+"default size cap for a cache directory (256 MiB)"
+
+DEFAULT_CHECKPOINT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+"default size cap for a checkpoint directory (2 GiB)"
+
+class DirectoryCache:
+  """
+  A size-capped store of byte strings, held as files in a directory
+  and keyed by strings of hex digits (e.g. hash digests).
+
+  Entries are written to a temporary file and then renamed into
+  place, so concurrent processes sharing a directory never see a
+  partly written entry. Reading an entry updates its modification
+  time, and when the total size of entries exceeds ``max_bytes``, the
+  least recently used entries are deleted (down to
+  :attr:`EVICT_TO` of ``max_bytes``).
+
+  Rather than listing the directory on every write, we keep a running
+  estimate of its total size -- from the last listing, plus what we
+  have written since -- and only list it again (and evict) once the
+  estimate exceeds ``max_bytes``. (Entries written by other processes
+  aren't counted until then, so a shared directory may overshoot its
+  cap a little.)
+  """
+
+  SUFFIX = ".cache"
+
+  EVICT_TO = 0.9
+  "fraction of ``max_bytes`` eviction brings the total size down to"
+
+  def __init__(self, directory : str, max_bytes : int = DEFAULT_MAX_BYTES):
+    """
+    Arguments:
+      directory: directory to store entries in (created if need be).
+      max_bytes: size cap for the entries in the directory.
+    """
+
+    self.directory = directory
+    self.max_bytes = max_bytes
+    os.makedirs(directory, exist_ok=True)
+    # estimated total size of entries; None until the directory is listed
+    self._estimated_bytes : Optional[int] = None
+
+  def path_for(self, key : str) -> str:
+    """path of the file holding the entry for ``key``"""
+
+    return os.path.join(self.directory, key + self.SUFFIX)
+
+  def get(self, key : str) -> Optional[bytes]:
+    """return the entry for ``key``, or None if there isn't one"""
+
+    path = self.path_for(key)
+    try:
+      with open(path, "rb") as ifp:
+        data = ifp.read()
+      os.utime(path)
+    except FileNotFoundError:
+      return None
+    return data
+
+  def put(self, key : str, data : bytes) -> None:
+    """store ``data`` as the entry for ``key``"""
+
+    ofp = self.open_for_writing(key)
+    try:
+      with ofp:
+        ofp.write(data)
+    except BaseException:
+      self.discard(ofp)
+      raise
+    self.commit(ofp)
+
+  def open_for_writing(self, key : str):
+    """
+    Return a new temporary binary file to write the entry for
+    ``key`` into; once it is written and closed, pass it to
+    :meth:`commit`. (This allows large entries to be written
+    incrementally.)
+    """
+
+    # pylint: disable=consider-using-with
+    ofp = tempfile.NamedTemporaryFile(dir=self.directory, prefix=".tmp-",
+                                      delete=False)
+    ofp.cache_key = key # type: ignore
+    return ofp
+
+  def commit(self, ofp) -> None:
+    """move a file from :meth:`open_for_writing` into place"""
+
+    size = os.path.getsize(ofp.name)
+    os.replace(ofp.name, self.path_for(ofp.cache_key))
+    if self._estimated_bytes is None or \
+       self._estimated_bytes + size > self.max_bytes:
+      self.evict()
+    else:
+      # (an overwritten entry is counted twice, which errs on the
+      # side of evicting early)
+      self._estimated_bytes += size
+
+  def discard(self, ofp) -> None:
+    """abandon a file from :meth:`open_for_writing`"""
+
+    ofp.close()
+    try:
+      os.remove(ofp.name)
+    except FileNotFoundError:
+      pass
+
+  def evict(self) -> None:
+    """if we are over our size cap, delete least recently used entries
+    until we are down to :attr:`EVICT_TO` of it"""
+
+    entries = []
+    total = 0
+    with os.scandir(self.directory) as dir_entries:
+      for entry in dir_entries:
+        if not entry.name.endswith(self.SUFFIX):
+          continue
+        try:
+          stat = entry.stat()
+        except FileNotFoundError:
+          continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total += stat.st_size
+
+    if total > self.max_bytes:
+      target = int(self.max_bytes * self.EVICT_TO)
+      entries.sort()
+      for _, size, path in entries:
+        if total <= target:
+          break
+        try:
+          os.remove(path)
+        except FileNotFoundError:
+          pass
+        total -= size
+    self._estimated_bytes = total
+
+
+class ParseCache:
+  """
+  A cache of parse results, keyed by a hash of a document's raw text,
+  the parser class and its code block start pattern.
+
+  Chunk lists are stored :mod:`marshal`-serialized, with code block
+  start and end lines interned.
+
+  >>> from tempfile import TemporaryDirectory
+  >>> from pytwine.parsers import MarkdownParser
+  >>> with TemporaryDirectory() as cache_dir:
+  ...   cache = ParseCache(cache_dir)
+  ...   first = cache.parse(MarkdownParser(string="foo"))
+  ...   second = cache.parse(MarkdownParser(string="foo"))
+  >>> (cache.hits, cache.misses)
+  (1, 1)
+  >>> second
+  [DocChunk(chunkType='doc', contents='foo', number=1, startLineNum=1)]
+  """
+
+  # bump whenever the serialized format changes
+  FORMAT_VERSION = 1
+
+  def __init__(self, directory : str, max_bytes : int = DEFAULT_MAX_BYTES):
+    self.store  = DirectoryCache(directory, max_bytes)
+    self.hits   = 0
+    self.misses = 0
+
+  def key(self, parser : Parser) -> str:
+    """the cache key for ``parser``'s document"""
+
+    if parser.rawtext is None:
+      raise ValueError("ParseCache needs a parser constructed from a string")
+
+    parser_class = type(parser)
+    hasher = hashlib.sha256()
+    for part in [str(self.FORMAT_VERSION),
+                 parser_class.__module__ + "." + parser_class.__qualname__,
+                 getattr(parser, "codeblock_begin", "")]:
+      hasher.update(part.encode("utf-8"))
+      hasher.update(b"\0")
+    hasher.update(parser.rawtext.encode("utf-8", "surrogatepass"))
+    return hasher.hexdigest()
+
+  @staticmethod
+  def _dumps(chunks : List[Chunk]) -> bytes:
+    """serialize chunks"""
+
+    fences : List[str] = []
+    fence_indexes = {}
+
+    def intern(line):
+      index = fence_indexes.get(line)
+      if index is None:
+        index = fence_indexes[line] = len(fences)
+        fences.append(line)
+      return index
+
+    rows = []
+    for chunk in chunks:
+      if chunk.chunkType == "code":
+        code_chunk = chunk
+        assert isinstance(code_chunk, CodeChunk)
+        rows.append((chunk.contents, chunk.number, chunk.startLineNum,
+                     intern(code_chunk.block_start_line),
+                     intern(code_chunk.block_end_line)))
+      else:
+        rows.append((chunk.contents, chunk.number, chunk.startLineNum))
+    return marshal.dumps((fences, rows))
+
+  @staticmethod
+  def _loads(data : bytes,
+             options_for : Optional[Callable[[str], BlockOptions]] = None
+            ) -> List[Chunk]:
+    """deserialize chunks, getting code chunk options (if
+    ``options_for`` is given) by calling it on start lines"""
+
+    fences, rows = marshal.loads(data)
+    fence_options = [None] * len(fences) if options_for is None else \
+                    [options_for(fence) for fence in fences]
+    chunks : List[Chunk] = []
+    for row in rows:
+      if len(row) == 5:
+        contents, number, startLineNum, start_idx, end_idx = row
+        chunks.append(CodeChunk(contents=contents, number=number,
+                                startLineNum=startLineNum,
+                                block_start_line=fences[start_idx],
+                                block_end_line=fences[end_idx],
+                                options=fence_options[start_idx]))
+      else:
+        contents, number, startLineNum = row
+        chunks.append(DocChunk(contents=contents, number=number,
+                               startLineNum=startLineNum))
+    return chunks
+
+  def parse(self, parser : Parser) -> List[Chunk]:
+    """
+    Return ``parser.parse()``, from the cache if possible
+    (storing the result in the cache if not).
+    """
+
+    key = self.key(parser)
+    data = self.store.get(key)
+    if data is not None:
+      try:
+        # pylint: disable=protected-access
+        chunks = self._loads(data, parser._codeblock_options)
+        self.hits += 1
+        return chunks
+      except (EOFError, ValueError, TypeError, IndexError):
+        # corrupt entry: re-parse and overwrite it
+        pass
+
+    self.misses += 1
+    chunks = parser.parse()
+    self.store.put(key, self._dumps(chunks))
+    return chunks
+
+
+class OutputCache:
+  """
+  A cache of the outputs of code chunks, for use by a
+  :class:`PythonProcessor <pytwine.processors.PythonProcessor>`.
+
+  Entries are keyed by a hash chain: the key of each code chunk
+  combines its start line and contents with the key of the code
+  chunk before it, so a key identifies a chunk *and* everything
+  executed before it. An unchanged prefix of a document thus has
+  the same keys from run to run, and its outputs can be replayed.
+
+  Attributes:
+    hits: number of chunk outputs found in the cache
+    misses: number of chunks that had to be executed
+    bytes_replayed: total size of the (UTF-8 encoded) outputs found
+
+  >>> from tempfile import TemporaryDirectory
+  >>> from pytwine.core import CodeChunk
+  >>> chunk = CodeChunk(contents="print(1)", number=1, startLineNum=2,
+  ...                   block_start_line="```python\\n", block_end_line="```\\n")
+  >>> with TemporaryDirectory() as cache_dir:
+  ...   cache = OutputCache(cache_dir)
+  ...   key = cache.chain_key(cache.initial_key(), chunk)
+  ...   cache.put(key, "1\\n")
+  ...   cache.get(key)
+  '1\\n'
+  """
+
+  # bump whenever the key or entry format changes
+  FORMAT_VERSION = 1
+
+  def __init__(self, directory : str, max_bytes : int = DEFAULT_MAX_BYTES):
+    self.store          = DirectoryCache(directory, max_bytes)
+    self.hits           = 0
+    self.misses         = 0
+    self.bytes_replayed = 0
+
+  def initial_key(self) -> str:
+    """the key the chain starts from, before the first code chunk"""
+
+    return hashlib.sha256(
+      f"pytwine output cache {self.FORMAT_VERSION}".encode("utf-8")
+    ).hexdigest()
+
+  @staticmethod
+  def chain_key(previous_key : str, chunk : CodeChunk) -> str:
+    """the key of ``chunk``, given the key of the code chunk before it"""
+
+    hasher = hashlib.sha256()
+    for part in [previous_key, chunk.block_start_line, chunk.contents]:
+      hasher.update(part.encode("utf-8", "surrogatepass"))
+      hasher.update(b"\0")
+    return hasher.hexdigest()
+
+  def get(self, key : str) -> Optional[str]:
+    """return the output stored for ``key``, or None if there is none"""
+
+    data = self.store.get(key)
+    if data is None:
+      return None
+    try:
+      output = data.decode("utf-8", "surrogatepass")
+    except UnicodeDecodeError:
+      return None
+    self.hits += 1
+    self.bytes_replayed += len(data)
+    return output
+
+  def put(self, key : str, output : str) -> None:
+    """store ``output`` as the output for ``key``"""
+
+    self.store.put(key, output.encode("utf-8", "surrogatepass"))
+
+
+class CodeCache:
+  """
+  A cache of compiled code objects, like ``__pycache__``: code is
+  compiled once, and the :mod:`marshal`-serialised code object is
+  stored and reused on later runs.
+
+  Entries are keyed by a hash of the interpreter's bytecode magic
+  number, the filename and flags the code is compiled with, and the
+  source code, so a cache directory can safely be shared by different
+  Python versions (and by concurrent processes -- see
+  :class:`DirectoryCache`). Code that fails to compile isn't cached.
+
+  Attributes:
+    hits: number of code objects found in the cache
+    misses: number of sources that had to be compiled
+
+  >>> from tempfile import TemporaryDirectory
+  >>> with TemporaryDirectory() as cache_dir:
+  ...   cache = CodeCache(cache_dir)
+  ...   _ = cache.compile("x = 1", "<string>")
+  ...   code_obj = cache.compile("x = 1", "<string>")
+  ...   (cache.hits, cache.misses)
+  (1, 1)
+  >>> ns = {}
+  >>> exec(code_obj, ns); ns["x"]
+  1
+  """
+
+  # bump whenever the key or entry format changes
+  FORMAT_VERSION = 1
+
+  def __init__(self, directory : str, max_bytes : int = DEFAULT_MAX_BYTES):
+    self.store  = DirectoryCache(directory, max_bytes)
+    self.hits   = 0
+    self.misses = 0
+
+  def key(self, source : str, filename : str, flags : int = 0) -> str:
+    """the key for ``source`` compiled under ``filename`` with ``flags``"""
+
+    hasher = hashlib.sha256()
+    hasher.update(f"pytwine code cache {self.FORMAT_VERSION}\0".encode("utf-8"))
+    hasher.update(importlib.util.MAGIC_NUMBER)
+    for part in [filename, str(flags), source]:
+      hasher.update(b"\0")
+      hasher.update(part.encode("utf-8", "surrogatepass"))
+    return hasher.hexdigest()
+
+  def compile(self, source : str, filename : str,
+              flags : int = 0) -> types.CodeType:
+    """
+    Return ``source`` compiled (in ``exec`` mode) under
+    ``filename`` with ``flags``, from the cache if possible. Raises
+    :class:`SyntaxError` (etc.) as :func:`compile` does.
+    """
+
+    key = self.key(source, filename, flags)
+    data = self.store.get(key)
+    if data is not None:
+      try:
+        code_obj = marshal.loads(data)
+      except (EOFError, ValueError, TypeError):
+        code_obj = None
+      if isinstance(code_obj, types.CodeType):
+        self.hits += 1
+        return code_obj
+
+    self.misses += 1
+    code_obj = compile(source, filename, "exec", flags)
+    self.store.put(key, marshal.dumps(code_obj))
+    return code_obj
+
+
+class CheckpointStore:
+  """
+  A store of snapshots ("checkpoints") of a
+  :class:`PythonProcessor <pytwine.processors.PythonProcessor>`'s
+  global namespace, keyed by the :class:`OutputCache` key of the
+  code chunk after which each snapshot was taken.
+
+  The globals are pickled one at a time, but by a single pickler --
+  so objects shared between globals are still shared once restored.
+  Each is pickled (once) into a buffer, which is copied to the
+  checkpoint file if pickling succeeds. Modules are recorded by name,
+  and re-imported on restore.
+
+  Names whose values can't be pickled are skipped, and reported by
+  :meth:`save`; the names skipped are recorded in the checkpoint.
+  (The pickler is made to forget what it memoised of a value only
+  partly pickled, so later values can't refer to it.)
+
+  >>> from tempfile import TemporaryDirectory
+  >>> import math
+  >>> with TemporaryDirectory() as store_dir:
+  ...   store = CheckpointStore(store_dir)
+  ...   skipped = store.save("abc1", {"x": [1, 2], "m": math, "f": lambda: 1})
+  ...   restored, not_restored = store.restore("abc1")
+  >>> skipped, not_restored
+  (['f'], ['f'])
+  >>> restored["x"], restored["m"] is math, "f" in restored
+  ([1, 2], True, False)
+  """
+
+  # bump whenever the file format changes
+  FORMAT_VERSION = 3
+
+  _END = "__pytwine_checkpoint_end__"
+
+  PICKLE_PROTOCOL = pickle.HIGHEST_PROTOCOL
+
+  def __init__(self, directory : str,
+               max_bytes : int = DEFAULT_CHECKPOINT_MAX_BYTES):
+    self.store = DirectoryCache(directory, max_bytes)
+
+  def save(self, key : str, namespace : Dict[str, Any]) -> List[str]:
+    """
+    Save a checkpoint of ``namespace`` as the entry for ``key``.
+
+    Returns the names (if any) whose values couldn't be pickled,
+    and so were left out.
+    """
+
+    skipped : List[str] = []
+    ofp = self.store.open_for_writing(key)
+    try:
+      with ofp:
+        buffer = io.BytesIO()
+        pickler = pickle.Pickler(buffer, protocol=self.PICKLE_PROTOCOL)
+        pickler.dump((self.FORMAT_VERSION, key))
+        self._drain(buffer, ofp)
+        for name, value in namespace.items():
+          if name == "__builtins__":
+            continue
+          # (a list, so the pickler memoises it before its contents)
+          if isinstance(value, types.ModuleType):
+            record = [name, "module", value.__name__]
+          else:
+            record = [name, "value", value]
+          try:
+            pickler.dump(record)
+          except Exception: # pylint: disable=broad-except
+            # all sorts of exceptions can be raised by objects'
+            # __reduce__ methods
+            self._forget(pickler, record)
+            skipped.append(name)
+            buffer.seek(0)
+            buffer.truncate()
+          else:
+            self._drain(buffer, ofp)
+        pickler.dump((self._END, "end", skipped))
+        self._drain(buffer, ofp)
+    except BaseException:
+      self.store.discard(ofp)
+      raise
+
+    self.store.commit(ofp)
+    return skipped
+
+  @staticmethod
+  def _drain(buffer : io.BytesIO, ofp : IO[bytes]) -> None:
+    """move what has been pickled into ``buffer`` to ``ofp``"""
+
+    with buffer.getbuffer() as pickled:
+      ofp.write(pickled)
+    buffer.seek(0)
+    buffer.truncate()
+
+  @staticmethod
+  def _forget(pickler : pickle.Pickler, record : List[Any]) -> None:
+    """make ``pickler`` forget what it memoised while failing to pickle
+    ``record`` (memo entries are numbered in the order they're made,
+    and ``record`` was the first)"""
+
+    memo = pickler.memo.copy()
+    entry = memo.get(id(record))
+    if entry is not None:
+      pickler.memo = {obj_id : (index, obj)
+                      for obj_id, (index, obj) in memo.items()
+                      if index < entry[0]}
+
+  def restore(self, key : str) -> Optional[Tuple[Dict[str, Any], List[str]]]:
+    """
+    Return the namespace saved as the entry for ``key``, and a list
+    of the names left out of it when it was saved -- or None if there
+    is no such entry, or it can't be restored.
+    """
+
+    path = self.store.path_for(key)
+    namespace : Dict[str, Any] = {}
+    try:
+      with open(path, "rb") as ifp:
+        unpickler = pickle.Unpickler(ifp)
+        if unpickler.load() != (self.FORMAT_VERSION, key):
+          return None
+        while True:
+          name, kind, value = unpickler.load()
+          if name == self._END:
+            skipped = value
+            break
+          if kind == "module":
+            value = importlib.import_module(value)
+          namespace[name] = value
+      os.utime(path)
+    except FileNotFoundError:
+      return None
+    except Exception: # pylint: disable=broad-except
+      # corrupt or truncated entries, objects whose classes
+      # no longer exist, etc.
+      return None
+    return namespace, skipped
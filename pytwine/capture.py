@@ -0,0 +1,278 @@
+"""
+Capturing what code prints.
+
+Code in chunks prints to ``sys.stdout`` as usual; a
+:class:`StdoutRouter` installed there sends it on to the target of the
+current context's :class:`Route` (see :func:`routed`), so processors
+in different threads or asyncio tasks each capture their own code's
+output. A route's target is typically a :class:`SinkWriter` (passing
+output straight on to a document) or a :class:`SpoolWriter` (holding
+it until the chunk is done).
+"""
+
+import sys
+import tempfile
+import threading
+
+from contextlib import contextmanager
+
+from typing import IO, Any, Callable, Iterator, List, Optional
+
+try:
+  import contextvars
+except ImportError: # Python 3.6
+  contextvars = None # type: ignore
+
+
+class Route:
+  """where code running in a context sends what it prints"""
+
+  __slots__ = ("target",)
+
+  def __init__(self, target : Optional[IO] = None):
+    self.target = target
+
+
+class _ThreadLocalVar:
+  """a stand-in for :class:`contextvars.ContextVar` (new in Python
+  3.7), holding a value per thread"""
+
+  def __init__(self, name : str, default : Any = None):
+    self.name = name
+    self._default = default
+    self._local = threading.local()
+
+  def get(self) -> Any:
+    """this thread's value"""
+    return getattr(self._local, "value", self._default)
+
+  def set(self, value : Any) -> Any:
+    """set this thread's value, returning a token for :meth:`reset`"""
+    token = self.get()
+    self._local.value = value
+    return token
+
+  def reset(self, token : Any) -> None:
+    """restore the value this thread had before :meth:`set`"""
+    self._local.value = token
+
+if contextvars is not None:
+  _current_route : Any = contextvars.ContextVar("pytwine_stdout_route",
+                                                default=None)
+else:
+  _current_route = _ThreadLocalVar("pytwine_stdout_route")
+
+
+# the routes of the documents being processed (see :func:`routed`)
+_document_routes : List[Route] = []
+
+def _active_route() -> Optional[Route]:
+  """the route of the current context -- or, in contexts with none
+  (such as threads started by code in a chunk), the route of the
+  document being processed, if there is just one"""
+
+  route = _current_route.get()
+  if route is None:
+    routes = list(_document_routes)
+    if len(routes) != 1:
+      return None
+    route = routes[0]
+  return route
+
+
+class StdoutRouter:
+  """
+  Installed (once) as ``sys.stdout``, passing output on to the target
+  of the :func:`_active_route` -- or to the original stdout, if there
+  is none. So processors in different threads (or asyncio tasks) each
+  capture their own code's output, without ever reassigning
+  ``sys.stdout``.
+  """
+
+  def __init__(self, default : IO):
+    self._default = default
+
+  def _target(self) -> IO:
+    route = _active_route()
+    if route is None or route.target is None:
+      return self._default
+    return route.target
+
+  def write(self, s : str) -> int:
+    """write ``s`` to the current target"""
+    return self._target().write(s)
+
+  def flush(self) -> None:
+    """flush the current target"""
+    self._target().flush()
+
+  def __getattr__(self, name):
+    return getattr(self._target(), name)
+
+
+_install_lock = threading.Lock()
+
+@contextmanager
+def routed(route : Route, document : bool = False) -> Iterator[None]:
+  """
+  Send what is printed in the current context (and tasks started
+  from it) through ``route``, while in the ``with`` statement.
+
+  If ``document`` is true, ``route`` is also used by threads with no
+  route of their own, while no other document is being processed --
+  as there is no telling which document such threads belong to.
+  """
+
+  with _install_lock:
+    if not isinstance(sys.stdout, StdoutRouter):
+      sys.stdout = StdoutRouter(sys.stdout) # type: ignore
+    if document:
+      _document_routes.append(route)
+  token = _current_route.set(route)
+  try:
+    yield
+  finally:
+    _current_route.reset(token)
+    if document:
+      with _install_lock:
+        _document_routes.remove(route)
+
+
+class SinkWriter:
+  """
+  Captures what a chunk prints, passing it on to ``write`` (and then
+  calling ``flush``) once at least ``flush_size`` characters are
+  pending -- or whenever ``flush()`` is called (e.g. by
+  ``print(..., flush=True)``).
+
+  If ``keep`` is true, everything written is also kept, for
+  :meth:`getvalue`.
+  """
+
+  encoding = "utf-8"
+
+  def __init__(self, write : Callable[[str], Any], flush : Callable[[], Any],
+               flush_size : int = 0, keep : bool = False):
+    self._write = write
+    self._flush = flush
+    self._flush_size = flush_size
+    self._pending : List[str] = []
+    self._pending_size = 0
+    self._kept : Optional[List[str]] = [] if keep else None
+
+  def write(self, s : str) -> int:
+    """capture ``s``"""
+    if not isinstance(s, str):
+      raise TypeError(f"write() argument must be str, not {type(s).__name__}")
+    if s:
+      self._pending.append(s)
+      self._pending_size += len(s)
+      if self._kept is not None:
+        self._kept.append(s)
+      if self._pending_size >= self._flush_size:
+        self.flush()
+    return len(s)
+
+  def flush(self) -> None:
+    """pass on whatever is pending"""
+    if self._pending:
+      self._write("".join(self._pending))
+      self._pending = []
+      self._pending_size = 0
+    self._flush()
+
+  def getvalue(self) -> str:
+    """everything written (if we were asked to keep it)"""
+    return "".join(self._kept or [])
+
+  @staticmethod
+  def isatty() -> bool:
+    """never a terminal"""
+    return False
+
+  @staticmethod
+  def writable() -> bool:
+    """always writable"""
+    return True
+
+
+class SpoolWriter:
+  """
+  Captures what a chunk prints, holding it in memory until it comes to more than ``max_size``
+  characters, and from then on in a temporary file -- so it can be
+  read back in blocks (see :meth:`blocks`) without ever all being in
+  memory. (Like :class:`tempfile.SpooledTemporaryFile`, but without
+  asking a text file for its position on every write.)
+  """
+
+  encoding = "utf-8"
+
+  def __init__(self, max_size : int):
+    self._max_size = max_size
+    self._pending : List[str] = []
+    self._pending_size = 0
+    self._file : Optional[IO[str]] = None
+
+  @property
+  def spilled(self) -> bool:
+    """whether output has been moved to a temporary file"""
+    return self._file is not None
+
+  def write(self, s : str) -> int:
+    """capture ``s``"""
+    if not isinstance(s, str):
+      raise TypeError(f"write() argument must be str, not {type(s).__name__}")
+    if self._file is not None:
+      self._file.write(s)
+    elif s:
+      self._pending.append(s)
+      self._pending_size += len(s)
+      if self._pending_size > self._max_size:
+        self._spill()
+    return len(s)
+
+  def _spill(self) -> None:
+    """move what we hold to a temporary file"""
+
+    # pylint: disable=consider-using-with
+    self._file = tempfile.TemporaryFile(
+      "w+", encoding="utf-8", errors="surrogatepass", newline="")
+    self._file.writelines(self._pending)
+    self._pending = []
+    self._pending_size = 0
+
+  def flush(self) -> None:
+    """does nothing: output is held until it is read back"""
+
+  def blocks(self, block_size : int) -> Iterator[str]:
+    """everything written, in blocks of at most ``block_size``
+    characters (or, if it is still in memory, all at once)"""
+
+    if self._file is None:
+      if self._pending:
+        yield "".join(self._pending)
+      return
+    self._file.seek(0)
+    while True:
+      block = self._file.read(block_size)
+      if not block:
+        return
+      yield block
+
+  def close(self) -> None:
+    """discard what was written"""
+
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+    self._pending = []
+
+  @staticmethod
+  def isatty() -> bool:
+    """never a terminal"""
+    return False
+
+  @staticmethod
+  def writable() -> bool:
+    """always writable"""
+    return True
@@ -3,36 +3,237 @@
 scripts and tools.
 """
 
+import io
+import mmap
+import os
 import sys
 
-from typing import TextIO, Union
+from typing import IO, Any, Iterable, NamedTuple, Optional, TextIO, cast
 
 
-from .core        import TwineExitStatus
+from .async_processor import AsyncPythonProcessor
+from .caching     import CheckpointStore, CodeCache, OutputCache, ParseCache
+from .core        import Chunk, TwineExitStatus
+from .events      import PARSE, ChromeTraceExporter, EventHooks, traced_chunks
+from .limits      import ResourceLimits, parse_size
 from .parsers     import MarkdownParser
-from .processors  import PythonProcessor
+from .processors  import ProcessorOptions, PythonProcessor
+from .profiling   import ProfileReport
 
-def cli_twine(ifp : TextIO, ofp : TextIO, debug : bool =False) -> TwineExitStatus :
+def _read_buffer(ifp : IO) -> Any:
+  """
+  Return the contents of binary file ``ifp`` as a bytes-like object:
+  memory-mapped, if it is a regular file, otherwise read.
+  """
+
+  try:
+    return mmap.mmap(ifp.fileno(), 0, access=mmap.ACCESS_READ)
+  except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+    # not a regular file (e.g. a pipe), or empty
+    return ifp.read()
+
+class TwineOptions(NamedTuple):
+  """settings for :func:`cli_twine`, all optional"""
+
+  debug: bool = False
+  "if True, report progress (and cache hits) to ``sys.stderr``"
+
+  parse_cache: Optional[str] = None
+  """if not None, a directory in which to cache parse results (see
+  :class:`pytwine.caching.ParseCache`)"""
+
+  binary: bool = False
+  """if True, the input and output are binary files, holding UTF-8
+  encoded documents. Only code chunks are decoded; doc chunks are
+  copied to the output unchanged, line endings and all."""
+
+  output_cache: Optional[str] = None
+  """if not None, a directory in which to cache the outputs of code
+  chunks (see :class:`pytwine.caching.OutputCache`)"""
+
+  checkpoints: Optional[str] = None
+  """if not None, a directory in which to store checkpoints of the
+  global namespace (see :class:`pytwine.caching.CheckpointStore`). If
+  no ``output_cache`` is given, one is kept in an ``outputs``
+  subdirectory of it."""
+
+  checkpoint_interval: Optional[float] = None
+  """if not None, take a checkpoint whenever this many seconds of
+  execution have passed since the last one"""
+
+  chunk_jobs: int = 1
+  """number of threads to run independent code chunks in (see
+  :class:`pytwine.processors.ProcessorOptions`)"""
+
+  stream: bool = False
+  """if True, write code chunk output to the output as it is
+  produced, once at least ``flush_size`` characters are pending"""
+
+  flush_size: int = 0
+  "characters of streamed output to hold before writing them"
+
+  code_cache: Optional[str] = None
+  """if not None, a directory in which to cache compiled code chunks
+  (see :class:`pytwine.caching.CodeCache`)"""
+
+  log: Optional[TextIO] = None
+  "where progress and errors are reported (default: ``sys.stderr``)"
+
+  use_async: bool = False
+  """if True, code chunks may use top-level ``await`` (see
+  :class:`pytwine.async_processor.AsyncPythonProcessor`)"""
+
+  timeout: Optional[float] = None
+  """if not None, a limit (in seconds) on the wall-clock time the
+  document's code chunks may take"""
+
+  cpu_timeout: Optional[float] = None
+  """if not None, a limit (in seconds) on the CPU time the document's
+  code chunks may take"""
+
+  memory_limit: Optional[str] = None
+  """if not None, a limit (in bytes, with an optional K, M or G
+  suffix) on the process's address space while code chunks run (see
+  :mod:`pytwine.limits`)"""
+
+  on_limit: str = "continue"
+  """``"continue"`` or ``"stop"`` after a code chunk exceeds a limit
+  set by its block options"""
+
+  profile_report: Optional[str] = None
+  """if not None, a file to write a JSON profile of each code chunk's
+  execution to (see :class:`pytwine.profiling.ProfileReport`); a
+  table of it is also written to the log"""
+
+  cprofile: bool = False
+  """if True, run every code chunk under :mod:`cProfile` (otherwise,
+  only code blocks with class ``.cprofile`` are), and write
+  ``.pstats`` files named ``pstats_prefix.chunkN.pstats``"""
+
+  pstats_prefix: Optional[str] = None
+  "prefix of ``.pstats`` files (see ``cprofile``)"
+
+  source_path: Optional[str] = None
+  """the path of the document (by default, the input's ``name``, if
+  that is a path); profiled chunks are compiled under it (see
+  :class:`pytwine.processors.ProcessorOptions`)"""
+
+  trace: Optional[str] = None
+  """if not None, a file to write a trace of parsing, and of each
+  code chunk's compilation, execution and output, to, in the Chrome
+  ``trace_event`` format (see :mod:`pytwine.events`)"""
+
+  spool_size: Optional[str] = None
+  """if not None, a number of characters (with an optional K, M or G
+  suffix) of each code chunk's output to hold in memory, beyond which
+  it is held in a temporary file (see
+  :class:`pytwine.processors.ProcessorOptions`)"""
+
+
+def _parse(ifp : IO, options : TwineOptions,
+           hooks : Optional[EventHooks]) -> Iterable[Chunk]:
+  """the chunks of the document in ``ifp``"""
+
+  if options.parse_cache is not None:
+    # the cache is keyed by the whole text, so we have to read it
+    cache = ParseCache(options.parse_cache)
+    text = ifp.read()
+    if options.binary:
+      text = str(text, "utf-8")
+    if hooks is not None:
+      with hooks.span(PARSE):
+        chunks = cache.parse(MarkdownParser(string=text))
+    else:
+      chunks = cache.parse(MarkdownParser(string=text))
+    if options.debug:
+      print("parse cache hits:", cache.hits, "misses:", cache.misses,
+            file=sys.stderr)
+  elif options.binary:
+    chunks = MarkdownParser(buffer=_read_buffer(ifp)).iter_chunks()
+  else:
+    chunks = MarkdownParser(file=ifp).iter_chunks()
+  if hooks is not None:
+    chunks = traced_chunks(chunks, hooks)
+  return chunks
+
+def _processor_options(options : TwineOptions,
+                       hooks : Optional[EventHooks]) -> ProcessorOptions:
+  """the :class:`ProcessorOptions` our ``options`` call for"""
+
+  output_cache = options.output_cache
+  if options.checkpoints is not None and output_cache is None:
+    output_cache = os.path.join(options.checkpoints, "outputs")
+  memory_limit = options.memory_limit
+  return ProcessorOptions(
+    output_cache=OutputCache(output_cache) if output_cache is not None else None,
+    checkpoint_store=(CheckpointStore(options.checkpoints)
+                      if options.checkpoints is not None else None),
+    checkpoint_interval=options.checkpoint_interval,
+    chunk_jobs=options.chunk_jobs,
+    stream_output=options.stream,
+    flush_size=options.flush_size,
+    code_cache=(CodeCache(options.code_cache)
+                if options.code_cache is not None else None),
+    limits=ResourceLimits(
+      wall_time=options.timeout, cpu_time=options.cpu_timeout,
+      memory=parse_size(memory_limit) if memory_limit is not None else None),
+    limit_policy=options.on_limit,
+    profile=ProfileReport() if options.profile_report is not None else None,
+    cprofile=options.cprofile,
+    pstats_prefix=options.pstats_prefix,
+    source_path=options.source_path,
+    hooks=hooks,
+    spool_size=(parse_size(options.spool_size)
+                if options.spool_size is not None else None))
+
+def cli_twine(ifp : IO, ofp : IO, options : Optional[TwineOptions] = None,
+              **kwargs) -> TwineExitStatus :
   """
   Process a markdown document and write output to a file
 
   Parameters:
-    infile_name: input file-like
-    outfile_name: output file-like
+    ifp: input file-like
+    ofp: output file-like
+    options: how to process it (see :class:`TwineOptions`).
+    kwargs: fields of :class:`TwineOptions`, overriding those of
+      ``options``.
 
   Returns:
     a :class:`TwineExitStatus` with a .value that
     can be passed to sys.exit.
   """
 
-  if debug:
+  options = (options or TwineOptions())._replace(**kwargs)
+  if options.debug:
     print("running cli w infile:", ifp, "outfile:", ofp, file=sys.stderr)
 
-  parser = MarkdownParser(file=ifp)
-  chunks = parser.parse()
+  if options.source_path is None:
+    name = getattr(ifp, "name", None)
+    if isinstance(name, str) and not name.startswith("<"):
+      options = options._replace(source_path=name)
+  hooks = None
+  if options.trace is not None:
+    exporter = ChromeTraceExporter(process_name=options.source_path or "pytwine")
+    hooks = EventHooks([exporter])
 
-  processor = PythonProcessor(ofp)
-  return processor.twine(chunks)
+  chunks = _parse(ifp, options, hooks)
+  processor_options = _processor_options(options, hooks)
+  processor_class = AsyncPythonProcessor if options.use_async else PythonProcessor
+  status = processor_class(
+    ofp, log=options.log if options.log is not None else sys.stderr,
+    options=processor_options).twine(chunks)
+  profile = processor_options.profile
+  if profile is not None:
+    with open(cast(str, options.profile_report), "w", encoding="utf8") as profile_fp:
+      profile.write_json(profile_fp)
+  if options.trace is not None:
+    with open(options.trace, "w", encoding="utf8") as trace_fp:
+      exporter.write_json(trace_fp)
+  code_cache = processor_options.code_cache
+  if options.debug and code_cache is not None:
+    print("code cache hits:", code_cache.hits, "misses:", code_cache.misses,
+          file=sys.stderr)
+  return status
 
 
 
@@ -3,8 +3,16 @@
 Core classes: chunks of document, exit statuses.
 """
 
+import codecs
+import io
+
+from array import array
+from collections.abc import Sequence
 from enum import Enum
-from typing import NamedTuple, List
+from typing import (Any, Callable, Dict, Iterable, Iterator, NamedTuple, List,
+                    Optional)
+
+from .options import BlockOptions
 
 class Chunk(NamedTuple):
   """
@@ -60,6 +68,16 @@ def merge_docchunks(chunks: List[DocChunk]) -> DocChunk:
   if not chunks:
     raise ValueError("ack!")
 
+  # adjacent spans of the same buffer can be merged without decoding
+  first = chunks[0]
+  if isinstance(first, LazyDocChunk) and \
+      all(isinstance(chunk, LazyDocChunk) and chunk.buffer is first.buffer
+          for chunk in chunks) and \
+      all(prev.span[1] == nxt.span[0] for prev, nxt in zip(chunks, chunks[1:])):
+    return LazyDocChunk(first.buffer, first.span[0], chunks[-1].span[1],
+                        number=first.number,
+                        startLineNum=first.startLineNum)
+
   combined_conts = []
   for chunk in chunks:
     combined_conts.append( chunk.contents )
@@ -76,6 +94,13 @@ class CodeChunk(Chunk):
                 line.
     block_end_line: stores the end-of-code-block demarcator
                 line.
+    options: the block's options, parsed from ``block_start_line``
+                (see :mod:`pytwine.options`). Parsers supply these
+                when they create chunks; otherwise they are parsed
+                (as for a :class:`MarkdownParser
+                <pytwine.parsers.MarkdownParser>`) on first access.
+                Options aren't included in comparisons, since they
+                are derived from ``block_start_line``.
   >>> c = CodeChunk(contents="foo bar", number=3, startLineNum=10, \
 block_start_line="``` python", block_end_line="```")
   >>> c
@@ -106,11 +131,26 @@ startLineNum=10, block_start_line='``` python', block_end_line='```')
     else:
       raise ValueError("must specify block_end_line for CodeChunk")
 
+    options = kwargs.pop("options", None)
+
     self = super(CodeChunk, cls).__new__(cls, "code", *args, **kwargs)
     self.block_start_line = block_start_line
     self.block_end_line   = block_end_line
+    self._options         = options
     return self
 
+  @property
+  def options(self) -> BlockOptions:
+    """the block's parsed options"""
+
+    options = self.__dict__.get("_options")
+    if options is None:
+      # pylint: disable=import-outside-toplevel,cyclic-import
+      from .parsers import start_line_options
+      options = start_line_options(self.__dict__.get("block_start_line", ""))
+      self.__dict__["_options"] = options
+    return options
+
   def __str__(self):
     orig = super().__str__()
     return orig[0:-1] + \
@@ -125,6 +165,8 @@ startLineNum=10, block_start_line='``` python', block_end_line='```')
 
   def __eq__(self, value):
     orig = super().__eq__(value)
+    if orig is NotImplemented:
+      return orig
     if not orig:
       return False
     try:
@@ -134,6 +176,387 @@ startLineNum=10, block_start_line='``` python', block_end_line='```')
       return False
 
 
+
+def _is_utf8(encoding : Optional[str]) -> bool:
+  """whether ``encoding`` names the UTF-8 codec"""
+
+  if not encoding:
+    return False
+  try:
+    return codecs.lookup(encoding).name == "utf-8"
+  except LookupError:
+    return False
+
+def is_binary_sink(sink) -> bool:
+  """whether ``sink`` is a binary (rather than text) file-like"""
+
+  return isinstance(sink, (io.RawIOBase, io.BufferedIOBase))
+
+class LazyContents:
+  """
+  Mixin for chunks whose contents are a span of a UTF-8 encoded
+  buffer (such as a memory-mapped file), only decoded when the
+  ``contents`` attribute is first read.
+
+  Apart from that, lazy chunks behave like their eager
+  counterparts: they compare equal to, and have the same ``repr``
+  as, the :class:`DocChunk` or :class:`CodeChunk` they stand for.
+
+  Attributes:
+    buffer: the buffer the contents are held in.
+    span:   ``(start, end)`` byte offsets of the contents in ``buffer``.
+  """
+
+  # the eager class this stands for; set by subclasses
+  _eager_class : Callable[..., Chunk]
+
+  buffer : Any
+  span : Any
+  _text : Optional[str]
+
+  def _set_span(self, buffer, start : int, end : int) -> None:
+    """record where our contents are"""
+
+    self.buffer = buffer
+    self.span   = (start, end)
+    self._text  = None
+
+  def _decode(self) -> str:
+    """decode our span (without keeping the result)"""
+
+    start, end = self.span
+    return str(self.buffer[start:end], "utf-8")
+
+  @property
+  def decoded(self) -> bool:
+    """whether our contents have been decoded yet"""
+
+    return self._text is not None
+
+  @property
+  def contents(self) -> str:
+    """string contents of the chunk (decoded on first access)"""
+
+    if self._text is None:
+      self._text = self._decode()
+    return self._text
+
+  def write_contents(self, sink) -> None:
+    """
+    Write our contents to ``sink``.
+
+    If they haven't been decoded, and ``sink`` is either a binary
+    file or a text file whose underlying binary buffer is UTF-8
+    encoded, the bytes are copied straight through without being
+    decoded. (Binary sinks are always written UTF-8 encoded bytes.)
+    """
+
+    if is_binary_sink(sink):
+      if self._text is None:
+        start, end = self.span
+        with memoryview(self.buffer) as view, view[start:end] as piece:
+          sink.write(piece)
+      else:
+        sink.write(self._text.encode("utf-8"))
+      return
+
+    binary_sink = getattr(sink, "buffer", None)
+    if self._text is None and binary_sink is not None and \
+        _is_utf8(getattr(sink, "encoding", None)):
+      start, end = self.span
+      sink.flush()
+      with memoryview(self.buffer) as view, view[start:end] as piece:
+        binary_sink.write(piece)
+    elif self._text is None:
+      sink.write(self._decode())
+    else:
+      sink.write(self._text)
+
+  def materialise(self) -> Chunk:
+    """return the equivalent eager chunk"""
+
+    # (iterating over ourselves decodes the contents)
+    fields = dict(zip(Chunk._fields, self))
+    del fields["chunkType"]
+    if isinstance(self, CodeChunk):
+      fields["block_start_line"] = self.block_start_line
+      fields["block_end_line"]   = self.block_end_line
+      fields["options"]          = self.options
+    return self._eager_class(**fields)
+
+  # everything that would otherwise see the tuple's placeholder
+  # contents goes via the eager chunk.
+
+  def __iter__(self):
+    # (the placeholder is at index 1 -- chunkType comes first)
+    fields = list(tuple.__iter__(self)) # type: ignore
+    fields[1] = self.contents
+    return iter(fields)
+
+  def __getitem__(self, index):
+    return tuple(self)[index]
+
+  def __eq__(self, value):
+    return self.materialise() == value
+
+  def __ne__(self, value):
+    return not self == value
+
+  def __hash__(self):
+    return hash(self.materialise())
+
+  def __repr__(self):
+    return repr(self.materialise())
+
+  def __str__(self):
+    return str(self.materialise())
+
+  def _replace(self, **kwargs):
+    return self.materialise()._replace(**kwargs)
+
+
+class LazyDocChunk(LazyContents, DocChunk):
+  """
+  A :class:`DocChunk` whose contents are the bytes
+  ``buffer[start:end]``, decoded as UTF-8 when first needed.
+
+  >>> d = LazyDocChunk(b"xxfoo bar", 2, 9, number=3, startLineNum=10)
+  >>> d
+  DocChunk(chunkType='doc', contents='foo bar', number=3, startLineNum=10)
+  >>> d == DocChunk(contents="foo bar", number=3, startLineNum=10)
+  True
+  """
+
+  _eager_class = DocChunk
+
+  def __new__(cls, buffer, start : int, end : int, **kwargs):
+    self = super(LazyDocChunk, cls).__new__(cls, contents=None, **kwargs)
+    self._set_span(buffer, start, end)
+    return self
+
+class LazyCodeChunk(LazyContents, CodeChunk):
+  """
+  A :class:`CodeChunk` whose contents are the bytes
+  ``buffer[start:end]``, decoded as UTF-8 when first needed.
+  """
+
+  _eager_class = CodeChunk
+
+  def __new__(cls, buffer, start : int, end : int, **kwargs):
+    self = super(LazyCodeChunk, cls).__new__(cls, contents=None, **kwargs)
+    self._set_span(buffer, start, end)
+    return self
+
+
+class ChunkView:
+  """
+  A lightweight view of one chunk in a :class:`ChunkTable`, with the
+  same attributes as a :class:`Chunk` (plus, for code chunks,
+  ``block_start_line``, ``block_end_line`` and ``options``).
+
+  Views compare equal to the chunks they represent.
+  """
+
+  __slots__ = ("_table", "_index")
+
+  def __init__(self, table : "ChunkTable", index : int):
+    self._table = table
+    self._index = index
+
+  @property
+  def chunkType(self) -> str:
+    """chunk type: "doc" or "code"."""
+    return self._table.chunk_type(self._index)
+
+  @property
+  def contents(self) -> str:
+    """string contents of the chunk"""
+    return self._table.contents(self._index)
+
+  @property
+  def number(self) -> int:
+    """doc or code chunk position number in the document"""
+    return self._table.number(self._index)
+
+  @property
+  def startLineNum(self) -> int:
+    """line number (starting from 1) the chunk was found at"""
+    return self._table.start_line(self._index)
+
+  @property
+  def block_start_line(self) -> str:
+    """start-of-code-block line (code chunks only)"""
+    return self._table.block_start_line(self._index)
+
+  @property
+  def block_end_line(self) -> str:
+    """end-of-code-block line (code chunks only)"""
+    return self._table.block_end_line(self._index)
+
+  @property
+  def options(self) -> BlockOptions:
+    """parsed code block options (code chunks only)"""
+    return self._table.options(self._index)
+
+  def to_chunk(self) -> Chunk:
+    """return the equivalent :class:`DocChunk` or :class:`CodeChunk`"""
+
+    if self.chunkType == "doc":
+      return DocChunk(contents=self.contents, number=self.number,
+                      startLineNum=self.startLineNum)
+    return CodeChunk(contents=self.contents, number=self.number,
+                     startLineNum=self.startLineNum,
+                     block_start_line=self.block_start_line,
+                     block_end_line=self.block_end_line,
+                     options=self.options)
+
+  def __eq__(self, value):
+    if isinstance(value, ChunkView):
+      value = value.to_chunk()
+    return self.to_chunk() == value
+
+  def __ne__(self, value):
+    return not self == value
+
+  __hash__ = None # type: ignore
+
+  def __repr__(self):
+    return repr(self.to_chunk())
+
+class ChunkTable(Sequence):
+  """
+  A compact, column-oriented sequence of chunks.
+
+  Chunk types, numbers and start line numbers are held in
+  :mod:`array`-backed columns, and code block start and end lines are
+  interned, so that each distinct fence line is stored once.
+  Indexing or iterating over a table gives :class:`ChunkView`\\ s,
+  created on demand.
+
+  Contents of :class:`LazyContents` chunks are decoded when they
+  are added.
+
+  >>> table = ChunkTable([DocChunk(contents="foo", number=1, startLineNum=1)])
+  >>> len(table)
+  1
+  >>> table[0]
+  DocChunk(chunkType='doc', contents='foo', number=1, startLineNum=1)
+  """
+
+  CHUNK_TYPES = ("doc", "code")
+
+  def __init__(self, chunks : Iterable[Chunk] = ()):
+    self._types       = array("b")
+    self._numbers     = array("l")
+    self._start_lines = array("l")
+    self._contents    : List[str] = []
+
+    # indexes into _fences, or -1 for doc chunks
+    self._block_starts = array("l")
+    self._block_ends   = array("l")
+    self._fences       : List[str] = []
+    self._fence_indexes : Dict[str, int] = {}
+    # options of code chunks, keyed by index of their start line
+    self._start_options : Dict[int, BlockOptions] = {}
+
+    for chunk in chunks:
+      self.append(chunk)
+
+  def _intern_fence(self, line : str) -> int:
+    """return index of ``line`` in _fences, adding it if need be"""
+
+    index = self._fence_indexes.get(line)
+    if index is None:
+      index = len(self._fences)
+      self._fences.append(line)
+      self._fence_indexes[line] = index
+    return index
+
+  def _fence(self, column : array, index : int) -> str:
+    """look up the fence line for chunk ``index`` in ``column``"""
+
+    fence_index = column[index]
+    if fence_index < 0:
+      raise AttributeError("doc chunks have no code block lines")
+    return self._fences[fence_index]
+
+  # accessors for the fields of chunk ``index`` (used by ChunkView)
+
+  def chunk_type(self, index : int) -> str:
+    """chunk type of chunk ``index``: "doc" or "code"."""
+    return self.CHUNK_TYPES[self._types[index]]
+
+  def contents(self, index : int) -> str:
+    """string contents of chunk ``index``"""
+    return self._contents[index]
+
+  def number(self, index : int) -> int:
+    """doc or code chunk position number of chunk ``index``"""
+    return self._numbers[index]
+
+  def start_line(self, index : int) -> int:
+    """line number chunk ``index`` was found at"""
+    return self._start_lines[index]
+
+  def block_start_line(self, index : int) -> str:
+    """start-of-code-block line of chunk ``index`` (a code chunk)"""
+    return self._fence(self._block_starts, index)
+
+  def block_end_line(self, index : int) -> str:
+    """end-of-code-block line of chunk ``index`` (a code chunk)"""
+    return self._fence(self._block_ends, index)
+
+  def options(self, index : int) -> BlockOptions:
+    """parsed code block options of chunk ``index`` (a code chunk)"""
+    start_index = self._block_starts[index]
+    if start_index < 0:
+      raise AttributeError("doc chunks have no code block options")
+    return self._start_options[start_index]
+
+  @property
+  def fence_lines(self) -> List[str]:
+    """the distinct code block start and end lines stored"""
+    return list(self._fences)
+
+  def append(self, chunk : Any) -> None:
+    """add a :class:`Chunk` (or :class:`ChunkView`) to the end of the table"""
+
+    self._types.append(self.CHUNK_TYPES.index(chunk.chunkType))
+    self._numbers.append(chunk.number)
+    self._start_lines.append(chunk.startLineNum)
+    self._contents.append(chunk.contents)
+    if chunk.chunkType == "code":
+      start_index = self._intern_fence(chunk.block_start_line)
+      if start_index not in self._start_options:
+        self._start_options[start_index] = chunk.options
+      self._block_starts.append(start_index)
+      self._block_ends.append(self._intern_fence(chunk.block_end_line))
+    else:
+      self._block_starts.append(-1)
+      self._block_ends.append(-1)
+
+  def to_chunks(self) -> List[Chunk]:
+    """return the table's contents as a list of chunks"""
+
+    return [view.to_chunk() for view in self]
+
+  def __len__(self) -> int:
+    return len(self._types)
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return [self[i] for i in range(*index.indices(len(self)))]
+    if index < 0:
+      index += len(self)
+    if not 0 <= index < len(self):
+      raise IndexError("ChunkTable index out of range")
+    return ChunkView(self, index)
+
+  def __iter__(self) -> Iterator[ChunkView]:
+    for index in range(len(self)):
+      yield ChunkView(self, index)
+
+
 class TwineExitStatus(Enum):
   """Some exit statuses.
 
@@ -150,4 +573,7 @@ class TwineExitStatus(Enum):
   BLOCK_COMPILATION_ERROR = 2
   "an exception was encountered trying to compile a code block"
 
+  RESOURCE_LIMIT_EXCEEDED = 3
+  "a code block exceeded a time or memory limit, and was aborted"
+
 
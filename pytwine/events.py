@@ -0,0 +1,255 @@
+"""
+Events marking the stages of processing a document, for timing and
+tracing.
+
+A :class:`PythonProcessor <pytwine.processors.PythonProcessor>` given
+an :class:`EventHooks` as its ``hooks`` emits an :class:`Event` as
+each of these begins and ends:
+
+- :data:`DOCUMENT`: processing the whole document (``data`` holds
+  its ``path``, if known);
+- :data:`PARSE`: parsing each chunk (see :func:`traced_chunks`; for
+  documents parsed all at once, a single span with no chunk);
+- :data:`COMPILE` and :data:`EXEC`: compiling, and executing, each
+  code chunk;
+- :data:`WRITE`: writing to the output (``data`` holds its ``size``:
+  the number of characters written, or of bytes, for chunk contents
+  copied without decoding).
+
+Listeners are callables taking an :class:`Event`; they are called in
+the thread the event happened in, and anything they raise propagates.
+Code emitting events checks whether any listeners are registered
+first, so hooks with none cost next to nothing.
+
+:class:`ChromeTraceExporter` is a listener recording events in the
+Chrome ``trace_event`` format, which Perfetto (https://ui.perfetto.dev)
+and ``chrome://tracing`` display as a timeline.
+
+>>> hooks = EventHooks()
+>>> names = []
+>>> hooks.add(lambda event: names.append((event.name, event.phase)))
+>>> with hooks.span(PARSE):
+...   pass
+>>> names
+[('parse', 'begin'), ('parse', 'end')]
+"""
+
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import (IO, Any, Callable, Dict, Iterable, Iterator, List,
+                    NamedTuple, Optional)
+
+from .core import Chunk
+
+DOCUMENT = "document"
+"processing a whole document"
+
+PARSE = "parse"
+"parsing a chunk (or a whole document)"
+
+COMPILE = "compile"
+"compiling a code chunk"
+
+EXEC = "exec"
+"executing a code chunk"
+
+WRITE = "write"
+"writing to the output"
+
+BEGIN = "begin"
+"phase of events marking the start of something"
+
+END = "end"
+"phase of events marking the end of something"
+
+class Event(NamedTuple):
+  """something beginning or ending"""
+
+  name: str
+  "what it is: :data:`DOCUMENT`, :data:`PARSE`, etc."
+
+  phase: str
+  ":data:`BEGIN` or :data:`END`"
+
+  timestamp: float
+  "when it happened, in seconds, by :func:`time.perf_counter`"
+
+  thread: int
+  "identifier of the thread it happened in (see :func:`threading.get_ident`)"
+
+  chunk_number: Optional[int] = None
+  "number of the chunk concerned, if any"
+
+  start_line: Optional[int] = None
+  "line number the chunk concerned starts at, if any"
+
+  data: Optional[Dict[str, Any]] = None
+  "further details, depending on ``name``"
+
+Listener = Callable[[Event], None]
+
+class EventHooks:
+  """
+  A set of listeners to be told of :class:`Event`\\ s. Hooks are
+  false when no listeners are registered, so emitting code can skip
+  building events with ``if hooks:``.
+  """
+
+  def __init__(self, listeners : Iterable[Listener] = ()):
+    self.listeners : List[Listener] = list(listeners)
+
+  def add(self, listener : Listener) -> None:
+    """register ``listener``"""
+
+    self.listeners.append(listener)
+
+  def remove(self, listener : Listener) -> None:
+    """unregister ``listener``"""
+
+    self.listeners.remove(listener)
+
+  def __bool__(self) -> bool:
+    return bool(self.listeners)
+
+  def emit(self, name : str, phase : str, chunk : Optional[Chunk] = None,
+           **data) -> None:
+    """tell our listeners that ``name`` has reached ``phase`` (for
+    ``chunk``, if given)"""
+
+    event = Event(name, phase, time.perf_counter(), threading.get_ident(),
+                  getattr(chunk, "number", None),
+                  getattr(chunk, "startLineNum", None),
+                  data or None)
+    for listener in self.listeners:
+      listener(event)
+
+  @contextmanager
+  def span(self, name : str, chunk : Optional[Chunk] = None,
+           **data) -> Iterator[None]:
+    """emit ``name``'s beginning and end around the body of the
+    ``with`` statement"""
+
+    self.emit(name, BEGIN, chunk, **data)
+    try:
+      yield
+    finally:
+      self.emit(name, END, chunk)
+
+
+def traced_chunks(chunks : Iterable[Chunk], hooks : EventHooks
+                 ) -> Iterator[Chunk]:
+  """
+  Pass on ``chunks``, emitting a :data:`PARSE` span around getting
+  each one (so for a lazy parser, such as :meth:`MarkdownParser.iter_chunks
+  <pytwine.parsers.MarkdownParser.iter_chunks>`, around parsing it).
+  The beginning of a span has no chunk, as it isn't known yet.
+  """
+
+  iterator = iter(chunks)
+  while True:
+    hooks.emit(PARSE, BEGIN)
+    try:
+      chunk = next(iterator)
+    except StopIteration:
+      hooks.emit(PARSE, END)
+      return
+    hooks.emit(PARSE, END, chunk)
+    yield chunk
+
+
+_PHASES = {BEGIN: "B", END: "E"}
+
+class ChromeTraceExporter:
+  """
+  A listener recording events in the Chrome ``trace_event`` format:
+  each span becomes a pair of duration events, in a track for the
+  thread it happened in, with chunk details as arguments.
+
+  Arguments:
+    process_name: name shown for the process's tracks (e.g. the
+      document's path).
+    pid: process ID to record (default: our own). Timestamps come from
+      a system-wide clock, so traces from several processes (see
+      :func:`merge_traces`) line up.
+
+  >>> exporter = ChromeTraceExporter(process_name="doc.pmd", pid=1)
+  >>> exporter(Event(EXEC, BEGIN, 2.5, 99, chunk_number=1, start_line=3))
+  >>> exporter.trace_events[-1]["name"], exporter.trace_events[-1]["ts"]
+  ('exec chunk 1', 2500000.0)
+  """
+
+  def __init__(self, process_name : Optional[str] = None,
+               pid : Optional[int] = None):
+    self.pid = os.getpid() if pid is None else pid
+    self.trace_events : List[Dict[str, Any]] = []
+    self._threads : Dict[int, int] = {}
+    self._lock = threading.Lock()
+    if process_name is not None:
+      self.trace_events.append({"name": "process_name", "ph": "M",
+                                "pid": self.pid,
+                                "args": {"name": process_name}})
+
+  def _tid(self, thread : int) -> int:
+    """a small thread ID for ``thread``, naming its track when first seen"""
+
+    tid = self._threads.get(thread)
+    if tid is None:
+      tid = self._threads[thread] = len(self._threads) + 1
+      self.trace_events.append({"name": "thread_name", "ph": "M",
+                                "pid": self.pid, "tid": tid,
+                                "args": {"name": "main" if tid == 1 else
+                                                 f"worker {tid - 1}"}})
+    return tid
+
+  def __call__(self, event : Event) -> None:
+    name = event.name
+    if event.chunk_number is not None and event.name != PARSE:
+      name = f"{name} chunk {event.chunk_number}"
+    record : Dict[str, Any] = {"name": name, "cat": event.name,
+                               "ph": _PHASES[event.phase],
+                               "ts": event.timestamp * 1e6}
+    args = dict(event.data or {})
+    if event.chunk_number is not None:
+      args["chunk"] = event.chunk_number
+      args["line"] = event.start_line
+    if args:
+      record["args"] = args
+    with self._lock:
+      record["pid"] = self.pid
+      record["tid"] = self._tid(event.thread)
+      self.trace_events.append(record)
+
+  def to_json(self) -> Dict[str, Any]:
+    """the trace, as a JSON-serialisable dict"""
+
+    return {"traceEvents": self.trace_events, "displayTimeUnit": "ms"}
+
+  def write_json(self, ofp : IO[str]) -> None:
+    """write the trace to ``ofp`` as JSON"""
+
+    json.dump(self.to_json(), ofp)
+    ofp.write("\n")
+
+
+def merge_traces(paths : Iterable[str], ofp : IO[str]) -> None:
+  """
+  Merge the traces written by :class:`ChromeTraceExporter`\\ s to
+  ``paths`` into one, written to ``ofp``. Each trace is given a
+  process ID of its own (its position in ``paths``), so each is shown
+  as a separate group of tracks, even if several came from the same
+  process.
+  """
+
+  merged : List[Dict[str, Any]] = []
+  for pid, path in enumerate(paths, 1):
+    with open(path, encoding="utf8") as ifp:
+      events = json.load(ifp)["traceEvents"]
+    for record in events:
+      record["pid"] = pid
+    merged.extend(events)
+  json.dump({"traceEvents": merged, "displayTimeUnit": "ms"}, ofp)
+  ofp.write("\n")
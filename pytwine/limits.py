@@ -0,0 +1,220 @@
+"""
+Limits on the wall-clock time, CPU time and memory code chunks may use.
+
+Limits can be set for each code block with block options::
+
+  ```python timeout=30 cpu-timeout=10 memory-limit=2G
+
+and for a whole document (see :class:`PythonProcessor
+<pytwine.processors.PythonProcessor>`'s ``limits``, and the
+``pytwine`` script's ``--timeout``, ``--cpu-timeout`` and
+``--memory-limit`` options). A chunk that exceeds a limit is
+aborted with a :class:`ResourceLimitExceeded` exception.
+
+Time limits are enforced with interval timers and signals, and the
+memory limit by capping the process's address space (``RLIMIT_AS``),
+so limits are only available on POSIX systems. Time limits are
+ignored outside the main thread. As the address space cap applies to
+the whole process, memory limits can only be set from the main thread
+(a chunk's memory limit limits any other threads running at the same
+time, too). Code that spends a long time in a single call to C code
+may overrun a time limit until that call returns.
+"""
+
+import signal
+import threading
+
+from contextlib import contextmanager
+from typing import Iterator, Mapping, NamedTuple, Optional, TypeVar
+
+try:
+  import resource
+except ImportError:
+  resource = None # type: ignore
+
+OPTION_NAMES = {
+  "wall_time": "timeout",
+  "cpu_time":  "cpu-timeout",
+  "memory":    "memory-limit",
+}
+"block option names for each :class:`ResourceLimits` field"
+
+_DESCRIPTIONS = {
+  "wall_time": "wall-clock time",
+  "cpu_time":  "CPU time",
+  "memory":    "memory",
+}
+
+_SIZE_MULTIPLIERS = {"K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+
+def parse_size(text : str) -> int:
+  """
+  Parse a size in bytes, with an optional K, M, G or T suffix.
+
+  >>> parse_size("512M")
+  536870912
+  """
+
+  text = text.strip().upper()
+  if text.endswith("B"):
+    text = text[:-1]
+  if text and text[-1] in _SIZE_MULTIPLIERS:
+    return int(float(text[:-1]) * _SIZE_MULTIPLIERS[text[-1]])
+  return int(text)
+
+_T = TypeVar("_T", int, float)
+
+def _min(first : Optional[_T], second : Optional[_T]) -> Optional[_T]:
+  if first is None:
+    return second
+  if second is None:
+    return first
+  return min(first, second)
+
+
+class ResourceLimits(NamedTuple):
+  """limits on resources used, any of which may be None (no limit)"""
+
+  wall_time: Optional[float] = None
+  "wall-clock time, in seconds"
+
+  cpu_time: Optional[float] = None
+  "CPU time (user and system), in seconds"
+
+  memory: Optional[int] = None
+  "size of the process's address space, in bytes"
+
+  def tightened(self, other : "ResourceLimits") -> "ResourceLimits":
+    """
+    the tighter of our limits and ``other``'s
+
+    >>> ResourceLimits(wall_time=5, memory=2**30).tightened(ResourceLimits(wall_time=2))
+    ResourceLimits(wall_time=2, cpu_time=None, memory=1073741824)
+    """
+
+    return ResourceLimits(*(_min(mine, theirs)
+                            for mine, theirs in zip(self, other)))
+
+  def any(self) -> bool:
+    """whether any limit is set"""
+
+    return self != ResourceLimits()
+
+  @classmethod
+  def from_options(cls, options : Mapping[str, str]) -> "ResourceLimits":
+    """
+    The limits given by a code block's options (see
+    :data:`OPTION_NAMES`). Raises :class:`ValueError` for
+    unparseable values.
+
+    >>> ResourceLimits.from_options({"timeout": "1.5", "memory-limit": "1G"})
+    ResourceLimits(wall_time=1.5, cpu_time=None, memory=1073741824)
+    """
+
+    values = {}
+    for field, option in OPTION_NAMES.items():
+      text = options.get(option)
+      if text is None:
+        continue
+      try:
+        values[field] = parse_size(text) if field == "memory" else float(text)
+      except ValueError:
+        raise ValueError(f"bad {option} option: {text!r}") from None
+    return cls(**values)
+
+
+class ResourceLimitExceeded(BaseException):
+  """
+  Raised in code that exceeds a resource limit. (It derives from
+  :class:`BaseException`, like :class:`KeyboardInterrupt`, so that
+  ``except Exception`` clauses in the code don't stop it.)
+
+  Attributes:
+    resource: the :class:`ResourceLimits` field exceeded
+    limit: the limit's value
+  """
+
+  def __init__(self, resource_name : str, limit):
+    self.resource = resource_name
+    self.limit = limit
+    super().__init__(f"exceeded {describe_limit(resource_name, limit)}")
+
+
+def describe_limit(resource_name : str, limit) -> str:
+  """
+  describe the limit ``limit`` on the :class:`ResourceLimits` field
+  ``resource_name``
+
+  >>> describe_limit("wall_time", 2.5)
+  'wall-clock time limit of 2.5s'
+  """
+
+  units = " bytes" if resource_name == "memory" else "s"
+  return f"{_DESCRIPTIONS[resource_name]} limit of {limit:g}{units}"
+
+
+@contextmanager
+def _timer(which : int, signum : int, resource_name : str,
+           seconds : Optional[float]) -> Iterator[None]:
+  """raise ResourceLimitExceeded if the timer ``which`` runs for
+  ``seconds``"""
+
+  if seconds is None or threading.current_thread() is not threading.main_thread():
+    yield
+    return
+
+  def handler(_signum, _frame):
+    raise ResourceLimitExceeded(resource_name, seconds)
+
+  old_handler = signal.signal(signum, handler)
+  # a zero timer would be disabled, rather than expire at once
+  signal.setitimer(which, max(seconds, 1e-6))
+  try:
+    yield
+  finally:
+    signal.setitimer(which, 0)
+    signal.signal(signum, old_handler)
+
+@contextmanager
+def _address_space(limit : Optional[int]) -> Iterator[None]:
+  """cap the address space at ``limit`` bytes, turning MemoryErrors
+  into ResourceLimitExceeded"""
+
+  if limit is None:
+    yield
+    return
+  # another thread restoring the old cap would lift ours
+  if threading.current_thread() is not threading.main_thread():
+    raise NotImplementedError("memory limits can only be set in the main thread")
+
+  old_soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+  if hard != resource.RLIM_INFINITY:
+    limit = min(limit, hard)
+  resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+  try:
+    yield
+  except MemoryError:
+    raise ResourceLimitExceeded("memory", limit) from None
+  finally:
+    resource.setrlimit(resource.RLIMIT_AS, (old_soft, hard))
+
+@contextmanager
+def enforce(limits : ResourceLimits) -> Iterator[None]:
+  """
+  Run the body of the ``with`` statement under ``limits``, raising
+  :class:`ResourceLimitExceeded` if one is exceeded. Time limits are
+  ignored outside the main thread. Raises :class:`NotImplementedError`
+  if limits are given but can't be enforced on this platform, or if a
+  memory limit is given outside the main thread.
+  """
+
+  if not limits.any():
+    yield
+    return
+  if resource is None or not hasattr(signal, "setitimer"):
+    raise NotImplementedError("resource limits need a POSIX system")
+
+  with _address_space(limits.memory), \
+       _timer(signal.ITIMER_PROF, signal.SIGPROF, "cpu_time", limits.cpu_time), \
+       _timer(signal.ITIMER_REAL, signal.SIGALRM, "wall_time", limits.wall_time):
+    yield
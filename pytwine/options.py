@@ -0,0 +1,156 @@
+"""
+Parsed pandoc-style code block options.
+
+A code block start line like::
+
+  ```python .important #intro startLine=101 animal="spotted lynx"
+
+carries **options**: ``.name`` gives a class, ``#name`` an identifier,
+and ``key=value`` an attribute (values may be double- or
+single-quoted). Bare words are also taken to be classes, as pandoc
+does.
+
+Options are parsed by :func:`parse_options`, which memoizes its
+results, so every code block with the same options shares a single
+immutable :class:`BlockOptions` object.
+"""
+
+import re
+
+from collections.abc import Mapping
+from functools import lru_cache
+from typing import Dict, Iterator, Optional, Tuple
+
+class BlockOptions(Mapping):
+  """
+  The options of a code block: an immutable mapping from
+  attribute names to values, plus a tuple of ``classes`` and an
+  optional ``id``.
+
+  >>> opts = parse_options('.important startLine=101 animal="spotted lynx"')
+  >>> opts["animal"]
+  'spotted lynx'
+  >>> opts.classes
+  ('important',)
+  >>> opts.get("colour") is None
+  True
+  >>> dict(opts)
+  {'startLine': '101', 'animal': 'spotted lynx'}
+  """
+
+  __slots__ = ("classes", "id", "_attributes", "_hash")
+
+  # (the slots are set with object.__setattr__, as we are immutable)
+  classes : Tuple[str, ...]
+  "the block's classes, in order"
+
+  id : Optional[str]
+  "the block's identifier, if any"
+
+  _attributes : Dict[str, str]
+  _hash : Optional[int]
+
+  def __init__(self, classes : Tuple[str, ...] = (), id : Optional[str] = None, # pylint: disable=redefined-builtin
+               attributes : Optional[Dict[str, str]] = None):
+    object.__setattr__(self, "classes", tuple(classes))
+    object.__setattr__(self, "id", id)
+    object.__setattr__(self, "_attributes", dict(attributes or {}))
+    object.__setattr__(self, "_hash", None)
+
+  def __setattr__(self, name, value):
+    raise AttributeError("BlockOptions objects are immutable")
+
+  def __delattr__(self, name):
+    raise AttributeError("BlockOptions objects are immutable")
+
+  def __getitem__(self, key : str) -> str:
+    return self._attributes[key]
+
+  def __iter__(self) -> Iterator[str]:
+    return iter(self._attributes)
+
+  def __len__(self) -> int:
+    return len(self._attributes)
+
+  def has_class(self, name : str) -> bool:
+    """whether the block has class ``name``"""
+    return name in self.classes
+
+  def __eq__(self, value):
+    if not isinstance(value, BlockOptions):
+      return NotImplemented
+    return self.classes == value.classes and self.id == value.id and \
+           self._attributes == value._attributes
+
+  def __hash__(self):
+    if self._hash is None:
+      object.__setattr__(self, "_hash",
+                         hash((self.classes, self.id,
+                               tuple(self._attributes.items()))))
+    return self._hash
+
+  def __repr__(self):
+    return (f"BlockOptions(classes={self.classes!r}, id={self.id!r}, "
+            f"attributes={self._attributes!r})")
+
+  def __reduce__(self):
+    return (BlockOptions, (self.classes, self.id, self._attributes))
+
+
+EMPTY_OPTIONS = BlockOptions()
+"options of a code block that has none"
+
+_option_re = re.compile(r"""
+    \s*
+    (?:
+      \.(?P<cls>[^\s{}="']+)
+    | \#(?P<id>[^\s{}="']+)
+    | (?P<key>[^\s{}="']+)=
+        (?: "(?P<dq>(?:[^"\\]|\\.)*)"
+          | '(?P<sq>(?:[^'\\]|\\.)*)'
+          | (?P<bare>[^\s{}]*) )
+    | (?P<word>[^\s{}="']+)
+    | (?P<other>\S)
+    )
+  """, re.VERBOSE)
+
+_escape_re = re.compile(r"\\(.)")
+
+@lru_cache(maxsize=4096)
+def parse_options(text : str) -> BlockOptions:
+  """
+  Parse the options part of a code block start line (e.g. group 2
+  of :attr:`MarkdownParser.codeblock_begin
+  <pytwine.parsers.MarkdownParser.codeblock_begin>`). Braces, and any
+  other stray punctuation, are ignored.
+
+  Results are memoized, so equal ``text`` gives the same object.
+
+  >>> parse_options("{#intro .a .b timeout=5}")
+  BlockOptions(classes=('a', 'b'), id='intro', attributes={'timeout': '5'})
+  >>> parse_options("") is EMPTY_OPTIONS
+  True
+  """
+
+  classes = []
+  block_id = None
+  attributes : Dict[str, str] = {}
+  for match in _option_re.finditer(text):
+    if match.group("cls") is not None:
+      classes.append(match.group("cls"))
+    elif match.group("word") is not None:
+      classes.append(match.group("word"))
+    elif match.group("id") is not None:
+      block_id = match.group("id")
+    elif match.group("key") is not None:
+      if match.group("dq") is not None:
+        value = _escape_re.sub(r"\1", match.group("dq"))
+      elif match.group("sq") is not None:
+        value = _escape_re.sub(r"\1", match.group("sq"))
+      else:
+        value = match.group("bare")
+      attributes[match.group("key")] = value
+
+  if not classes and block_id is None and not attributes:
+    return EMPTY_OPTIONS
+  return BlockOptions(classes, block_id, attributes)
@@ -0,0 +1,205 @@
+r"""
+Parse a single large markdown document using several processes.
+
+The text is split at line boundaries into segments, which are scanned
+in a process pool. Since a worker can't know whether its segment
+starts inside a code block (or, if so, which fence will close it),
+each segment is scanned speculatively: once starting in "doc" state,
+and once starting inside a code block for each fence that could
+close one in that segment. A quick sequential pass then picks the
+right interpretation of each segment, given the state the
+previous one ended in, and builds the
+:class:`Chunk <pytwine.core.Chunk>`\ s.
+
+Workers only report the line numbers where code blocks open and close,
+so little data passes between processes.
+"""
+
+import os
+import re
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from .core import Chunk
+from .parsers import FenceScanner, MarkdownParser
+
+# An event: (line index, state entered after that line) -- the state
+# being the fence of the code block just opened, or None when a code
+# block has just been closed.
+_Event = Tuple[int, Optional[str]]
+
+# lines consisting only of a possible fence
+_bare_fence_re = re.compile(r"[`~]{3,}")
+
+class _Interpretation(NamedTuple):
+  """events found scanning a segment from some start state, and the
+  state at the end of the segment"""
+
+  events: List[_Event]
+  end_state: Optional[str]
+
+class _SegmentScan(NamedTuple):
+  """result of scanning one segment"""
+
+  num_lines: int
+  from_doc: _Interpretation
+  # interpretations when starting inside a code block, keyed by the
+  # block's fence. Fences that don't close in the segment are absent.
+  from_code: Dict[str, _Interpretation]
+
+
+def _scan_events(lines : List[str], start : int, state : Optional[str],
+                 sync : Optional[_Interpretation] = None) -> _Interpretation:
+  """
+  Scan ``lines[start:]``, starting in ``state``.
+
+  If ``sync`` is given (the interpretation of the same lines from
+  index 0), stop as soon as our state after some line equals the
+  state ``sync`` was in after it, and take the rest of its events.
+  """
+
+  scanner = FenceScanner()
+  events : List[_Event] = []
+
+  sync_pos = 0
+  sync_state : Optional[str] = None
+
+  for idx in range(start, len(lines)):
+    line = lines[idx]
+    if state is None:
+      match = scanner.match_start(line)
+      if match is not None:
+        state = match[0]
+        events.append((idx, state))
+    elif scanner.is_end(line, state):
+      state = None
+      events.append((idx, None))
+
+    if sync is not None:
+      while sync_pos < len(sync.events) and sync.events[sync_pos][0] <= idx:
+        sync_state = sync.events[sync_pos][1]
+        sync_pos += 1
+      if sync_state == state:
+        return _Interpretation(events + sync.events[sync_pos:], sync.end_state)
+
+  return _Interpretation(events, state)
+
+def _scan_segment(text : str) -> _SegmentScan:
+  """
+  Scan a segment of a document both ways (see module doc).
+  """
+
+  lines = text.splitlines(keepends=True)
+  from_doc = _scan_events(lines, 0, None)
+
+  from_code : Dict[str, _Interpretation] = {}
+  for idx, line in enumerate(lines):
+    fence = line.strip()
+    if fence in from_code or not _bare_fence_re.fullmatch(fence):
+      continue
+    # the block is closed at the first line with that fence
+    rest = _scan_events(lines, idx + 1, None, sync=from_doc)
+    from_code[fence] = _Interpretation([(idx, None)] + rest.events,
+                                       rest.end_state)
+
+  return _SegmentScan(len(lines), from_doc, from_code)
+
+def _split_segments(text : str, num_segments : int) -> List[str]:
+  """split ``text`` after newlines into roughly equal segments"""
+
+  segments = []
+  start = 0
+  approx_size = max(len(text) // max(num_segments, 1), 1)
+  while start < len(text):
+    cut = text.find("\n", start + approx_size - 1)
+    end = len(text) if cut < 0 else cut + 1
+    segments.append(text[start:end])
+    start = end
+  return segments
+
+def _stitch(scans : List[_SegmentScan]) -> List[_Event]:
+  """
+  Pick the right interpretation of each segment, and return
+  all the events of the document, with line indexes relative to
+  the whole document.
+  """
+
+  events : List[_Event] = []
+  state : Optional[str] = None
+  base = 0
+  for scan in scans:
+    if state is None:
+      interpretation : Optional[_Interpretation] = scan.from_doc
+    else:
+      interpretation = scan.from_code.get(state)
+    if interpretation is not None:
+      events.extend((base + idx, new_state)
+                    for idx, new_state in interpretation.events)
+      state = interpretation.end_state
+    base += scan.num_lines
+  return events
+
+def _build_chunks(lines : List[str], events : List[_Event]) -> List[Chunk]:
+  """turn a document's lines and events into chunks, as a
+  :class:`MarkdownParser` would"""
+
+  parser = MarkdownParser(string="")
+  chunks : List[Chunk] = []
+  docN, codeN = 1, 1
+
+  def add(chunk : Optional[Chunk]) -> int:
+    if chunk is None:
+      return 0
+    chunks.append(chunk)
+    return 1
+
+  pos = 0
+  for idx, new_state in events:
+    if new_state is not None:
+      docN += add(parser.make_chunk("doc", lines[pos:idx], docN, pos + 1))
+      parser.block_start_line = lines[idx]
+    else:
+      parser.block_end_line = lines[idx]
+      codeN += add(parser.make_chunk("code", lines[pos:idx], codeN, pos))
+    pos = idx + 1
+
+  if events and events[-1][1] is not None:
+    parser.block_end_line = ""
+    add(parser.make_chunk("code", lines[pos:], codeN, pos))
+  else:
+    add(parser.make_chunk("doc", lines[pos:], docN, pos + 1))
+  return chunks
+
+def parse_parallel(text : str, processes : Optional[int] = None,
+                   min_segment_size : int = 1024 * 1024) -> List[Chunk]:
+  """
+  Parse ``text`` as :meth:`MarkdownParser.parse()
+  <pytwine.parsers.Parser.parse>` would, but using a pool of
+  ``processes`` worker processes (default: one per CPU).
+
+  Segments are at least ``min_segment_size`` characters, so small
+  documents use fewer processes. If that leaves a single segment, or
+  ``processes`` is 1, the document is just parsed sequentially.
+
+  >>> chunks = parse_parallel("foo\\n```python\\nprint()\\n```\\n")
+  >>> chunks[1].contents, chunks[1].startLineNum
+  ('print()\\n', 2)
+  """
+
+  if processes is None:
+    processes = os.cpu_count() or 1
+  num_segments = max(min(processes, len(text) // max(min_segment_size, 1)), 1)
+  if num_segments <= 1 or processes <= 1:
+    # the speculative scan and stitching would only add to the work
+    return MarkdownParser(string=text).parse()
+  segments = _split_segments(text, num_segments)
+  if len(segments) <= 1:
+    return MarkdownParser(string=text).parse()
+
+  with ProcessPoolExecutor(max_workers=processes) as pool:
+    scans = list(pool.map(_scan_segment, segments))
+
+  # only now do we need the document's lines
+  lines = text.splitlines(keepends=True)
+  return _build_chunks(lines, _stitch(scans))
@@ -3,11 +3,17 @@
 parse documents into chunks.
 """
 
+import bisect
+import mmap
 import re
 
-from typing import List, TextIO, cast, Optional
+from functools import lru_cache
 
-from .core import Chunk, CodeChunk, DocChunk
+from typing import (Any, Iterable, Iterator, List, NamedTuple, TextIO, Tuple,
+                    cast, Optional)
+
+from .core import Chunk, ChunkTable, CodeChunk, DocChunk, LazyCodeChunk, LazyDocChunk
+from .options import BlockOptions, EMPTY_OPTIONS, parse_options
 
 def _read_filepath(source: str) -> str:
   """
@@ -24,6 +30,63 @@ def _read_file(infile: TextIO) -> str:
   """
   return infile.read()
 
+def _iter_file_lines(infile: TextIO) -> Iterator[str]:
+  """
+  Read file contents line by line, yielding lines split
+  the same way ``str.splitlines(keepends=True)`` would split the
+  whole contents.
+
+  (A file may yield lines containing other line boundaries
+  recognized by ``splitlines``, such as form feeds; and a line
+  ending in a carriage return might be followed by a
+  line starting with a newline, which should be joined to it.)
+  """
+
+  pending = ""
+  for raw_line in infile:
+    if pending:
+      raw_line = pending + raw_line
+      pending = ""
+    lines = raw_line.splitlines(keepends=True)
+    if lines[-1].endswith("\r"):
+      pending = lines.pop()
+    yield from lines
+  if pending:
+    yield pending
+
+def _map_file(path: str):
+  """
+  Memory-map the file at ``path`` read-only (or, since empty files can't
+  be mapped, return an empty bytes object).
+  """
+
+  with open(path, "rb") as infile:
+    try:
+      return mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+      # empty file
+      return b""
+
+# line endings in binary mode, as per the CommonMark spec
+_line_end_re = re.compile(rb"\r\n?|\n")
+
+# ASCII characters for which str.isspace() is true
+_ascii_space_re = re.compile(rb"[ \t\n\r\x0b\x0c\x1c-\x1f]*")
+
+def _is_blank_span(buffer, start: int, end: int) -> bool:
+  """
+  Whether ``buffer[start:end]`` decodes to a string
+  containing only whitespace. Only decodes if non-ASCII bytes are
+  found before any non-space character.
+  """
+
+  pos = _ascii_space_re.match(buffer, start, end).end()
+  if pos == end:
+    return True
+  if buffer[pos] < 0x80:
+    return False
+  return str(buffer[start:end], "utf-8").strip() == ""
+
 
 class Parser:
   """
@@ -54,17 +117,19 @@ class Parser:
 
   where dot gives a class and the ``=`` gives attributes.
 
-  The Parser doesn't parse or process options at all, but just stores
-  the whole unparsed start-of-block line in the
+  The Parser stores the whole unparsed start-of-block line in the
   ``block_start_line`` attribute
-  of the :class:`CodeChunk <pytwine.core.CodeChunk>`;
-  it's up to Processor classes to parse and potentially
-  make use of the options.
+  of the :class:`CodeChunk <pytwine.core.CodeChunk>`, and the parsed
+  options (see :mod:`pytwine.options`) in its ``options`` attribute;
+  it's up to Processor classes to make use of them. Options are
+  parsed once per distinct start line, and chunks with identical
+  start lines share a single, immutable options object.
 
   Only subclass so far is :class:`MarkdownParser`.
 
   Subclasses should override :meth:`_is_codeblock_start` and
-  :meth:`_is_codeblock_end` (see the code for details).
+  :meth:`_is_codeblock_end`, and may override
+  :meth:`_codeblock_options` (see the code for details).
 
   **sample usage:**
 
@@ -80,26 +145,49 @@ class Parser:
   # "doc" (i.e. in markdown bits)
   # and "code" (i.e. in code blocks)
 
-  def __init__(self, file :TextIO =None, string :str =None):
+  def __init__(self, file :TextIO =None, string :str =None,
+               path :str =None, buffer :Any =None):
     """
     Keyword arguments:
-        file: path to a file to be processed
+        file: a file-like object to be processed
         string: a string to be processed
-
-    One of either ``file`` or ``string`` must be given.
-
+        path: path to a UTF-8 encoded file to be memory-mapped
+          and processed
+        buffer: a bytes-like object (e.g. ``bytes``, ``bytearray``,
+          ``memoryview`` or ``mmap``) holding a UTF-8 encoded
+          document to be processed
+
+    One of either ``file``, ``string``, ``path`` or ``buffer`` must be
+    given.
+
+    A ``file`` is not read when the parser is constructed, but
+    line by line as chunks are requested -- so it can
+    only be parsed once.
+
+    A file given by ``path`` is memory-mapped, and the chunks
+    produced are :class:`LazyDocChunk <pytwine.core.LazyDocChunk>`\\ s
+    and :class:`LazyCodeChunk <pytwine.core.LazyCodeChunk>`\\ s, whose
+    contents refer to spans of the mapped file and are only
+    decoded when read. In this mode, line endings are kept as they
+    are in the file, and only ``\\n``, ``\\r\\n`` and ``\\r`` end lines.
+    A ``buffer`` is parsed the same way.
     """
 
     self.source = file
+    self.rawtext : Optional[str] = None
+    self._buffer : Any = None
 
-    # Get input from string or
+    # Get input from string or file
     if self.source is not None:
       self.source = cast(TextIO, self.source)
-      self.rawtext = _read_file(self.source)
     elif string is not None:
       self.rawtext = string
+    elif path is not None:
+      self._buffer = _map_file(path)
+    elif buffer is not None:
+      self._buffer = buffer
     else:
-      raise KeyError("string or file must be specified")
+      raise KeyError("string, file, path or buffer must be specified")
     self.state = "doc"  # Initial state of document
 
     # stores start of code block, so that (a) we know
@@ -119,111 +207,336 @@ class Parser:
     """
     raise NotImplementedError('_is_codeblock_end not implemented')
 
-  def parse(self) -> List[Chunk] :
-    r"""
-    Parse the source and return a list of
-    :class:`Chunk <pytwine.core.Chunk>`\ s.
+  def _codeblock_options(self, line : str) -> BlockOptions:
+    """
+    Return the parsed options of a code block starting with ``line``.
+    By default, blocks have no options.
+    """
+    # pylint: disable=unused-argument
+    return EMPTY_OPTIONS
+
+  def _may_be_border(self, buffer, start : int, end : int) -> bool:
+    """
+    When parsing a binary buffer: returns False if the line
+    ``buffer[start:end]`` definitely can't start or end a code block,
+    in which case it won't be decoded. (Subclasses can override this
+    to avoid decoding most lines.)
     """
+    # pylint: disable=unused-argument
 
-    lines : List[str] = self.rawtext.splitlines(keepends=True)
+    return True
+
+  def _iter_lines(self) -> Iterator[str]:
+    """
+    Iterate over the lines of the source (with line endings
+    kept), split exactly as ``str.splitlines`` would split
+    the whole text.
+    """
+
+    if self.rawtext is not None:
+      return iter(self.rawtext.splitlines(keepends=True))
+    return _iter_file_lines(cast(TextIO, self.source))
+
+  def make_chunk(self, chunkType : str, lines : List[str],
+                  number : int, startLineNum : int) -> Optional[Chunk]:
+    """
+    helper func: build a chunk out of accumulated ``lines``.
+    Returns None for empty chunks or whitespace-only code
+    chunks, which are skipped.
+    """
+    assert chunkType in ["doc", "code"]
+
+    contents = "".join(lines)
+
+    if chunkType == "doc":
+      if contents == "":
+        return None
+      return DocChunk(contents=contents, number=number,
+                      startLineNum=startLineNum)
+
+    if contents.strip() == "":
+      return None
+    return CodeChunk(contents=contents, number=number,
+                     startLineNum=startLineNum,
+                     block_start_line=self.block_start_line,
+                     block_end_line=self.block_end_line,
+                     options=self._codeblock_options(
+                       cast(str, self.block_start_line)))
+
+  def scan_lines(self, lines : Iterable[str], firstLineNo : int = 1,
+                  docN : int = 1, codeN : int = 1) -> Iterator[Chunk]:
+    """
+    The parsing state machine: yield chunks from ``lines``, the
+    first of which is line number ``firstLineNo`` of the document
+    and is encountered in "doc" state. ``docN`` and ``codeN``
+    are the numbers to give the first doc and code chunks
+    found.
+    """
 
     # we accumulate a chunk of lines in currentChunk
     # (then join them back together once the chunk is done)
-    currentChunk  : List[str]   = []
-    chunks        : List[Chunk] = []
-
-    # keep track of how many code and non-code chunks
-    # we've seen
-    codeN : int = 1
-    docN  : int = 1
+    currentChunk : List[str] = []
+    chunk : Optional[Chunk]
 
-    # stores start of code block, so that (a) we know
-    # about block_start_line, and (b) we can match end.
+    self.state = "doc"
     self.block_start_line = None
     self.block_end_line   = None
 
-    lineNo : int = 0
-    chunk_start_line : int = 1
+    chunk_start_line : int = firstLineNo
 
-    # set to True when we hit a code-block start line or end line
-    # (```) -- we exclude that line from the block and take
-    # only the contents.
-    onBlockBorder : bool = False
-
-    def add_chunk(chunkType) -> bool:
-      """
-      helper func: add current chunk to chunks.
-      don't add empty chunks or whitespace-only code
-      chunks.
-
-      returns: whether a chunk was added
-      """
-      assert chunkType in ["doc", "code"]
-
-      contents = "".join(currentChunk)
-      if chunkType == "doc":
-        number = docN
-        clazz : type = DocChunk
-      elif chunkType == "code":
-        number = codeN
-        clazz = CodeChunk
-
-      # Don't parse empty chunks, or whitespace-only code chunks
-      if (chunkType == "code" and contents.strip() != "") or \
-         (chunkType == "doc" and contents != ""):
-        keywords = dict(chunkType=chunkType,
-                        contents=contents,
-                        number=number,
-                        startLineNum=chunk_start_line)
-        if chunkType == "code":
-          keywords["block_start_line"] = self.block_start_line
-          keywords["block_end_line"]   = self.block_end_line
-
-        chunks.append( clazz(**keywords) )
-        return True
-      return False
-
-    # we want lineNos from 1, not 0
-    bumpFst = lambda x : (x[0] + 1, x[1])
-
-    for lineNo, line in map(bumpFst, enumerate(lines)):
+    # code-block start and end lines are excluded from the
+    # block; we take only the contents.
+    for lineNo, line in enumerate(lines, firstLineNo):
 
       if self.state != "code" and self._is_codeblock_start(line):
         self.state = "code"
         self.block_start_line = line
 
-        # we've finished a doc chunk, append it
-        if add_chunk("doc"):
-          docN += 1
+        # we've finished a doc chunk
+        chunk = self.make_chunk("doc", currentChunk, docN, chunk_start_line)
         currentChunk = []
         chunk_start_line = lineNo
-        onBlockBorder = True
+        if chunk is not None:
+          docN += 1
+          yield chunk
       elif self.state == "code" and self._is_codeblock_end(line):
         self.state = "doc"
-        # we've finished a code chunk, append it
+        # we've finished a code chunk
         self.block_end_line = line
-        if add_chunk("code"):
-          codeN += 1
+        chunk = self.make_chunk("code", currentChunk, codeN, chunk_start_line)
         self.block_end_line = None
         currentChunk = []
         chunk_start_line = lineNo + 1
-        onBlockBorder = True
-
-      # add line to chunk (but not lines that are boundaries
-      # of code blocks)
-      if not onBlockBorder:
+        if chunk is not None:
+          codeN += 1
+          yield chunk
+      else:
         currentChunk.append(line)
-      onBlockBorder = False
 
     # end of for line in lines
     # Handle the last chunk
     if self.state == "code":
       self.block_end_line = ""
-      add_chunk("code")
-    elif self.state == "doc":
-      add_chunk("doc")
+      chunk = self.make_chunk("code", currentChunk, codeN, chunk_start_line)
+    else:
+      chunk = self.make_chunk("doc", currentChunk, docN, chunk_start_line)
+    if chunk is not None:
+      yield chunk
 
-    return chunks
+  def _make_span_chunk(self, chunkType : str, start : int, end : int,
+                       number : int, startLineNum : int) -> Optional[Chunk]:
+    """
+    As for :meth:`make_chunk`, but for chunks whose contents are
+    the span ``start:end`` of our buffer.
+    """
+
+    if chunkType == "doc":
+      if start == end:
+        return None
+      return LazyDocChunk(self._buffer, start, end, number=number,
+                          startLineNum=startLineNum)
+
+    if _is_blank_span(self._buffer, start, end):
+      return None
+    return LazyCodeChunk(self._buffer, start, end, number=number,
+                         startLineNum=startLineNum,
+                         block_start_line=self.block_start_line,
+                         block_end_line=self.block_end_line,
+                         options=self._codeblock_options(
+                           cast(str, self.block_start_line)))
+
+  def _iter_line_ends(self) -> Iterator[int]:
+    """
+    Iterate over the offsets in our buffer at which each line ends
+    (after its line ending, if any).
+    """
+
+    end = 0
+    for match in _line_end_re.finditer(self._buffer):
+      end = match.end()
+      yield end
+    if end < len(self._buffer):
+      yield len(self._buffer)
+
+  def _scan_spans(self) -> Iterator[Chunk]:
+    """
+    The parsing state machine as for :meth:`scan_lines`, but run over
+    the lines of our binary buffer, producing lazy chunks. Lines are
+    only decoded if they might be code block borders.
+    """
+
+    buffer = self._buffer
+    chunk : Optional[Chunk]
+    docN  : int = 1
+    codeN : int = 1
+
+    self.state = "doc"
+    self.block_start_line = None
+    self.block_end_line   = None
+
+    chunk_start      : int = 0
+    chunk_start_line : int = 1
+    line_start       : int = 0
+
+    for lineNo, line_end in enumerate(self._iter_line_ends(), 1):
+      if self._may_be_border(buffer, line_start, line_end):
+        line = str(buffer[line_start:line_end], "utf-8")
+
+        if self.state != "code" and self._is_codeblock_start(line):
+          self.state = "code"
+          self.block_start_line = line
+
+          chunk = self._make_span_chunk("doc", chunk_start, line_start,
+                                        docN, chunk_start_line)
+          chunk_start = line_end
+          chunk_start_line = lineNo
+          if chunk is not None:
+            docN += 1
+            yield chunk
+        elif self.state == "code" and self._is_codeblock_end(line):
+          self.state = "doc"
+          self.block_end_line = line
+          chunk = self._make_span_chunk("code", chunk_start, line_start,
+                                        codeN, chunk_start_line)
+          self.block_end_line = None
+          chunk_start = line_end
+          chunk_start_line = lineNo + 1
+          if chunk is not None:
+            codeN += 1
+            yield chunk
+      line_start = line_end
+
+    # Handle the last chunk
+    if self.state == "code":
+      self.block_end_line = ""
+      chunk = self._make_span_chunk("code", chunk_start, len(buffer),
+                                    codeN, chunk_start_line)
+    else:
+      chunk = self._make_span_chunk("doc", chunk_start, len(buffer),
+                                    docN, chunk_start_line)
+    if chunk is not None:
+      yield chunk
+
+  def iter_chunks(self) -> Iterator[Chunk]:
+    r"""
+    Parse the source, yielding
+    :class:`Chunk <pytwine.core.Chunk>`\ s one at a time.
+
+    A file source is read line by line, and each chunk
+    is yielded as soon as it ends, so only one chunk's worth of
+    lines is held in memory at a time.
+
+    >>> parser = MarkdownParser(string="foo\n```python\nprint()\n```\n")
+    >>> chunks = parser.iter_chunks()
+    >>> next(chunks)
+    DocChunk(chunkType='doc', contents='foo\n', number=1, startLineNum=1)
+    """
+
+    if self._buffer is not None:
+      yield from self._scan_spans()
+    else:
+      yield from self.scan_lines(self._iter_lines())
+
+  def parse(self) -> List[Chunk] :
+    r"""
+    Parse the source and return a list of
+    :class:`Chunk <pytwine.core.Chunk>`\ s.
+    """
+
+    return list(self.iter_chunks())
+
+  def parse_table(self) -> ChunkTable :
+    r"""
+    Parse the source and return a compact
+    :class:`ChunkTable <pytwine.core.ChunkTable>` of its chunks.
+    """
+
+    return ChunkTable(self.iter_chunks())
+
+
+class FenceScanner:
+  """
+  Recognizes the start and end lines of markdown fenced code blocks.
+
+  :meth:`match_start` gives the same result as matching
+  :attr:`MarkdownParser.codeblock_begin` against a line, but runs in
+  time linear in the length of the line: the pattern's lazy
+  ``(.*?)(?:\\}|\\s*)$`` tail can backtrack quadratically on long lines
+  containing runs of whitespace, so it is replaced by a precompiled
+  prefix pattern plus a direct computation of the options group.
+
+  >>> scanner = FenceScanner()
+  >>> scanner.match_start("~~~~ .python foo=bar }\\n")
+  ('~~~~', 'foo=bar ')
+  >>> scanner.match_start("  ```python\\n") is None
+  True
+  """
+
+  # fence, optional whitespace, optional dot, "python", optional
+  # separator and whitespace. No two adjacent parts can match the
+  # same character, so matching never backtracks.
+  _start_prefix = re.compile(r"([`~]{3,})\s*\.?python[;,]?\s*")
+
+  def match_start(self, line : str) -> Optional[Tuple[str, str]]:
+    """
+    If ``line`` starts a code block, return a pair
+    ``(fence, options)`` (the two groups
+    of :attr:`MarkdownParser.codeblock_begin`); otherwise None.
+    """
+
+    if not line.startswith(("`", "~")):
+      return None
+    match = self._start_prefix.match(line)
+    if match is None:
+      return None
+
+    # the options are the shortest prefix of the rest of the
+    # line which is followed either by a closing brace (at the end
+    # of the line, or before a final newline) or by nothing but
+    # whitespace. They can't contain a newline.
+    rest = line[match.end():]
+    opts_end = len(rest.rstrip())
+    if rest.endswith("}"):
+      opts_end = min(opts_end, len(rest) - 1)
+    elif rest.endswith("}\n"):
+      opts_end = min(opts_end, len(rest) - 2)
+    if "\n" in rest[:opts_end]:
+      return None
+    return match.group(1), rest[:opts_end]
+
+  @staticmethod
+  def is_end(line : str, fence : str) -> bool:
+    """
+    Whether ``line`` closes a code block opened with ``fence``.
+    """
+
+    return line.strip() == fence
+
+
+_start_line_scanner = FenceScanner()
+
+# see tests/test_parser.py/test_tildes_can_start_block
+# two groups: the fence start (e.g. ``` or ```` or ~~~~)
+#   and the stuff that comes after "python"
+_DEFAULT_CODEBLOCK_BEGIN = r"^([`~]{3,})\s*(?:|\.|)python(?:;|,|)\s*(.*?)(?:\}|\s*)$"
+
+# for buffers with no .find() method
+_border_char_re = re.compile(rb"[`~]")
+
+@lru_cache(maxsize=4096)
+def start_line_options(line : str) -> BlockOptions:
+  """
+  The parsed options of a markdown code block starting with ``line``
+  (memoized, so identical lines give the same object).
+
+  >>> start_line_options("```python .important startLine=101\\n")
+  BlockOptions(classes=('important',), id=None, attributes={'startLine': '101'})
+  """
+
+  match = _start_line_scanner.match_start(line)
+  if match is None:
+    return EMPTY_OPTIONS
+  return parse_options(match[1])
 
 
 class MarkdownParser(Parser):
@@ -254,21 +567,68 @@ class MarkdownParser(Parser):
   outputting indented content which will be inside a list or block
   quote.)
 
+  Code block start lines are matched by the regular expression
+  ``codeblock_begin``, whose two groups are the fence and the
+  options. With the default pattern, an equivalent linear-time
+  :class:`FenceScanner` is used instead; a subclass or instance
+  setting ``codeblock_begin`` to another pattern gets it matched with
+  :mod:`re`.
+
   """
 
-  def __init__(self, file=None, string=None):
-    Parser.__init__(self, file, string)
+  def __init__(self, file=None, string=None, path=None, buffer=None):
+    Parser.__init__(self, file, string, path, buffer)
+
+    self.codeblock_begin = _DEFAULT_CODEBLOCK_BEGIN
+
+    self._scanner = FenceScanner()
+
+    # the fence of the current code block, remembered when the
+    # block opens (and keyed by its start line).
+    self._fence_line : Optional[str] = None
+    self._fence      : Optional[str] = None
 
-    # see tests/test_parser.py/test_tildes_can_start_block
-    # two groups: the fence start (e.g. ``` or ```` or ~~~~)
-    #   and the stuff that comes after "python"
-    self.codeblock_begin = r"^([`~]{3,})\s*(?:|\.|)python(?:;|,|)\s*(.*?)(?:\}|\s*)$"
+  def _match_start(self, line : str) -> Optional[Tuple[str, str]]:
+    """ the two groups of ``codeblock_begin``, if ``line`` matches it """
+
+    # (an identity check: this is called for every line)
+    if self.codeblock_begin is _DEFAULT_CODEBLOCK_BEGIN:
+      return self._scanner.match_start(line)
+    match = re.match(self.codeblock_begin, line)
+    if match is None:
+      return None
+    fence_chars, options = match.groups()
+    return fence_chars, options
 
   def _is_codeblock_start(self, line):
     """ returns a boolean-ish result when a line matches
     ``codeblock_begin`` pattern
     """
-    return re.match(self.codeblock_begin, line)
+    if self.codeblock_begin is _DEFAULT_CODEBLOCK_BEGIN:
+      return self._scanner.match_start(line)
+    return self._match_start(line)
+
+  def _codeblock_options(self, line):
+    """ options are parsed from the second group of
+    ``codeblock_begin``
+    """
+    if self.codeblock_begin is _DEFAULT_CODEBLOCK_BEGIN:
+      return start_line_options(line)
+    match = self._match_start(line)
+    return parse_options(match[1]) if match is not None else EMPTY_OPTIONS
+
+  def _may_be_border(self, buffer, start, end):
+    """ fence lines must contain a backtick or tilde (at least, with
+    the default ``codeblock_begin``) """
+
+    if self.codeblock_begin is not _DEFAULT_CODEBLOCK_BEGIN:
+      return True
+    try:
+      return buffer.find(b"`", start, end) >= 0 or \
+             buffer.find(b"~", start, end) >= 0
+    except AttributeError:
+      # e.g. a memoryview
+      return _border_char_re.search(buffer, start, end) is not None
 
   def _is_codeblock_end(self, line):
     """ returns a boolean-ish result when a line is
@@ -281,9 +641,217 @@ class MarkdownParser(Parser):
 
     # find out how the block started (three backticks? four tildes):
     # that's how it must end.
-    regex_result = re.match(self.codeblock_begin, self.block_start_line)
-    fence_chars, _ = regex_result.groups()
+    if self._fence_line is not self.block_start_line:
+      match = self._match_start(self.block_start_line)
+      assert match is not None
+      self._fence_line = self.block_start_line
+      self._fence = match[0]
+
+    return self._scanner.is_end(line, cast(str, self._fence))
+
+
+def _line_count(chunk : Chunk) -> int:
+  """number of document lines a chunk occupies, including any
+  code block start and end lines"""
+
+  count = len(chunk.contents.splitlines())
+  if chunk.chunkType == "code":
+    count += 1
+    if cast(CodeChunk, chunk).block_end_line:
+      count += 1
+  return count
+
+def _same_content(chunk : Chunk, other : Chunk) -> bool:
+  """whether two chunks are the same, apart from their numbers and
+  start lines"""
+
+  if chunk.chunkType != other.chunkType or chunk.contents != other.contents:
+    return False
+  if chunk.chunkType == "code":
+    chunk, other = cast(CodeChunk, chunk), cast(CodeChunk, other)
+    return chunk.block_start_line == other.block_start_line and \
+           chunk.block_end_line == other.block_end_line
+  return True
+
+def _renumbered(chunk : Chunk, number : int, startLineNum : int) -> Chunk:
+  """``chunk`` with a new number and start line (the same object,
+  if those are unchanged)"""
+
+  if chunk.number == number and chunk.startLineNum == startLineNum:
+    return chunk
+  if chunk.chunkType == "code":
+    code_chunk = cast(CodeChunk, chunk)
+    return CodeChunk(contents=chunk.contents, number=number,
+                     startLineNum=startLineNum,
+                     block_start_line=code_chunk.block_start_line,
+                     block_end_line=code_chunk.block_end_line,
+                     options=code_chunk.options)
+  return DocChunk(contents=chunk.contents, number=number,
+                  startLineNum=startLineNum)
+
+
+class ReparseResult(NamedTuple):
+  """
+  Result of :meth:`IncrementalParser.edit`.
 
-    return line.strip() == fence_chars
+  Attributes:
+    chunks:  the document's updated list of chunks.
+    changed: indexes into ``chunks`` of chunks which are new,
+             or whose contents (or code block lines) differ
+             from any chunk before the edit.
+  """
+
+  chunks:  List[Chunk]
+  changed: List[int]
 
 
+class IncrementalParser:
+  """
+  Keeps the lines and chunks of a document, and updates the chunks
+  after an edit by re-parsing only the affected region.
+
+  Re-parsing starts at the start of the chunk containing the edit
+  (or the doc chunk before it, if the edit touches a code block's
+  start line), and stops at the first chunk boundary after the
+  edit at which the parse is back in step with the old one. Chunks
+  after that are renumbered if need be; chunks whose fields are
+  unchanged are reused as-is (so remain the same objects).
+
+  >>> inc = IncrementalParser("foo\\n```python\\nx = 1\\n```\\nbar\\n")
+  >>> first_chunk = inc.chunks[0]
+  >>> result = inc.edit(3, 3, "x = 2\\n")
+  >>> result.changed
+  [1]
+  >>> result.chunks[1].contents
+  'x = 2\\n'
+  >>> result.chunks[0] is first_chunk
+  True
+  """
+
+  def __init__(self, text : str, chunks : Optional[List[Chunk]] = None,
+               parser_class : type = None):
+    """
+    Arguments:
+      text: the document.
+      chunks: the result of parsing ``text``, if already available.
+      parser_class: the :class:`Parser` subclass to use
+        (default :class:`MarkdownParser`).
+    """
+
+    if parser_class is None:
+      parser_class = MarkdownParser
+    self._parser : Parser = parser_class(string=text)
+    self.lines : List[str] = text.splitlines(keepends=True)
+    if chunks is None:
+      chunks = list(self._parser.scan_lines(self.lines))
+    self.chunks : List[Chunk] = chunks
+
+  @property
+  def text(self) -> str:
+    """the current text of the document"""
+    return "".join(self.lines)
+
+  def edit(self, first_line : int, last_line : int,
+           replacement : str) -> ReparseResult:
+    """
+    Replace lines ``first_line`` to ``last_line`` (inclusive, and
+    counting from 1) with ``replacement``, and update
+    :attr:`chunks`.
+
+    To insert text before line ``n`` without replacing anything,
+    use a ``last_line`` of ``n - 1``.
+    """
+    # pylint: disable=too-many-locals
+
+    lines, chunks = self.lines, self.chunks
+    if not (1 <= first_line <= len(lines) + 1 and
+            first_line - 1 <= last_line <= len(lines)):
+      raise ValueError(f"bad line range {first_line}-{last_line}")
+
+    # Replace the lines, re-splitting them along with the lines either
+    # side, in case line endings get joined (e.g. "\r" + "\n").
+    lo, hi = first_line - 1, last_line
+    text = replacement
+    if lo > 0:
+      lo -= 1
+      text = lines[lo] + text
+    if hi < len(lines):
+      text += lines[hi]
+      hi += 1
+    new_lines = text.splitlines(keepends=True)
+    delta = len(new_lines) - (hi - lo)
+    lines[lo:hi] = new_lines
+    edit_first, edit_last = lo + 1, lo + len(new_lines)
+
+    # where to restart parsing: the chunk containing the edit; or
+    # if the edit touches a code block's start line, the doc chunk
+    # before that (which might now continue on).
+    starts = [chunk.startLineNum for chunk in chunks]
+    restart = max(bisect.bisect_right(starts, edit_first) - 1, 0)
+    if restart > 0 and chunks[restart].chunkType == "code" and \
+        chunks[restart].startLineNum == edit_first and \
+        chunks[restart - 1].chunkType == "doc":
+      restart -= 1
+    restart_line = chunks[restart].startLineNum if chunks else 1
+    if restart_line > edit_first:
+      restart_line = 1
+
+    docN  = 1 + sum(1 for chunk in chunks[:restart] if chunk.chunkType == "doc")
+    codeN = 1 + restart - (docN - 1)
+
+    region : List[Chunk] = []
+    resume = len(chunks)
+    scan = self._parser.scan_lines(
+        (lines[i] for i in range(restart_line - 1, len(lines))),
+        restart_line, docN, codeN)
+    for chunk in scan:
+      region.append(chunk)
+
+      # the line after this chunk, and whether old chunks
+      # starting there can be reused (see class doc)
+      next_line = chunk.startLineNum + _line_count(chunk)
+      if chunk.chunkType == "code":
+        if not cast(CodeChunk, chunk).block_end_line:
+          continue
+        any_type = True
+      else:
+        any_type = False
+      if next_line <= edit_last:
+        continue
+      old_idx = bisect.bisect_left(starts, next_line - delta)
+      if old_idx < len(chunks) and starts[old_idx] == next_line - delta and \
+          (any_type or chunks[old_idx].chunkType == "code"):
+        resume = old_idx
+        break
+
+    # reuse unchanged chunks at either end of the re-parsed region
+    old_region = chunks[restart:resume]
+    changed_flags = [True] * len(region)
+    prefix = 0
+    while prefix < min(len(region), len(old_region)) and \
+        _same_content(old_region[prefix], region[prefix]):
+      prefix += 1
+    suffix = 0
+    while suffix < min(len(region), len(old_region)) - prefix and \
+        _same_content(old_region[-1 - suffix], region[-1 - suffix]):
+      suffix += 1
+    for idx in list(range(prefix)) + \
+               list(range(len(region) - suffix, len(region))):
+      old_chunk = old_region[idx - len(region) + len(old_region)
+                             if idx >= prefix else idx]
+      changed_flags[idx] = False
+      region[idx] = _renumbered(old_chunk, region[idx].number,
+                                region[idx].startLineNum)
+
+    # renumber the rest
+    def count(chunk_list, chunkType):
+      return sum(1 for chunk in chunk_list if chunk.chunkType == chunkType)
+    shifts = {chunkType: count(region, chunkType) - count(old_region, chunkType)
+              for chunkType in ("doc", "code")}
+    tail = [_renumbered(chunk, chunk.number + shifts[chunk.chunkType],
+                        chunk.startLineNum + delta)
+            for chunk in chunks[resume:]]
+
+    self.chunks = chunks[:restart] + region + tail
+    changed = [restart + idx for idx, flag in enumerate(changed_flags) if flag]
+    return ReparseResult(self.chunks, changed)
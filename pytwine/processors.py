@@ -5,16 +5,32 @@ Classes that turn lists of
 documents.
 """
 
+import ast
+import cProfile
+import os
 import sys
 import textwrap as tw
+import time
 import traceback
 
-from typing import List, TextIO, cast, Dict, Any
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from types import CodeType
+
+from typing import (IO, Callable, Iterable, Iterator, List, NamedTuple,
+                    Optional, TextIO, Tuple, Union, cast, Dict, Any)
 
 # ?? use binary??
 from io import StringIO
 
-from .core import Chunk, CodeChunk, TwineExitStatus
+from .analysis import analyse_code, dependency_graph, read_before_bound
+from .caching import CheckpointStore, CodeCache, OutputCache
+from .capture import Route, SinkWriter, SpoolWriter, routed
+from .core import (Chunk, ChunkTable, CodeChunk, LazyContents, TwineExitStatus,
+                   is_binary_sink)
+from .events import BEGIN, COMPILE, DOCUMENT, END, EXEC, WRITE, EventHooks
+from .limits import ResourceLimitExceeded, ResourceLimits, describe_limit, enforce
+from .profiling import ProfileReport
 
 class AnnotatedCodeChunk(CodeChunk):
   """ just used for casting, so that mypy won't complain
@@ -32,16 +48,54 @@ class Processor:
 
   Attributes:
       _sink: subclasses should have an attribute ``_sink``,
-        a file-like that gets written to.
+        a file-like that gets written to. It may be a text
+        file, or a binary one (in which case output is written
+        UTF-8 encoded).
+      hooks: if not None, :mod:`events <pytwine.events>` are emitted
+        to it.
 
   """
 
-  _sink: TextIO
+  _sink: IO
+  hooks: Optional[EventHooks] = None
 
   def _write(self, s : str):
     """write ``s`` to our ``_sink`` with no newline"""
 
-    self._sink.write(s)
+    hooks = self.hooks
+    if hooks and s:
+      hooks.emit(WRITE, BEGIN, size=len(s))
+    if is_binary_sink(self._sink):
+      self._sink.write(s.encode("utf-8"))
+    else:
+      self._sink.write(s)
+    if hooks and s:
+      hooks.emit(WRITE, END)
+
+  def _flush_sink(self):
+    """flush our ``_sink``, if it can be flushed"""
+
+    flush = getattr(self._sink, "flush", None)
+    if flush is not None:
+      flush()
+
+  def _write_contents(self, chunk : Chunk):
+    """write the contents of ``chunk`` to our ``_sink``.
+
+    Contents of lazy chunks which haven't yet been decoded
+    are copied through without decoding where possible.
+    """
+
+    if isinstance(chunk, LazyContents):
+      hooks = self.hooks
+      if hooks:
+        start, end = chunk.span
+        hooks.emit(WRITE, BEGIN, size=end - start)
+      chunk.write_contents(self._sink)
+      if hooks:
+        hooks.emit(WRITE, END)
+    else:
+      self._write(chunk.contents)
 
 
 class IdentityProcessor(Processor):
@@ -49,29 +103,53 @@ class IdentityProcessor(Processor):
   The processor that tries to map every chunk back to itself.
   """
 
-  def __init__(self, sink: TextIO):
+  def __init__(self, sink: IO, hooks: Optional[EventHooks] = None):
     """
     Arguments:
-      sink: a file-like object to be written to.
+      sink: a (text or binary) file-like object to be written to.
+      hooks: if given, :data:`WRITE <pytwine.events.WRITE>` events
+        are emitted to it.
     """
 
     self._sink = sink
+    self.hooks = hooks
 
-  def twine(self, chunks : List[Chunk] ) -> None:
+  def twine(self, chunks : Union[Iterable[Chunk], ChunkTable] ) -> None:
     """THE TWINE FUNC - WORK IN PROGRESS"""
 
     for chunk in chunks:
 
       if chunk.chunkType == "doc":
-        self._write(chunk.contents)
+        self._write_contents(chunk)
       elif chunk.chunkType == "code":
         chunk = cast(AnnotatedCodeChunk, chunk)
         #chunk.wibble = True
         self._write(chunk.block_start_line)
-        self._write(chunk.contents)
+        self._write_contents(chunk)
         self._write(chunk.block_end_line)
 
 
+class _Lookahead:
+  """an iterator whose remaining items can be looked at without
+  consuming them (which reads them all)"""
+
+  def __init__(self, items : Iterable[Any]):
+    self._items = iter(items)
+
+  def __iter__(self) -> "_Lookahead":
+    return self
+
+  def __next__(self) -> Any:
+    return next(self._items)
+
+  def rest(self) -> List[Any]:
+    """the items not yet consumed"""
+
+    items = list(self._items)
+    self._items = iter(items)
+    return items
+
+
 def _get_traceback_text(exc_type, value, tb) -> str:
   """return the text that would be printed by
   traceback.print_exception.
@@ -82,40 +160,269 @@ def _get_traceback_text(exc_type, value, tb) -> str:
   return sio.getvalue()
 
 
+class ProcessorOptions(NamedTuple):
+  """
+  How a :class:`PythonProcessor` runs code chunks, and caches their
+  output. Some can't be combined (see :meth:`check`).
+  """
+
+  output_cache: Optional[OutputCache] = None
+  """if given, chunk outputs are stored in this cache, and the outputs
+  of an unchanged prefix of the document are replayed from it rather
+  than being executed (see :meth:`PythonProcessor.twine`)"""
+
+  checkpoint_store: Optional[CheckpointStore] = None
+  """if given (along with an ``output_cache``), the global namespace
+  is checkpointed into it after code blocks with the class
+  ``.checkpoint``, and after ``checkpoint_interval`` seconds of
+  execution (if given) since the last checkpoint. Checkpoints spare
+  re-running replayed chunks (see :meth:`PythonProcessor.twine`).
+  Globals which can't be pickled are left out of checkpoints (and
+  reported to the log)."""
+
+  checkpoint_interval: Optional[float] = None
+  "seconds of execution after which a checkpoint is taken"
+
+  chunk_jobs: int = 1
+  """if more than 1, code chunks which don't depend on one another
+  (as determined by :mod:`pytwine.analysis`) are run concurrently, in
+  up to this many threads (see :meth:`PythonProcessor.twine`)"""
+
+  stream_output: bool = False
+  """if true, what code chunks print is passed straight on to the
+  sink (which is then flushed), rather than being written once each
+  chunk finishes. Output is passed on once at least ``flush_size``
+  characters are pending (so with the default of 0, on every write),
+  or when flushed."""
+
+  flush_size: int = 0
+  "characters of streamed output to hold before passing them on"
+
+  code_cache: Optional[CodeCache] = None
+  """if given, compiled code chunks are stored in (and loaded from)
+  this cache, rather than being compiled afresh on every run"""
+
+  limits: ResourceLimits = ResourceLimits()
+  """limits on the resources the document's code chunks may use in
+  total (see :mod:`pytwine.limits`). Code blocks may also set their
+  own limits with block options. A chunk exceeding a limit is
+  aborted (keeping any output it has produced), and the exceeded
+  limit reported to the log."""
+
+  limit_policy: str = "continue"
+  """what to do after a chunk exceeds one of its own limits:
+  ``"continue"`` with the rest of the document, or ``"stop"``.
+  (Exceeding a limit on the whole document always stops.) Block
+  options setting limits are ignored if ``chunk_jobs`` is more
+  than 1."""
+
+  profile: Optional[ProfileReport] = None
+  """if given, a :class:`ChunkProfile <pytwine.profiling.ChunkProfile>`
+  of each code chunk executed is recorded in it, and a table of them
+  is written to the log at the end"""
+
+  cprofile: bool = False
+  """if true, every code chunk is run under :mod:`cProfile`
+  (otherwise, only those of code blocks with the class ``.cprofile``
+  are). Each profiled chunk's stats are written to a file
+  ``PREFIX.chunkN.pstats``, where ``N`` is the chunk number, and
+  ``PREFIX`` is ``pstats_prefix``."""
+
+  pstats_prefix: Optional[str] = None
+  """prefix of ``.pstats`` files -- by default, ``source_path``
+  without its extension (or ``pytwine``)"""
+
+  source_path: Optional[str] = None
+  """path of the document being processed. Profiled chunks are
+  compiled under this filename, with line numbers matching the
+  document's, so profiles point back into it."""
+
+  hooks: Optional[EventHooks] = None
+  """if given, :mod:`events <pytwine.events>` are emitted to it as the
+  document, and each code chunk's compilation and execution, begin
+  and end, and as output is written"""
+
+  spool_size: Optional[int] = None
+  """if given, each code chunk's output is held in memory only until
+  it comes to more than this many characters, and beyond that in a
+  temporary file, which is copied to the sink in blocks of
+  :attr:`PythonProcessor.SPOOL_BLOCK_SIZE` characters. (Output stored
+  in an ``output_cache`` is still read back whole.) Has no effect on
+  streamed output, or with ``chunk_jobs``."""
+
+  LIMIT_POLICIES = ("continue", "stop")
+  "possible values of ``limit_policy``"
+
+  def check(self) -> None:
+    """
+    raise a :class:`ValueError` if our options can't be combined
+
+    >>> ProcessorOptions(chunk_jobs=2, stream_output=True).check()
+    Traceback (most recent call last):
+    ...
+    ValueError: concurrent chunks can't be used with streamed output
+    """
+
+    if self.checkpoint_store is not None and self.output_cache is None:
+      raise ValueError("checkpoints can only be used with an output cache")
+    if self.limit_policy not in self.LIMIT_POLICIES:
+      raise ValueError(f"limit_policy must be one of {self.LIMIT_POLICIES}")
+    if self.chunk_jobs <= 1:
+      return
+    if self.output_cache is not None:
+      raise ValueError("concurrent chunks can't be used with an output cache")
+    if self.stream_output:
+      raise ValueError("concurrent chunks can't be used with streamed output")
+    if self.limits.any():
+      raise ValueError("concurrent chunks can't be used with resource limits")
+    if self.profile is not None:
+      raise ValueError("concurrent chunks can't be profiled")
+
+
 class PythonProcessor(Processor):
   """
   Processor that tries to run all code blocks as Python.
 
   Uncompileable code blocks just get omitted from the output.
 
+  What code blocks print is captured without reassigning
+  ``sys.stdout`` (see :mod:`pytwine.capture`), so processors can run
+  in several threads of a process at once.
+
   TODO: put an error into the output
   """
   # TODO: put an error into the output
 
-  def __init__(self, sink: TextIO, log: TextIO = sys.stderr):
+  CHECKPOINT_CLASS = "checkpoint"
+  "code blocks with this class are followed by a checkpoint"
+
+  CPROFILE_CLASS = "cprofile"
+  "code blocks with this class are run under :mod:`cProfile`"
+
+  SPOOL_BLOCK_SIZE = 64 * 1024
+  "characters of spooled output copied to the sink at a time"
+
+  def __init__(self, sink: IO, log: TextIO = sys.stderr,
+               options: Optional[ProcessorOptions] = None, **kwargs):
     """
     Arguments:
-      sink: a file-like object to be written to.
+      sink: a (text or binary) file-like object to be written to.
+      log: a file-like object progress and errors are reported to.
+      options: how code chunks are run, and their output cached (see
+        :class:`ProcessorOptions`).
+      kwargs: fields of :class:`ProcessorOptions`, overriding those
+        of ``options``.
     """
 
+    options = (options or ProcessorOptions())._replace(**kwargs)
+    if options.pstats_prefix is None:
+      options = options._replace(pstats_prefix=(
+        os.path.splitext(options.source_path)[0] if options.source_path
+        else "pytwine"))
+    options.check()
+
     self._sink = sink
     self.log = log
+    self.options = options
+    self.hooks = options.hooks
+    # where code chunks' output goes (see StdoutRouter)
+    self._route = Route()
     self.globals : Dict[Any,Any] = {}
     self.exceptions_encountered : List[Exception] = []
+    self.limits_exceeded : List[ResourceLimitExceeded] = []
+
+    # seconds spent executing since the last checkpoint
+    self._since_checkpoint = 0.0
+
+    # wall-clock and CPU times when we started twining
+    self._started : Optional[Tuple[float, float]] = None
+    # set once a limit is exceeded and we are to stop
+    self._stopped = False
 
 
   ######
   # TODO: make sure we store original filename
   # so can use in error mesgs
 
-  def _runcode(self, chunk : CodeChunk):
-    old_stdout = sys.stdout
+  COMPILE_FLAGS = 0
+  "flags code chunks are compiled with (see :func:`compile`)"
+
+  def _compile(self, chunk : CodeChunk) -> CodeType:
+    """compile ``chunk`` (using our code cache, if we have one)"""
+
+    if self.options.code_cache is not None:
+      return self.options.code_cache.compile(chunk.contents, '<string>',
+                                     self.COMPILE_FLAGS)
+    return compile(chunk.contents, '<string>', 'exec', self.COMPILE_FLAGS)
+
+  def _compile_in_place(self, chunk : CodeChunk) -> CodeType:
+    """compile ``chunk`` under our ``source_path``, with line numbers
+    as in the document"""
+
+    filename = self.options.source_path or '<string>'
+    tree = compile(chunk.contents, filename, 'exec',
+                   self.COMPILE_FLAGS | ast.PyCF_ONLY_AST)
+    # the code starts on the line after the block's start line
+    ast.increment_lineno(tree, chunk.startLineNum)
+    return compile(tree, filename, 'exec', self.COMPILE_FLAGS)
+
+  def _exec(self, code_obj : CodeType) -> None:
+    """execute ``code_obj`` in our globals"""
+
+    exec(code_obj, self.globals) # pylint: disable=exec-used
+
+  def _exec_profiled(self, chunk : CodeChunk, code_obj : CodeType) -> None:
+    """execute ``code_obj`` (compiled from ``chunk``) under
+    :mod:`cProfile`, and write out the stats"""
+
+    profiler = cProfile.Profile()
+    profiler.enable()
     try:
-      tmp_stdout = StringIO()
-      sys.stdout = tmp_stdout
-      code_obj = compile(chunk.contents, '<string>', 'exec')
-      exec(code_obj, self.globals)
-      sys.stdout = old_stdout
+      self._exec(code_obj)
+    finally:
+      profiler.disable()
+      path = f"{self.options.pstats_prefix}.chunk{chunk.number}.pstats"
+      profiler.dump_stats(path)
+      print(f"Wrote profile of chunk {chunk.number} to {path}", file=self.log)
+
+  def _execute(self, chunk : CodeChunk) -> None:
+    """compile and execute ``chunk`` in our globals (with output going
+    to our current capture target -- see :meth:`_capture`)"""
+
+    chunk_limits, document_limits = self._limits_for(chunk)
+    profile = self.options.profile
+    hooks = self.hooks
+    if profile is not None:
+      profile.begin_chunk()
+    cprofiled = self.options.cprofile or chunk.options.has_class(self.CPROFILE_CLASS)
+    try:
+      if hooks:
+        hooks.emit(COMPILE, BEGIN, chunk)
+      try:
+        if cprofiled:
+          code_obj = self._compile_in_place(chunk)
+        else:
+          code_obj = self._compile(chunk)
+      finally:
+        if hooks:
+          hooks.emit(COMPILE, END, chunk)
+      if profile is not None:
+        profile.compiled()
+      if hooks:
+        hooks.emit(EXEC, BEGIN, chunk)
+      try:
+        with enforce(chunk_limits.tightened(document_limits)):
+          if cprofiled:
+            self._exec_profiled(chunk, code_obj)
+          else:
+            self._exec(code_obj)
+      finally:
+        if profile is not None:
+          profile.end_chunk(chunk)
+        if hooks:
+          hooks.emit(EXEC, END, chunk)
+    except ResourceLimitExceeded as ex:
+      self._limit_exceeded(chunk, ex, chunk_limits, document_limits)
     except SyntaxError as ex:
       (exc_type, value, tb) = sys.exc_info()
       self.exceptions_encountered.append(ex)
@@ -135,12 +442,211 @@ class PythonProcessor(Processor):
 
     except KeyError as ex:
       print("exception occurred :/", ex)
+
+  def _limits_for(self, chunk : CodeChunk
+                 ) -> Tuple[ResourceLimits, ResourceLimits]:
+    """the limits set by ``chunk``'s options, and what is left of the
+    document's"""
+
+    if self.options.chunk_jobs > 1:
+      return ResourceLimits(), ResourceLimits()
+
+    try:
+      chunk_limits = ResourceLimits.from_options(chunk.options)
+    except ValueError as ex:
+      print(f"ignoring {ex} of code block no. {chunk.number}", file=self.log)
+      chunk_limits = ResourceLimits()
+
+    document_limits = self.options.limits
+    if self._started is not None:
+      wall_start, cpu_start = self._started
+      if document_limits.wall_time is not None:
+        document_limits = document_limits._replace(
+          wall_time=document_limits.wall_time - (time.perf_counter() - wall_start))
+      if document_limits.cpu_time is not None:
+        document_limits = document_limits._replace(
+          cpu_time=document_limits.cpu_time - (time.process_time() - cpu_start))
+    return chunk_limits, document_limits
+
+  def _limit_exceeded(self, chunk : CodeChunk, ex : ResourceLimitExceeded,
+                      chunk_limits : ResourceLimits,
+                      document_limits : ResourceLimits) -> None:
+    """report that ``chunk`` exceeded a limit, and decide whether to stop"""
+
+    self.limits_exceeded.append(ex)
+    own_limit = getattr(chunk_limits, ex.resource)
+    document_limit = getattr(document_limits, ex.resource)
+    whole_document = document_limit is not None and \
+                     (own_limit is None or document_limit < own_limit)
+    if whole_document or self.options.limit_policy == "stop":
+      self._stopped = True
+
+    if whole_document:
+      total = getattr(self.options.limits, ex.resource)
+      limit = f"the document's {describe_limit(ex.resource, total)}"
+    else:
+      limit = f"its {describe_limit(ex.resource, own_limit)}"
+    print(f"code block no. {chunk.number}, beginning at line",
+          f"{chunk.startLineNum} of input file, exceeded {limit},",
+          f"and was aborted{'; stopping' if self._stopped else ''}",
+          file=self.log)
+
+  def _num_failures(self) -> int:
+    """number of chunks that have failed so far"""
+
+    return len(self.exceptions_encountered) + len(self.limits_exceeded)
+
+  @contextmanager
+  def _capture(self, target : Any) -> Iterator[None]:
+    """send what code prints to ``target`` while in the ``with``
+    statement (``twine`` routes our code's output through
+    ``self._route``)"""
+
+    old_target = self._route.target
+    self._route.target = target
+    try:
+      yield
     finally:
-      sys.stdout = old_stdout
+      self._route.target = old_target
+
+  def _runcode(self, chunk : CodeChunk):
+    tmp_stdout = StringIO()
+    with self._capture(tmp_stdout):
+      self._execute(chunk)
+
+    return tmp_stdout.getvalue()
+
+  def _write_output(self, s : str) -> None:
+    """write output ``s`` of a code chunk to our sink (and record its
+    size in our profile, if we have one)"""
+
+    self._write(s)
+    if self.options.profile is not None:
+      self.options.profile.add_output(len(s.encode("utf-8", "surrogateescape")))
+
+  def _run_and_write(self, chunk : CodeChunk, keep : bool = False) -> str:
+    """
+    Run ``chunk`` and write its output to our sink (as it is
+    produced, if we're streaming output). Returns the output -- unless
+    we're streaming or spooling it, in which case it is only kept
+    (and returned) if ``keep`` is true.
+    """
+
+    if not self.options.stream_output and self.options.spool_size is not None:
+      return self._run_spooled(chunk, keep)
+    if not self.options.stream_output:
+      result = self._runcode(chunk)
+      self._write_output(result)
+      return result
+
+    # so readers see everything up to this chunk while it runs
+    self._flush_sink()
+    writer = SinkWriter(self._write_output, self._flush_sink,
+                        self.options.flush_size, keep)
+    try:
+      with self._capture(writer):
+        self._execute(chunk)
+    finally:
+      writer.flush()
+    return writer.getvalue()
+
+  def _run_spooled(self, chunk : CodeChunk, keep : bool = False) -> str:
+    """as for :meth:`_run_and_write`, capturing output with a
+    :class:`SpoolWriter <pytwine.capture.SpoolWriter>`"""
+
+    spool = SpoolWriter(cast(int, self.options.spool_size))
+    try:
+      with self._capture(spool):
+        self._execute(chunk)
+
+      kept : Optional[List[str]] = [] if keep else None
+      for block in spool.blocks(self.SPOOL_BLOCK_SIZE):
+        self._write_output(block)
+        if kept is not None:
+          kept.append(block)
+    finally:
+      spool.close()
+    return "".join(kept or [])
+
+  def _runcode_in_thread(self, chunk : CodeChunk) -> str:
+    """as for :meth:`_runcode`, in a worker thread (with a route of
+    its own)"""
 
+    tmp_stdout = StringIO()
+    with routed(Route(tmp_stdout)):
+      self._execute(chunk)
     return tmp_stdout.getvalue()
 
-  def twine(self, chunks : List[Chunk] ) -> TwineExitStatus:
+  def _catch_up(self, pending : List[Tuple[CodeChunk, str]],
+                upcoming : Callable[[], List[CodeChunk]]) -> None:
+    """
+    Bring our namespace up to date with ``pending`` chunks (and
+    their cache keys), whose outputs have already been written:
+    restore the latest checkpoint we can, and execute the chunks
+    after it, discarding their output.
+
+    A checkpoint that left out unpicklable globals is only restored
+    if neither the chunks after it, nor the ``upcoming`` ones (those
+    still to be executed, obtained only when needed), may use those
+    globals before binding them again.
+    """
+
+    if self.options.checkpoint_store is not None:
+      chunk_names = None
+      for idx in range(len(pending) - 1, -1, -1):
+        chunk, key = pending[idx]
+        restored = self.options.checkpoint_store.restore(key)
+        if restored is None:
+          continue
+        namespace, skipped = restored
+        if skipped:
+          if chunk_names is None:
+            later = [code for code, _ in pending] + upcoming()
+            chunk_names = [analyse_code(code.contents) for code in later]
+          needed = read_before_bound(chunk_names[idx + 1:], skipped)
+          if needed:
+            print("Not restoring checkpoint taken after chunk", chunk.number,
+                  "(later chunks use unpicklable globals:",
+                  ", ".join(sorted(needed)) + ")", file=self.log)
+            continue
+        self.globals.clear()
+        self.globals.update(namespace)
+        print("Restored checkpoint taken after chunk", chunk.number,
+              file=self.log)
+        if skipped:
+          print("  (without unpicklable globals:", ", ".join(skipped) + ")",
+                file=self.log)
+        pending = pending[idx + 1:]
+        break
+
+    if pending:
+      print("Re-running", len(pending), "cached chunks to rebuild namespace",
+            file=self.log)
+    for chunk, _ in pending:
+      self._runcode(chunk)
+
+  def _maybe_checkpoint(self, chunk : CodeChunk, key : str,
+                        elapsed : float) -> None:
+    """checkpoint our namespace after executing ``chunk`` (which took
+    ``elapsed`` seconds), if it is marked for it or enough time
+    has passed"""
+
+    store = self.options.checkpoint_store
+    if store is None:
+      return
+    self._since_checkpoint += elapsed
+    interval = self.options.checkpoint_interval
+    if not (chunk.options.has_class(self.CHECKPOINT_CLASS) or
+            (interval is not None and self._since_checkpoint >= interval)):
+      return
+
+    skipped = store.save(key, self.globals)
+    if skipped:
+      print(f"Checkpoint after chunk {chunk.number}: skipped unpicklable "
+            f"globals {', '.join(skipped)}", file=self.log)
+    self._since_checkpoint = 0.0
+
+  def twine(self, chunks : Union[Iterable[Chunk], ChunkTable] ) -> TwineExitStatus:
     """WORK IN PROGRESS - process chunks and write to sink.
 
     in case of errors, returns a :class:`TwineExitStatus`;
@@ -151,27 +657,181 @@ class PythonProcessor(Processor):
       - output is written to the ``sink`` arrgument
         passed to the constructor.
 
+    If we have an ``output_cache``, the outputs of code chunks are
+    looked up in it for as long as they are found, and written
+    without executing the chunks. At the first chunk not found, the
+    chunks skipped so far are executed (with their output
+    discarded) to rebuild the global namespace, and from then on
+    chunks are executed as usual, their outputs being stored.
+
+    If we also have a ``checkpoint_store``, the namespace is
+    restored from the latest checkpoint of the skipped chunks
+    (if any), and only the chunks after it are executed.
+
+    If ``chunk_jobs`` is more than 1, all the chunks are read first,
+    and each code chunk is started as soon as the chunks it depends on
+    have finished, in a pool of threads sharing our globals. Output
+    is still written in document order.
     """
 
-    for chunk in chunks:
+    hooks = self.hooks
+    with routed(self._route, document=True):
+      if not hooks:
+        return self._twine(chunks)
+      with hooks.span(DOCUMENT, path=self.options.source_path):
+        return self._twine(chunks)
+
+  def _twine(self, chunks : Union[Iterable[Chunk], ChunkTable] ) -> TwineExitStatus:
+    """:meth:`twine`, without the events around it"""
+
+    self._started = (time.perf_counter(), time.process_time())
+    if self.options.chunk_jobs > 1:
+      return self._twine_concurrently(chunks)
+
+    profile = self.options.profile
+    if profile is None:
+      return self._twine_sequentially(chunks)
+    profile.start()
+    try:
+      status = self._twine_sequentially(chunks)
+    finally:
+      profile.stop()
+    print("profile (slowest chunks first):\n" + profile.format_table(),
+          file=self.log)
+    return status
+
+  def _twine_sequentially(self, chunks : Union[Iterable[Chunk], ChunkTable]
+                         ) -> TwineExitStatus:
+    """:meth:`twine`, running code chunks one at a time"""
+
+    cache = self.options.output_cache
+    cache_key = cache.initial_key() if cache is not None else ""
+    replaying = cache is not None
+    # chunks replayed from the cache but not yet executed
+    pending : List[Tuple[CodeChunk, str]] = []
+    remaining = _Lookahead(chunks)
+
+    for chunk in remaining:
+      if self._stopped:
+        break
 
       if chunk.chunkType == "doc":
-        self._write(chunk.contents)
+        self._write_contents(chunk)
       elif chunk.chunkType == "code":
         chunk = cast(AnnotatedCodeChunk, chunk)
         print("Processing chunk", chunk.number, file=self.log)
-        result = self._runcode(chunk)
-        self._write(result)
+
+        if cache is None:
+          self._run_and_write(chunk)
+          continue
+
+        cache_key = cache.chain_key(cache_key, chunk)
+        if replaying:
+          cached = cache.get(cache_key)
+          if cached is not None:
+            pending.append((chunk, cache_key))
+            self._write(cached)
+            continue
+          replaying = False
+          self._catch_up(pending, lambda chunk=chunk: [chunk] + [
+            later for later in remaining.rest() if later.chunkType == "code"])
+
+        num_failures = self._num_failures()
+        start_time = time.perf_counter()
+        result = self._run_and_write(chunk, keep=True)
+        elapsed = time.perf_counter() - start_time
+        cache.misses += 1
+        if self._num_failures() == num_failures:
+          cache.put(cache_key, result)
+          self._maybe_checkpoint(chunk, cache_key, elapsed)
+
+    if cache is not None:
+      print(f"output cache: {cache.hits} hits, {cache.misses} misses, "
+            f"{cache.bytes_replayed} bytes replayed", file=self.log)
+
+    return self._exit_status()
+
+  def _twine_concurrently(self, chunks : Union[Iterable[Chunk], ChunkTable]
+                         ) -> TwineExitStatus:
+    """:meth:`twine`, running independent code chunks concurrently"""
+
+    items = list(chunks)
+    code_chunks = [cast(CodeChunk, chunk) for chunk in items
+                   if chunk.chunkType == "code"]
+    graph = dependency_graph([analyse_code(chunk.contents)
+                              for chunk in code_chunks])
+    successors : List[List[int]] = [[] for _ in code_chunks]
+    for idx, preds in enumerate(graph):
+      for pred in preds:
+        successors[pred].append(idx)
+    num_waiting = [len(preds) for preds in graph]
+
+    pool = ThreadPoolExecutor(max_workers=self.options.chunk_jobs)
+    futures : Dict[int, Future] = {}
+    indexes : Dict[Future, int] = {}
+    running = set()
+    finished = set()
+
+    def start(idx : int) -> None:
+      future = pool.submit(self._runcode_in_thread, code_chunks[idx])
+      futures[idx] = future
+      indexes[future] = idx
+      running.add(future)
+
+    def wait_for(idx : int) -> None:
+      while idx not in finished:
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+          running.discard(future)
+          done_idx = indexes[future]
+          finished.add(done_idx)
+          if future.exception() is not None:
+            # it will be raised when output reaches it
+            continue
+          for succ in successors[done_idx]:
+            num_waiting[succ] -= 1
+            if num_waiting[succ] == 0:
+              start(succ)
+
+    try:
+      for idx, waiting in enumerate(num_waiting):
+        if waiting == 0:
+          start(idx)
+
+      code_idx = 0
+      for chunk in items:
+        if chunk.chunkType == "doc":
+          self._write_contents(chunk)
+          continue
+        print("Processing chunk", chunk.number, file=self.log)
+        wait_for(code_idx)
+        self._write(futures[code_idx].result())
+        code_idx += 1
+    finally:
+      for future in running:
+        future.cancel()
+      pool.shutdown(wait=True)
+
+    return self._exit_status()
+
+  def _exit_status(self) -> TwineExitStatus:
+    """report any exceptions encountered, and return our exit status"""
 
     if self.exceptions_encountered:
       num_exceptions = len(self.exceptions_encountered)
       print("Encountered", num_exceptions,
             "exceptions while processing input file",
             file=self.log)
+    if self.limits_exceeded:
+      print(len(self.limits_exceeded), "code blocks exceeded resource limits",
+            file=self.log)
+      return TwineExitStatus.RESOURCE_LIMIT_EXCEEDED
+    if self.exceptions_encountered:
       return TwineExitStatus.BLOCK_COMPILATION_ERROR
 
     return TwineExitStatus.SUCCESS
 
+
 #class Twiner:
 #
 #  """
@@ -0,0 +1,183 @@
+"""
+Per-chunk profiles: how long each code chunk took to compile and run,
+how much output it produced, and how much memory it allocated.
+
+A :class:`ProfileReport` is passed to a :class:`PythonProcessor
+<pytwine.processors.PythonProcessor>` as its ``profile``, and records
+a :class:`ChunkProfile` for each code chunk executed. Memory is
+measured with :mod:`tracemalloc`, which is only running while a
+profiled document is being processed.
+"""
+
+import json
+import time
+import tracemalloc
+
+from typing import IO, Any, Dict, List, NamedTuple, Optional
+
+from .core import CodeChunk
+
+class ChunkProfile(NamedTuple):
+  """the profile of one code chunk's execution"""
+
+  number: int
+  "the chunk's number"
+
+  start_line: int
+  "line number the chunk starts at"
+
+  compile_seconds: float
+  "wall-clock time taken to compile the chunk"
+
+  wall_seconds: float
+  "wall-clock time taken to execute the chunk"
+
+  cpu_seconds: float
+  "CPU time taken to execute the chunk"
+
+  output_bytes: int
+  "size of the chunk's output (UTF-8 encoded)"
+
+  peak_bytes: Optional[int]
+  "peak memory allocated while the chunk was executed, beyond what was allocated before"
+
+  net_bytes: Optional[int]
+  "memory allocated (less memory freed) by the chunk"
+
+
+def _format_bytes(size : Optional[int]) -> str:
+  """
+  format a byte count compactly
+
+  >>> _format_bytes(1536), _format_bytes(-2 * 2**20), _format_bytes(None)
+  ('1.5K', '-2.0M', '-')
+  """
+
+  if size is None:
+    return "-"
+  for suffix, multiplier in (("G", 2**30), ("M", 2**20), ("K", 2**10)):
+    if abs(size) >= multiplier:
+      return f"{size / multiplier:.1f}{suffix}"
+  return str(size)
+
+
+class ProfileReport:
+  """
+  Collects a :class:`ChunkProfile` for each code chunk executed.
+
+  Attributes:
+    records: the profiles, in order of execution
+    trace_memory: whether memory use is measured
+
+  >>> from pytwine.core import CodeChunk
+  >>> report = ProfileReport()
+  >>> report.start()
+  >>> report.begin_chunk()
+  >>> report.compiled()
+  >>> data = list(range(10000))
+  >>> report.end_chunk(CodeChunk(contents="x\\n", number=1, startLineNum=3,
+  ...                             block_start_line="```python\\n",
+  ...                             block_end_line="```\\n"))
+  >>> report.add_output(6)
+  >>> report.stop()
+  >>> record = report.records[0]
+  >>> (record.number, record.start_line, record.output_bytes)
+  (1, 3, 6)
+  >>> record.net_bytes > 10000
+  True
+  """
+
+  def __init__(self, trace_memory : bool = True):
+    self.trace_memory = trace_memory
+    self.records : List[ChunkProfile] = []
+    self._started_tracing = False
+    self._chunk_start = (0.0, 0.0)
+    self._exec_start = (0.0, 0.0)
+    self._memory_start = 0
+
+  def start(self) -> None:
+    """start measuring memory (if we are to, and no one else is)"""
+
+    if self.trace_memory and not tracemalloc.is_tracing():
+      tracemalloc.start()
+      self._started_tracing = True
+
+  def stop(self) -> None:
+    """stop measuring memory, if we started to"""
+
+    if self._started_tracing:
+      tracemalloc.stop()
+      self._started_tracing = False
+
+  def begin_chunk(self) -> None:
+    """note that a chunk is about to be compiled"""
+
+    self._chunk_start = (time.perf_counter(), time.process_time())
+
+  def compiled(self) -> None:
+    """note that the chunk has been compiled, and is about to be executed"""
+
+    if tracemalloc.is_tracing():
+      # (reset_peak() is new in Python 3.9; before that, the peak
+      # includes anything allocated earlier)
+      reset_peak = getattr(tracemalloc, "reset_peak", None)
+      if reset_peak is not None:
+        reset_peak()
+      self._memory_start = tracemalloc.get_traced_memory()[0]
+    self._exec_start = (time.perf_counter(), time.process_time())
+
+  def end_chunk(self, chunk : CodeChunk) -> None:
+    """note that ``chunk`` has finished executing"""
+
+    wall_end, cpu_end = time.perf_counter(), time.process_time()
+    peak_bytes = net_bytes = None
+    if tracemalloc.is_tracing():
+      current, peak = tracemalloc.get_traced_memory()
+      peak_bytes = max(peak - self._memory_start, 0)
+      net_bytes = current - self._memory_start
+    self.records.append(ChunkProfile(
+      number=chunk.number, start_line=chunk.startLineNum,
+      compile_seconds=self._exec_start[0] - self._chunk_start[0],
+      wall_seconds=wall_end - self._exec_start[0],
+      cpu_seconds=cpu_end - self._exec_start[1],
+      output_bytes=0, peak_bytes=peak_bytes, net_bytes=net_bytes))
+
+  def add_output(self, size : int) -> None:
+    """add ``size`` bytes to the output of the latest chunk"""
+
+    if self.records:
+      last = self.records[-1]
+      self.records[-1] = last._replace(output_bytes=last.output_bytes + size)
+
+  def to_json(self) -> Dict[str, Any]:
+    """the report, as a JSON-serialisable dict"""
+
+    return {"chunks": [record._asdict() for record in self.records]}
+
+  def write_json(self, ofp : IO[str]) -> None:
+    """write the report to ``ofp`` as JSON"""
+
+    json.dump(self.to_json(), ofp, indent=2)
+    ofp.write("\n")
+
+  def format_table(self) -> str:
+    """
+    the report as a table, slowest chunks first
+
+    >>> report = ProfileReport(trace_memory=False)
+    >>> report.records.append(ChunkProfile(2, 10, 0.001, 1.5, 1.25, 2048, None, None))
+    >>> print(report.format_table())
+    chunk   line  compile     wall      cpu   output     peak      net
+        2     10   0.001s   1.500s   1.250s     2.0K        -        -
+    """
+
+    lines = [f"{'chunk':>5} {'line':>6} {'compile':>8} {'wall':>8} {'cpu':>8} "
+             f"{'output':>8} {'peak':>8} {'net':>8}"]
+    for record in sorted(self.records, key=lambda record: -record.wall_seconds):
+      lines.append(f"{record.number:>5} {record.start_line:>6} "
+                   f"{record.compile_seconds:>7.3f}s {record.wall_seconds:>7.3f}s "
+                   f"{record.cpu_seconds:>7.3f}s "
+                   f"{_format_bytes(record.output_bytes):>8} "
+                   f"{_format_bytes(record.peak_bytes):>8} "
+                   f"{_format_bytes(record.net_bytes):>8}")
+    return "\n".join(lines)
@@ -9,18 +9,20 @@ which add command-line argument parsing.
 
 import sys
 
-from typing import Optional, TextIO, cast
+from typing import IO, Any, Dict, List, Optional, cast
 from optparse import OptionParser
 
 import pytwine
+from .batch import DEFAULT_GLOB, batch_exit_status, batch_twine, find_documents
 from .cli   import cli_twine
 from .core  import TwineExitStatus
 
-def _open_or_fallback( file_path : Optional[str], mode: str, fallback: Optional[TextIO] ):
+def _open_or_fallback( file_path : Optional[str], mode: str, fallback: Optional[IO] ):
   """
   Arguments:
     file_path: a file path to open, or None to use the fallback.
-    mode: mode to open with (e.g. "w" or "r")
+    mode: mode to open with (e.g. "w" or "r"; text files
+      are UTF-8 encoded)
     fallback: what to use when file_path is None; when context
       finishes, this *won't* close.
   """
@@ -30,9 +32,29 @@ def _open_or_fallback( file_path : Optional[str], mode: str, fallback: Optional[
     return fallback
 
   # pylint: disable=consider-using-with
+  if "b" in mode:
+    return open(file_path, mode)
   return open(file_path, mode, encoding="utf8")
 
 
+def _batch_script(sources : List[str], output_dir : str,
+                  pattern : Optional[str], jobs : Optional[int],
+                  options_dict : Dict[str, Any]) -> None:
+  """
+  Implement the ``pytwine --output-dir`` batch mode: process
+  ``sources`` into ``output_dir``, and exit with the batch's exit status
+  (see :func:`pytwine.batch.batch_exit_status`).
+  """
+
+  documents = find_documents(sources, pattern or DEFAULT_GLOB)
+  try:
+    results = batch_twine(documents, output_dir, jobs, **options_dict)
+  except ValueError as ex:
+    print("pytwine:", ex, file=sys.stderr)
+    sys.exit(TwineExitStatus.BAD_SCRIPT_ARGS.value)
+  sys.exit(batch_exit_status(results).value)
+
+
 def pytwine_script() -> None:
   """
   Implement the ``pytwine`` script: parse command line options,
@@ -45,7 +67,9 @@ def pytwine_script() -> None:
   """
 
   # Command line options
-  parser = OptionParser(usage="pytwine [options] [sourcefile [outfile]]",
+  parser = OptionParser(usage="pytwine [options] [sourcefile [outfile]]\n"
+                              "       pytwine [options] --output-dir DIR "
+                              "source...",
                         version="pytwine " + pytwine.__version__)
 #    parser.add_option("-f", "--format", dest="doctype", default=None,
 #                      help="The output format. Available formats: " +
@@ -57,10 +81,160 @@ def pytwine_script() -> None:
                     help="Name of the output file. (Overrides any arguments)")
   parser.add_option("-d", "--debug", dest="debug", action="store_true",
                     help="print additional debugging information to standard error")
+  parser.add_option("--parse-cache", dest="parse_cache", default=None,
+                    metavar="DIR",
+                    help="cache parse results in directory DIR, and reuse "
+                         "them for unchanged documents")
+  parser.add_option("--output-cache", dest="output_cache", default=None,
+                    metavar="DIR",
+                    help="cache code block outputs in directory DIR, and "
+                         "replay them for an unchanged start of the document")
+  parser.add_option("--spool-size", dest="spool_size", default=None,
+                    metavar="SIZE",
+                    help="hold at most SIZE characters of a code block's "
+                         "output in memory (e.g. 16M), keeping the rest in "
+                         "a temporary file")
+  parser.add_option("--code-cache", dest="code_cache", default=None,
+                    metavar="DIR",
+                    help="cache compiled code blocks in directory DIR, so "
+                         "unchanged blocks aren't recompiled")
+  parser.add_option("--checkpoints", dest="checkpoints", default=None,
+                    metavar="DIR",
+                    help="checkpoint global variables in directory DIR after "
+                         "code blocks with class .checkpoint, so re-runs "
+                         "can resume from them (implies an output cache)")
+  parser.add_option("--checkpoint-interval", dest="checkpoint_interval",
+                    type="float", default=None, metavar="SECONDS",
+                    help="also checkpoint after every SECONDS of execution")
+  parser.add_option("--chunk-jobs", dest="chunk_jobs", type="int", default=1,
+                    metavar="N",
+                    help="run code blocks that don't depend on each other "
+                         "concurrently, in up to N threads")
+  parser.add_option("--stream", dest="stream", action="store_true",
+                    default=False,
+                    help="write code block output as it is produced, rather "
+                         "than when each block finishes")
+  parser.add_option("--flush-size", dest="flush_size", type="int", default=0,
+                    metavar="N",
+                    help="with --stream, pass output on once N characters "
+                         "are pending (default: 0, i.e. on every write)")
+  parser.add_option("--async", dest="use_async", action="store_true",
+                    default=False,
+                    help="run code blocks in an event loop, so they can "
+                         "use top-level await")
+  parser.add_option("--timeout", dest="timeout", type="float", default=None,
+                    metavar="SECONDS",
+                    help="abort code blocks once the document has run for "
+                         "SECONDS of wall-clock time")
+  parser.add_option("--cpu-timeout", dest="cpu_timeout", type="float",
+                    default=None, metavar="SECONDS",
+                    help="abort code blocks once the document has used "
+                         "SECONDS of CPU time")
+  parser.add_option("--memory-limit", dest="memory_limit", default=None,
+                    metavar="SIZE",
+                    help="abort code blocks that take the process's address "
+                         "space past SIZE bytes (e.g. 512M, 2G)")
+  parser.add_option("--on-limit", dest="on_limit", default="continue",
+                    type="choice", choices=["continue", "stop"],
+                    help="after a code block exceeds its own limits "
+                         "(set with block options timeout=, cpu-timeout= "
+                         "and memory-limit=), 'continue' (the default) or "
+                         "'stop'")
+  parser.add_option("--profile-report", dest="profile_report", default=None,
+                    metavar="FILE",
+                    help="write the time, output size and memory use of "
+                         "each code block to FILE, as JSON (and a table of "
+                         "them to standard error)")
+  parser.add_option("--cprofile", dest="cprofile", action="store_true",
+                    default=False,
+                    help="run every code block under cProfile, as if it had "
+                         "class .cprofile, writing stats to "
+                         "PREFIX.chunkN.pstats files")
+  parser.add_option("--pstats-prefix", dest="pstats_prefix", default=None,
+                    metavar="PREFIX",
+                    help="prefix for .pstats files (default: the source "
+                         "file's path, without its extension)")
+  parser.add_option("--trace", dest="trace", default=None, metavar="FILE",
+                    help="write a timeline of parsing, and of each code "
+                         "block's compilation, execution and output, to "
+                         "FILE, in Chrome trace format (viewable in "
+                         "Perfetto); with --output-dir, of every document")
+  parser.add_option("--binary", dest="binary", action="store_true",
+                    default=False,
+                    help="process the document as UTF-8 bytes, only decoding "
+                         "code blocks (line endings are preserved exactly)")
+
+  parser.add_option("--output-dir", dest="output_dir", default=None,
+                    metavar="DIR",
+                    help="process each source (a document, or a directory "
+                         "of them) into a .md file, with a .log file, in DIR")
+  parser.add_option("--glob", dest="glob", default=None, metavar="PATTERN",
+                    help="with --output-dir, process files in source "
+                         "directories matching PATTERN (default: *.pmd; "
+                         "may use **)")
+  parser.add_option("--jobs", dest="jobs", type="int", default=None,
+                    metavar="N",
+                    help="with --output-dir, process up to N documents at "
+                         "once (default: one per CPU)")
+
+  parser.add_option("--serve", dest="serve", default=None, metavar="SOCKET",
+                    help="run a server on Unix socket SOCKET, processing "
+                         "documents sent with --connect")
+  parser.add_option("--preload", dest="preload", default="",
+                    metavar="MODULES",
+                    help="with --serve, comma-separated modules to import "
+                         "at startup")
+  parser.add_option("--fork", dest="fork", action="store_true",
+                    default=False,
+                    help="with --serve, process each document in a child "
+                         "process forked from the server")
+  parser.add_option("--connect", dest="connect", default=None,
+                    metavar="SOCKET",
+                    help="process the document using the server on Unix "
+                         "socket SOCKET")
 
   (options, args) = parser.parse_args()
   options_dict = vars(options)
 
+  serve_path   = options_dict.pop("serve")
+  preload      = [name for name in options_dict.pop("preload").split(",") if name]
+  connect_path = options_dict.pop("connect")
+  fork         = options_dict.pop("fork")
+  output_dir   = options_dict.pop("output_dir")
+  pattern      = options_dict.pop("glob")
+  jobs         = options_dict.pop("jobs")
+
+  if serve_path is not None:
+    if args or connect_path is not None:
+      parser.print_help()
+      sys.exit(TwineExitStatus.BAD_SCRIPT_ARGS.value)
+    # pylint: disable=import-outside-toplevel
+    from .server import HAVE_FORK, HAVE_UNIX_SOCKETS, serve
+    if not HAVE_UNIX_SOCKETS or (fork and not HAVE_FORK):
+      print("pytwine: --serve needs Unix domain sockets (and --fork, "
+            "os.fork()), which this system lacks", file=sys.stderr)
+      sys.exit(TwineExitStatus.BAD_SCRIPT_ARGS.value)
+    try:
+      serve(serve_path, preload, fork)
+    except FileExistsError as ex:
+      print(f"pytwine: {ex}", file=sys.stderr)
+      sys.exit(TwineExitStatus.BAD_SCRIPT_ARGS.value)
+    sys.exit(TwineExitStatus.SUCCESS.value)
+
+  if connect_path is not None:
+    # pylint: disable=import-outside-toplevel
+    from .server import HAVE_UNIX_SOCKETS
+    if not HAVE_UNIX_SOCKETS:
+      print("pytwine: --connect needs Unix domain sockets, which this "
+            "system lacks", file=sys.stderr)
+      sys.exit(TwineExitStatus.BAD_SCRIPT_ARGS.value)
+
+  if output_dir is not None:
+    if not args or options_dict.pop("output") is not None:
+      parser.print_help()
+      sys.exit(TwineExitStatus.BAD_SCRIPT_ARGS.value)
+    _batch_script(args, output_dir, pattern, jobs, options_dict)
+
   if len(args) > 2:
     parser.print_help()
     sys.exit(TwineExitStatus.BAD_SCRIPT_ARGS)
@@ -92,9 +266,21 @@ def pytwine_script() -> None:
 
   #options_dict["debug"] = True
 
-  with _open_or_fallback( infile_path, "r", sys.stdin) as ifp:
-    with _open_or_fallback( outfile_path, "w", sys.stdout) as ofp:
-      res = cli_twine(ifp, ofp, **options_dict)
+  if options_dict["binary"]:
+    in_mode, in_fallback   = "rb", sys.stdin.buffer
+    out_mode, out_fallback = "wb", sys.stdout.buffer
+  else:
+    in_mode, in_fallback   = "r", sys.stdin
+    out_mode, out_fallback = "w", sys.stdout
+
+  with _open_or_fallback( infile_path, in_mode, in_fallback) as ifp:
+    with _open_or_fallback( outfile_path, out_mode, out_fallback) as ofp:
+      if connect_path is not None:
+        # pylint: disable=import-outside-toplevel
+        from .server import client_twine
+        res = client_twine(connect_path, ifp, ofp, **options_dict)
+      else:
+        res = cli_twine(ifp, ofp, **options_dict)
       sys.exit(res.value)
 
 
@@ -0,0 +1,327 @@
+"""
+A long-running pytwine server, and a client for it, so documents can
+be processed without paying for interpreter startup and heavy imports
+on every run.
+
+The server (``pytwine --serve SOCKET``) listens on a Unix domain
+socket, importing a list of modules once at startup. Each connection
+is a request to process one document, and gets a fresh
+:class:`PythonProcessor <pytwine.processors.PythonProcessor>` (and so
+a fresh global namespace); modules imported by earlier documents stay
+imported, though. Requests are handled one at a time -- unless the
+server is a :class:`ForkingTwineServer` (``pytwine --serve SOCKET
+--fork``), which handles each request in a child process forked from
+the server. Children share the preloaded modules with the server
+(copy-on-write), but changes they make to them don't outlive the
+request.
+
+The client (``pytwine --connect SOCKET``) behaves like the ``pytwine``
+script, but hands the work to the server.
+
+Unix domain sockets, and :func:`os.fork`, are only available on POSIX
+systems: elsewhere (see :data:`HAVE_UNIX_SOCKETS` and
+:data:`HAVE_FORK`), this module can be imported, but
+:class:`TwineServer` and :class:`ForkingTwineServer` are None, and
+:func:`serve` and :func:`client_twine` raise
+:class:`NotImplementedError`.
+
+Protocol: the client sends a single line of JSON -- the keyword
+arguments for :func:`cli_twine <pytwine.cli.cli_twine>`, plus the
+client's working directory -- followed by the UTF-8 encoded document,
+and then shuts down its side of the connection. The server replies
+with a sequence of frames, each a one-byte kind, a four-byte
+big-endian length and a payload: ``o`` frames hold output, ``e``
+frames text for standard error, and a final ``s`` frame holds the
+exit status (as ASCII digits, or empty for success).
+"""
+
+import codecs
+import contextlib
+import gc
+import importlib
+import io
+import json
+import os
+import socket
+import socketserver
+import stat
+import struct
+import sys
+import threading
+import traceback
+
+from typing import Any, IO, Iterable, Optional
+
+from .cli  import cli_twine
+from .core import TwineExitStatus
+
+_FRAME_HEADER = struct.Struct(">cI")
+
+OUTPUT_FRAME = b"o"
+"kind of frames holding document output"
+
+LOG_FRAME = b"e"
+"kind of frames holding text for standard error"
+
+STATUS_FRAME = b"s"
+"kind of the final frame, holding the exit status"
+
+_READ_SIZE = 64 * 1024
+
+HAVE_UNIX_SOCKETS = hasattr(socketserver, "UnixStreamServer")
+"whether Unix domain sockets (and so servers) are available"
+
+HAVE_FORK = hasattr(socketserver, "ForkingMixIn")
+"whether :class:`ForkingTwineServer` is available"
+
+class _FrameWriter(io.RawIOBase):
+  """a binary file that sends what is written as frames of one kind"""
+
+  def __init__(self, wfile, kind : bytes, lock : threading.Lock):
+    super().__init__()
+    self._wfile = wfile
+    self._kind = kind
+    self._lock = lock
+
+  def writable(self) -> bool:
+    return True
+
+  def write(self, data) -> int: # type: ignore
+    size = len(data)
+    if size:
+      with self._lock:
+        _send_frame(self._wfile, self._kind, data)
+    return size
+
+
+def _send_frame(wfile, kind : bytes, payload : bytes) -> None:
+  wfile.write(_FRAME_HEADER.pack(kind, len(payload)) + bytes(payload))
+  wfile.flush()
+
+
+class _TwineHandler(socketserver.StreamRequestHandler):
+  """handles one request: processes a document"""
+
+  def handle(self):
+    line = self.rfile.readline()
+    if not line:
+      # a client that went away without asking anything (such as a
+      # server checking whether we are still listening)
+      return
+    # output and log frames may be written from different threads
+    self.frame_lock = threading.Lock()
+    log = io.TextIOWrapper(
+      io.BufferedWriter(_FrameWriter(self.wfile, LOG_FRAME, self.frame_lock)),
+      encoding="utf8", line_buffering=True)
+    try:
+      status = self._twine(line, log)
+    except Exception: # pylint: disable=broad-except
+      traceback.print_exc(file=log)
+      status = TwineExitStatus.BAD_SCRIPT_ARGS
+    log.flush()
+    value = status.value
+    with self.frame_lock:
+      _send_frame(self.wfile, STATUS_FRAME,
+                  b"" if value is None else str(value).encode("ascii"))
+
+  def _twine(self, line : bytes, log : IO[str]) -> TwineExitStatus:
+    request = json.loads(line)
+    cwd = request.pop("cwd")
+    options = request.pop("options")
+    binary = options.get("binary", False)
+
+    out_raw = _FrameWriter(self.wfile, OUTPUT_FRAME, self.frame_lock)
+    ifp : IO[Any]
+    ofp : IO[Any]
+    if binary:
+      ifp = self.rfile
+      ofp = io.BufferedWriter(out_raw)
+    else:
+      ifp = io.TextIOWrapper(self.rfile, encoding="utf8")
+      ofp = io.TextIOWrapper(io.BufferedWriter(out_raw), encoding="utf8",
+                             newline="\n")
+
+    old_cwd = os.getcwd()
+    try:
+      os.chdir(cwd)
+      with contextlib.redirect_stderr(log):
+        status = cli_twine(ifp, ofp, log=log, **options)
+      ofp.flush()
+    finally:
+      os.chdir(old_cwd)
+    return status
+
+
+def _remove_stale_socket(path : str) -> None:
+  """
+  Remove the socket at ``path``, if it is one left behind by a server
+  that has gone away. Raises :class:`FileExistsError` if there is
+  anything else at ``path`` (a file, or a socket that a server is
+  listening on).
+  """
+
+  try:
+    mode = os.lstat(path).st_mode
+  except FileNotFoundError:
+    return
+  if not stat.S_ISSOCK(mode):
+    raise FileExistsError(f"{path} already exists, and isn't a socket")
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+    try:
+      probe.connect(path)
+    except ConnectionRefusedError:
+      os.remove(path)
+      return
+  raise FileExistsError(f"a server is already listening on {path}")
+
+
+if HAVE_UNIX_SOCKETS:
+
+  class TwineServer(socketserver.UnixStreamServer):
+    """
+    Serves requests to process documents on the Unix domain socket at
+    ``path``, after importing the modules named in ``preload``.
+
+    A socket left at ``path`` by a server that has gone away is
+    replaced; if anything else is there, :class:`FileExistsError` is
+    raised.
+    """
+
+    def __init__(self, path : str, preload : Iterable[str] = ()):
+      _remove_stale_socket(path)
+      for module in preload:
+        importlib.import_module(module)
+      super().__init__(path, _TwineHandler)
+
+    def server_close(self):
+      super().server_close()
+      with contextlib.suppress(FileNotFoundError):
+        os.remove(self.server_address) # type: ignore
+
+else:
+  TwineServer = None # type: ignore # pylint: disable=invalid-name
+
+
+if HAVE_FORK and HAVE_UNIX_SOCKETS:
+
+  class ForkingTwineServer(socketserver.ForkingMixIn, TwineServer):
+    """
+    A :class:`TwineServer` which forks a child process to handle each
+    request (so requests may also be handled concurrently). Only
+    available where :func:`os.fork` is.
+    """
+
+    def __init__(self, path : str, preload : Iterable[str] = ()):
+      super().__init__(path, preload)
+      gc.collect()
+
+    def process_request(self, request, client_address):
+      # move everything the server has allocated out of the garbage
+      # collector's reach, so collections in the child don't touch (and
+      # thus copy) the pages it is on. (gc.freeze() is new in Python 3.7.)
+      freeze = getattr(gc, "freeze", None)
+      if freeze is not None:
+        freeze()
+      super().process_request(request, client_address)
+
+else:
+  ForkingTwineServer = None # type: ignore # pylint: disable=invalid-name
+
+
+def serve(path : str, preload : Iterable[str] = (), fork : bool = False) -> None:
+  """run a :class:`TwineServer` (or, if ``fork`` is true, a
+  :class:`ForkingTwineServer`) until interrupted"""
+
+  if not HAVE_UNIX_SOCKETS:
+    raise NotImplementedError("the pytwine server needs Unix domain sockets")
+  if fork and not HAVE_FORK:
+    raise NotImplementedError("forking servers need os.fork()")
+  server_class = ForkingTwineServer if fork else TwineServer
+  with server_class(path, preload) as server:
+    print(f"pytwine: serving on {path}", file=sys.stderr)
+    with contextlib.suppress(KeyboardInterrupt):
+      server.serve_forever()
+
+
+def _send_document(sock : socket.socket, ifp : IO) -> None:
+  """send the contents of ``ifp`` (text or binary), then shut down
+  our side of ``sock``"""
+
+  try:
+    while True:
+      data = ifp.read(_READ_SIZE)
+      if not data:
+        break
+      if isinstance(data, str):
+        data = data.encode("utf8")
+      sock.sendall(data)
+    sock.shutdown(socket.SHUT_WR)
+  except OSError:
+    # the server has gone away; the reader will notice
+    pass
+
+def _read_exactly(rfile, size : int) -> bytes:
+  data = rfile.read(size)
+  if len(data) < size:
+    raise ConnectionError("pytwine server closed the connection")
+  return data
+
+def client_twine(path : str, ifp : IO, ofp : IO,
+                 log : Optional[IO[str]] = None,
+                 **options) -> TwineExitStatus:
+  """
+  Process a document, as :func:`cli_twine <pytwine.cli.cli_twine>`
+  does, by sending it to the server listening at ``path``.
+
+  Arguments:
+    path: the server's socket.
+    ifp: file to read the document from.
+    ofp: file to write output to (binary if ``options["binary"]``).
+    log: where to write text from the server's standard error
+      (default: ``sys.stderr``).
+    options: keyword arguments for ``cli_twine``. Cache directories
+      and other paths may be relative to our working directory. The
+      document's path is passed on as ``source_path``, if known.
+  """
+
+  if not HAVE_UNIX_SOCKETS:
+    raise NotImplementedError("the pytwine server needs Unix domain sockets")
+  if log is None:
+    log = sys.stderr
+  options = dict(options)
+  for name in ["parse_cache", "output_cache", "checkpoints", "code_cache",
+               "profile_report", "pstats_prefix", "source_path", "trace"]:
+    if options.get(name) is not None:
+      options[name] = os.path.abspath(options[name])
+  name = getattr(ifp, "name", None)
+  if options.get("source_path") is None and isinstance(name, str) and \
+     not name.startswith("<"):
+    options["source_path"] = os.path.abspath(name)
+  header = json.dumps({"cwd": os.getcwd(), "options": options}) + "\n"
+
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+    sock.connect(path)
+    sock.sendall(header.encode("utf8"))
+    sender = threading.Thread(target=_send_document, args=(sock, ifp),
+                              daemon=True)
+    sender.start()
+
+    # (frames may split multi-byte characters)
+    decoder = None if options.get("binary") else \
+              codecs.getincrementaldecoder("utf8")("surrogateescape")
+    with sock.makefile("rb") as rfile:
+      while True:
+        kind, size = _FRAME_HEADER.unpack(
+          _read_exactly(rfile, _FRAME_HEADER.size))
+        payload = _read_exactly(rfile, size)
+        if kind == OUTPUT_FRAME:
+          ofp.write(payload if decoder is None else decoder.decode(payload))
+        elif kind == LOG_FRAME:
+          log.write(payload.decode("utf8", "replace"))
+        elif kind == STATUS_FRAME:
+          break
+    sender.join()
+
+  ofp.flush()
+  log.flush()
+  return TwineExitStatus(int(payload) if payload else None)
@@ -0,0 +1,32 @@
+"""
+sample documents shared by several tests
+"""
+
+SIMPLE_DOC = """\
+```python .important foo=bar
+print("aaa")
+```
+bar
+```python
+print(2)
+```
+"""
+"a document with two code blocks"
+
+SIMPLE_DOC_OUTPUT = "aaa\nbar\n2\n"
+"what :data:`SIMPLE_DOC` twines to"
+
+BAD_DOC = """\
+```python .important foo=bar
+import
+print(
+```
+bar
+```python
+print(2)
+```
+"""
+"a document whose first code block can't be compiled"
+
+BAD_DOC_OUTPUT = "bar\n2\n"
+"what :data:`BAD_DOC` twines to (omitting the bad code block)"
@@ -0,0 +1,110 @@
+"""
+test the dependency analysis in pytwine.analysis
+"""
+
+from pytwine.analysis import analyse_code, dependency_graph, read_before_bound
+
+def _graph(*sources):
+  return [sorted(preds) for preds in
+          dependency_graph([analyse_code(source) for source in sources])]
+
+def test_independent_loads():
+  "chunks writing different names are independent"
+
+  assert _graph("import csv\na = load('a.csv')",
+                "import csv\nb = load('b.csv')",
+                "c = len(a) + len(b)") == [[], [], [0, 1]]
+
+def test_mutation_is_a_write():
+  "method calls, item and attribute assignment, and call arguments write"
+
+  assert _graph("xs = []",
+                "xs.append(1)",
+                "ys = {}",
+                "ys['a'] = 1",
+                "print(len(ys))",
+                "total = sum(xs)") == [[], [0], [], [2], [2, 3], [0, 1]]
+
+def test_imported_modules_read():
+  "reading attributes of imported modules doesn't serialise chunks"
+
+  assert _graph("import math",
+                "a = math.pi",
+                "b = math.e") == [[], [0], [0]]
+
+def test_imported_modules_mutated():
+  "modifying imported modules, or calling their functions, is a write"
+
+  assert _graph("import os\nos.environ['X'] = '1'",
+                "import os\nprint(os.environ['X'])") == [[], [0]]
+  assert _graph("import random\nrandom.seed(0)",
+                "import random\nx = random.random()") == [[], [0]]
+  assert _graph("import sys\nsys.path.append('lib')",
+                "import sys\nprint(sys.path)") == [[], [0]]
+  assert _graph("import matplotlib.pyplot as plt\nplt.figure()",
+                "import matplotlib.pyplot as plt\nplt.savefig('a.png')") == \
+         [[], [0]]
+
+def test_aliases_share_mutations():
+  "modifying an object counts as writing every name that may refer to it"
+
+  assert _graph("lst = []",
+                "alias = lst",
+                "alias.append(1)",
+                "print(lst)") == [[], [0], [0, 1], [0, 1, 2]]
+  assert _graph("rows = [[]]",
+                "for row in rows:\n  row.append(1)\n",
+                "print(rows)") == [[], [0], [0, 1]]
+  assert _graph("xs = []",
+                "def add():\n  ys = xs\n  ys.append(1)\n",
+                "add()",
+                "print(xs)") == [[], [], [0, 1], [0, 2]]
+
+def test_calls_of_imported_functions_write_module():
+  "calling a function imported from a module may change the module's state"
+
+  assert _graph("from random import seed, random",
+                "seed(0)",
+                "x = random()") == [[], [0], [0, 1]]
+  assert _graph("import random",
+                "random.seed(0)",
+                "from random import random as rand\nx = rand()") == \
+         [[], [0], [1]]
+
+def test_functions_propagate_names():
+  "calling a function counts as using the globals its body uses"
+
+  assert _graph("data = [1]",
+                "def add(x):\n  data.append(x)\n",
+                "other = 1",
+                "add(2)",
+                "n = 0\ndef inc():\n  global n\n  n += 1\n",
+                "inc()",
+                "print(n)") == [[], [], [], [0, 1], [], [4], [4, 5]]
+
+def test_barriers():
+  "exec, globals() and star-imports serialise everything around them"
+
+  for barrier in ["exec('x = 1')", "globals()['x'] = 1", "from os import *",
+                  "def f():\n  return eval('1')\n"]:
+    assert _graph("a = 1", "b = 2", barrier, "c = 3") == \
+           [[], [], [0, 1], [2]], barrier
+
+def test_unparseable_code_uses_nothing():
+  "chunks with syntax errors have no dependencies"
+
+  assert _graph("a = 1", "print(") == [[], []]
+
+def test_read_before_bound():
+  "only reads before a name is (re)bound need it to be defined already"
+
+  def needed(names, *sources):
+    chunk_names = [analyse_code(source) for source in sources]
+    return sorted(read_before_bound(chunk_names, names))
+
+  assert needed("fx", "x = 1\nprint(x)", "print(f(x))") == ["f"]
+  assert needed("x", "x = x + 1") == ["x"]
+  assert needed("x", "for x in range(x):\n  pass") == ["x"]
+  assert needed("ofp", "with open('a') as ofp:\n  ofp.write('a')") == []
+  assert needed("f", "def g():\n  return f()\n", "g()") == ["f"]
+  assert needed("x", "exec('print(x)')", "x = 1") == ["x"]
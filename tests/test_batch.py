@@ -0,0 +1,133 @@
+"""
+test processing many documents at once, with pytwine.batch
+"""
+
+import os
+
+from io import StringIO
+from tempfile import TemporaryDirectory
+
+import pytest
+
+from pytwine.batch import batch_exit_status, batch_twine, find_documents
+from pytwine.core  import TwineExitStatus
+
+DOCS = {
+  "good.pmd":     "text\n```python\nprint(6 * 7)\n```\n",
+  "sub/bad.pmd":  "```python\nprint(\n```\n",
+  "notes.txt":    "not a document\n",
+}
+
+def _make_docs(tmpdirname : str) -> str:
+  "write DOCS to an ``in`` subdirectory, returning its path"
+
+  indir = os.path.join(tmpdirname, "in")
+  for name, contents in DOCS.items():
+    path = os.path.join(indir, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf8") as ofp:
+      ofp.write(contents)
+  return indir
+
+
+def test_find_documents():
+  "directories are searched with the glob, files taken as given"
+
+  with TemporaryDirectory() as tmpdirname:
+    indir = _make_docs(tmpdirname)
+    notes = os.path.join(indir, "notes.txt")
+
+    assert [name for _, name in find_documents([indir])] == ["good.pmd"]
+    assert [name for _, name in find_documents([indir, notes], "**/*.pmd")] == \
+           ["good.pmd", os.path.join("sub", "bad.pmd"), "notes.txt"]
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_batch_twine(jobs):
+  "each document gets an output file, a log file and a status"
+
+  with TemporaryDirectory() as tmpdirname:
+    indir = _make_docs(tmpdirname)
+    outdir = os.path.join(tmpdirname, "out")
+    log = StringIO()
+    results = batch_twine(find_documents([indir], "**/*.pmd"), outdir,
+                          jobs=jobs, log=log)
+
+    assert [result.status for result in results] == \
+           [TwineExitStatus.SUCCESS, TwineExitStatus.BLOCK_COMPILATION_ERROR]
+    with open(os.path.join(outdir, "good.md"), encoding="utf8") as ifp:
+      assert ifp.read() == "text\n42\n"
+    with open(os.path.join(outdir, "sub", "bad.log"), encoding="utf8") as ifp:
+      assert "SyntaxError" in ifp.read()
+    assert "2 documents: 1 succeeded, 1 with compilation errors, 0 failed" \
+           in log.getvalue()
+    assert batch_exit_status(results) == TwineExitStatus.BLOCK_COMPILATION_ERROR
+    assert batch_exit_status(results[:1]) == TwineExitStatus.SUCCESS
+
+
+def test_exceptions_reported():
+  "a document raising an exception fails, without stopping the batch"
+
+  with TemporaryDirectory() as tmpdirname:
+    indir = _make_docs(tmpdirname)
+    boom = os.path.join(tmpdirname, "boom.pmd")
+    with open(boom, "w", encoding="utf8") as ofp:
+      ofp.write("```python\nraise RuntimeError('boom')\n```\n")
+
+    results = batch_twine(find_documents([boom, indir]),
+                          os.path.join(tmpdirname, "out"), log=StringIO())
+
+    assert results[0].error == "RuntimeError: boom"
+    assert results[1].status == TwineExitStatus.SUCCESS
+    assert batch_exit_status(results) == TwineExitStatus.BAD_SCRIPT_ARGS
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_exit_reported(jobs):
+  "a document calling sys.exit() fails, without stopping the batch"
+
+  with TemporaryDirectory() as tmpdirname:
+    indir = _make_docs(tmpdirname)
+    leave = os.path.join(tmpdirname, "leave.pmd")
+    with open(leave, "w", encoding="utf8") as ofp:
+      ofp.write("```python\nimport sys\nsys.exit(3)\n```\n")
+
+    results = batch_twine(find_documents([leave, indir]),
+                          os.path.join(tmpdirname, "out"), jobs=jobs,
+                          log=StringIO())
+
+    assert results[0].error == "SystemExit: 3"
+    assert results[1].status == TwineExitStatus.SUCCESS
+    assert batch_exit_status(results) == TwineExitStatus.BAD_SCRIPT_ARGS
+
+
+def test_dead_worker_reported():
+  "a document whose worker process dies fails, without stopping the batch"
+
+  with TemporaryDirectory() as tmpdirname:
+    indir = _make_docs(tmpdirname)
+    die = os.path.join(tmpdirname, "die.pmd")
+    with open(die, "w", encoding="utf8") as ofp:
+      ofp.write("```python\nimport os\nos._exit(9)\n```\n")
+    log = StringIO()
+
+    results = batch_twine(find_documents([die, indir]),
+                          os.path.join(tmpdirname, "out"), jobs=2, log=log)
+
+    assert len(results) == 2
+    assert results[0].error is not None
+    assert "BrokenProcessPool" in results[0].error
+    with open(results[0].log, encoding="utf8") as ifp:
+      assert "processing failed: BrokenProcessPool" in ifp.read()
+    assert "2 documents:" in log.getvalue()
+    assert batch_exit_status(results) == TwineExitStatus.BAD_SCRIPT_ARGS
+
+
+def test_clashing_outputs_rejected():
+  "two documents that would share an output file are an error"
+
+  with TemporaryDirectory() as tmpdirname:
+    indir = _make_docs(tmpdirname)
+    good = os.path.join(indir, "good.pmd")
+    with pytest.raises(ValueError):
+      batch_twine(find_documents([good, indir]), tmpdirname, log=StringIO())
@@ -0,0 +1,246 @@
+"""
+test the on-disk caches in pytwine.caching
+"""
+
+import os
+import time
+
+from tempfile import TemporaryDirectory
+
+import pytest
+
+from pytwine.caching import CheckpointStore, CodeCache, DirectoryCache, ParseCache
+from pytwine.parsers import MarkdownParser
+
+SAMPLE_DOC = """\
+```python .important foo=bar
+print("aaa")
+```
+bar
+~~~python
+print(2)
+~~~
+"""
+
+class _CountedPickles:
+  """counts how many times it is pickled"""
+
+  def __init__(self):
+    self.pickled = 0
+
+  def __reduce__(self):
+    self.pickled += 1
+    return (_CountedPickles, ())
+
+
+class TestDirectoryCache:
+  """tests of the basic key/value store"""
+
+  def test_get_and_put(self):
+    "stored entries can be retrieved"
+
+    with TemporaryDirectory() as tmpdirname:
+      cache = DirectoryCache(tmpdirname)
+      assert cache.get("abc") is None
+      cache.put("abc", b"some data")
+      assert cache.get("abc") == b"some data"
+      assert not [name for name in os.listdir(tmpdirname)
+                  if name.startswith(".tmp-")]
+
+  def test_least_recently_used_evicted(self):
+    "once over the size cap, least recently used entries are deleted"
+
+    with TemporaryDirectory() as tmpdirname:
+      cache = DirectoryCache(tmpdirname, max_bytes=25)
+      cache.put("aa", b"x" * 10)
+      cache.put("bb", b"x" * 10)
+
+      # make "aa" the most recently used
+      past = time.time() - 100
+      os.utime(cache.path_for("bb"), (past, past))
+      assert cache.get("aa") is not None
+
+      cache.put("cc", b"x" * 10)
+      assert cache.get("bb") is None
+      assert cache.get("aa") is not None
+      assert cache.get("cc") is not None
+
+  def test_eviction_down_to_low_water_mark(self):
+    "eviction leaves room, and counts entries other caches wrote"
+
+    with TemporaryDirectory() as tmpdirname:
+      cache = DirectoryCache(tmpdirname, max_bytes=100)
+      other = DirectoryCache(tmpdirname, max_bytes=100)
+      for i in range(5):
+        other.put(f"{i:02x}", b"x" * 10)
+      for i in range(5, 11):
+        cache.put(f"{i:02x}", b"x" * 10)
+
+      sizes = [os.path.getsize(os.path.join(tmpdirname, name))
+               for name in os.listdir(tmpdirname)]
+      assert sum(sizes) <= 100 * DirectoryCache.EVICT_TO
+
+
+class TestParseCache:
+  """tests of caching parse results"""
+
+  def test_cached_chunks_equal_parsed(self):
+    "chunks loaded from the cache equal those from parsing"
+
+    with TemporaryDirectory() as tmpdirname:
+      cache = ParseCache(tmpdirname)
+      expected = MarkdownParser(string=SAMPLE_DOC).parse()
+
+      first = cache.parse(MarkdownParser(string=SAMPLE_DOC))
+      second = cache.parse(MarkdownParser(string=SAMPLE_DOC))
+
+      assert first == expected
+      assert second == expected
+      assert (cache.hits, cache.misses) == (1, 1)
+
+  def test_key_depends_on_text_and_pattern(self):
+    "changing the text or the code block pattern changes the key"
+
+    with TemporaryDirectory() as tmpdirname:
+      cache = ParseCache(tmpdirname)
+      parser = MarkdownParser(string=SAMPLE_DOC)
+      key = cache.key(parser)
+
+      assert cache.key(MarkdownParser(string=SAMPLE_DOC + "\n")) != key
+      parser.codeblock_begin = "^xxx$"
+      assert cache.key(parser) != key
+
+  def test_corrupt_entry_reparsed(self):
+    "a corrupt entry is ignored and overwritten"
+
+    with TemporaryDirectory() as tmpdirname:
+      cache = ParseCache(tmpdirname)
+      parser = MarkdownParser(string=SAMPLE_DOC)
+      cache.store.put(cache.key(parser), b"garbage")
+
+      chunks = cache.parse(parser)
+      assert chunks == MarkdownParser(string=SAMPLE_DOC).parse()
+      assert cache.misses == 1
+      assert cache.parse(MarkdownParser(string=SAMPLE_DOC)) == chunks
+      assert cache.hits == 1
+
+  def test_options_restored(self):
+    "cached code chunks have the parser's options"
+
+    with TemporaryDirectory() as tmpdirname:
+      cache = ParseCache(tmpdirname)
+      cache.parse(MarkdownParser(string=SAMPLE_DOC))
+      cached = cache.parse(MarkdownParser(string=SAMPLE_DOC))
+      fresh = MarkdownParser(string=SAMPLE_DOC).parse()
+      assert cache.hits == 1
+      assert [chunk.options for chunk in cached if chunk.chunkType == "code"] == \
+             [chunk.options for chunk in fresh if chunk.chunkType == "code"]
+
+
+class TestCodeCache:
+  """tests of caching compiled code"""
+
+  def test_key_depends_on_source_and_filename(self):
+    "changing the source or filename changes the key"
+
+    with TemporaryDirectory() as tmpdirname:
+      cache = CodeCache(tmpdirname)
+      key = cache.key("x = 1", "<string>")
+      assert cache.key("x = 2", "<string>") != key
+      assert cache.key("x = 1", "doc.md") != key
+
+  def test_corrupt_entry_recompiled(self):
+    "a corrupt entry is ignored and overwritten"
+
+    with TemporaryDirectory() as tmpdirname:
+      cache = CodeCache(tmpdirname)
+      cache.store.put(cache.key("x = 1", "<string>"), b"garbage")
+
+      namespace = {}
+      exec(cache.compile("x = 1", "<string>"), namespace) # pylint: disable=exec-used
+      assert namespace["x"] == 1
+      assert cache.misses == 1
+      cache.compile("x = 1", "<string>")
+      assert cache.hits == 1
+
+  def test_syntax_errors_not_cached(self):
+    "code that doesn't compile raises SyntaxError every time"
+
+    with TemporaryDirectory() as tmpdirname:
+      cache = CodeCache(tmpdirname)
+      for _ in range(2):
+        with pytest.raises(SyntaxError):
+          cache.compile("print(", "<string>")
+      assert (cache.hits, cache.misses) == (0, 2)
+
+
+class TestCheckpointStore:
+  """tests of namespace checkpoints"""
+
+  def test_partly_pickled_value_truncated(self):
+    "a value that fails part-way through pickling doesn't corrupt the rest"
+
+    with TemporaryDirectory() as tmpdirname:
+      store = CheckpointStore(tmpdirname)
+      namespace = {"before": b"x" * 100000,
+                   "bad": [b"y" * 100000, lambda: None],
+                   "after": {"z": 1},
+                   "mod": os}
+      assert store.save("k", namespace) == ["bad"]
+
+      restored = store.restore("k")
+      assert restored is not None
+      values, skipped = restored
+      assert skipped == ["bad"]
+      assert values == {"before": b"x" * 100000, "after": {"z": 1}, "mod": os}
+
+  def test_shared_references_kept(self):
+    "objects shared between globals are still shared once restored"
+
+    with TemporaryDirectory() as tmpdirname:
+      store = CheckpointStore(tmpdirname)
+      a = [1]
+      store.save("k", {"a": a, "f": lambda: a, "b": a, "c": {"a": a}})
+
+      restored = store.restore("k")
+      assert restored is not None
+      values, skipped = restored
+      assert skipped == ["f"]
+      values["a"].append(2)
+      assert values["b"] == values["c"]["a"] == [1, 2]
+
+  def test_values_pickled_once(self):
+    "each global is pickled just once"
+
+    with TemporaryDirectory() as tmpdirname:
+      store = CheckpointStore(tmpdirname)
+      counted = _CountedPickles()
+      store.save("k", {"counted": counted})
+      assert counted.pickled == 1
+
+  def test_failed_value_forgotten(self):
+    "an object first met in a value that can't be pickled is pickled afresh later"
+
+    with TemporaryDirectory() as tmpdirname:
+      store = CheckpointStore(tmpdirname)
+      shared = [1]
+      store.save("k", {"bad": [shared, lambda: None], "good": shared,
+                       "also": {"shared": shared}})
+
+      restored = store.restore("k")
+      assert restored is not None
+      values, skipped = restored
+      assert skipped == ["bad"]
+      assert values["good"] == [1]
+      assert values["also"]["shared"] is values["good"]
+
+  def test_corrupt_checkpoint_ignored(self):
+    "corrupt or missing checkpoints can't be restored"
+
+    with TemporaryDirectory() as tmpdirname:
+      store = CheckpointStore(tmpdirname)
+      assert store.restore("k") is None
+      store.save("k", {"x": 1})
+      with open(store.store.path_for("k"), "r+b") as ofp:
+        ofp.truncate(20)
+      assert store.restore("k") is None
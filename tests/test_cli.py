@@ -3,10 +3,15 @@
 test cli-level functions, found in pytwine.cli
 """
 
+import io
+import os
+
 from tempfile import TemporaryDirectory
 
+from sample_docs import BAD_DOC, BAD_DOC_OUTPUT, SIMPLE_DOC, SIMPLE_DOC_OUTPUT
+
 from pytwine.core       import TwineExitStatus
-from pytwine.cli        import cli_twine
+from pytwine.cli        import TwineOptions, cli_twine
 
 def _dump(contents : str, filename : str) -> None:
   """dump string to file"""
@@ -30,27 +35,15 @@ def test_simple_doc():
   in a temporary directory
   """
 
-  mydoc = """\
-```python .important foo=bar
-print("aaa")
-```
-bar
-```python
-print(2)
-```
-"""
-
   with TemporaryDirectory() as tmpdirname:
     infile_path   = f"{tmpdirname}/tmp.pmd"
     outfile_path  = f"{tmpdirname}/tmp.md"
 
-    _dump(mydoc, infile_path)
+    _dump(SIMPLE_DOC, infile_path)
     res = _run_twine(infile_path, outfile_path)
-    actual_output = _slurp(outfile_path)
-    expected_output = 'aaa\nbar\n2\n'
 
     assert res == TwineExitStatus.SUCCESS
-    assert actual_output == expected_output
+    assert _slurp(outfile_path) == SIMPLE_DOC_OUTPUT
 
 
 def test_bad_doc():
@@ -60,31 +53,103 @@ def test_bad_doc():
   The bad code block just gets skipped.
   """
 
+  with TemporaryDirectory() as tmpdirname:
+    infile_path = f"{tmpdirname}/tmp.pmd"
+    outfile_path = f"{tmpdirname}/tmp.md"
+
+    _dump(BAD_DOC, infile_path)
+    res = _run_twine(infile_path, outfile_path)
+
+    assert res == TwineExitStatus.BLOCK_COMPILATION_ERROR
+    assert _slurp(outfile_path) == BAD_DOC_OUTPUT
+
+
+def test_parse_cache():
+  """run the cli_twine function twice with a parse cache;
+  the second run uses the cache
+  """
+
   mydoc = """\
-```python .important foo=bar
-import
-print
-```
-bar
 ```python
-print(2)
+print("aaa")
 ```
+bar
 """
 
+  with TemporaryDirectory() as tmpdirname:
+    infile_path   = f"{tmpdirname}/tmp.pmd"
+    outfile_path  = f"{tmpdirname}/tmp.md"
+    cache_dir     = f"{tmpdirname}/cache"
+    _dump(mydoc, infile_path)
+
+    for _ in range(2):
+      with open(infile_path, "r", encoding="utf8") as ifp:
+        with open(outfile_path, "w", encoding="utf8") as ofp:
+          res = cli_twine(ifp, ofp, parse_cache=cache_dir)
+
+      assert res == TwineExitStatus.SUCCESS
+      assert _slurp(outfile_path) == 'aaa\nbar\n'
+      assert len(os.listdir(cache_dir)) == 1
+
+
+def test_binary_mode():
+  """in binary mode, doc chunks are copied through byte-for-byte
+  (mixed line endings included), and only code is decoded"""
+
+  mydoc = ("café\r\n"
+           "```python\r\n"
+           "print('été')\r\n"
+           "```\r\n"
+           "bar\rbaz\n"
+           "```python\n"
+           "print(2)\n"
+           "```\n"
+           "end\r\n").encode("utf-8")
+
   with TemporaryDirectory() as tmpdirname:
     infile_path = f"{tmpdirname}/tmp.pmd"
     outfile_path = f"{tmpdirname}/tmp.md"
+    with open(infile_path, "wb") as ofp:
+      ofp.write(mydoc)
 
-    _dump(mydoc, infile_path)
-    res = _run_twine(infile_path, outfile_path)
-    actual_output = _slurp(outfile_path)
-    expected_output = 'aaa\nbar\n2\n'
-    expected_output = 'bar\n2\n'
+    with open(infile_path, "rb") as ifp:
+      with open(outfile_path, "wb") as ofp:
+        res = cli_twine(ifp, ofp, binary=True)
 
-    assert res == TwineExitStatus.BLOCK_COMPILATION_ERROR
-    assert actual_output == expected_output
+    with open(outfile_path, "rb") as ifp:
+      actual_output = ifp.read()
 
+  assert res == TwineExitStatus.SUCCESS
+  assert actual_output == ("café\r\n"
+                           "été\n"
+                           "bar\rbaz\n"
+                           "2\n"
+                           "end\r\n").encode("utf-8")
 
 
+def test_options_object():
+  "cli_twine takes its settings as TwineOptions, or as keywords"
 
+  mydoc = """\
+```python
+print(
+```
+```python
+print(2)
+```
+"""
 
+  with TemporaryDirectory() as tmpdirname:
+    infile_path = f"{tmpdirname}/tmp.pmd"
+    outfile_path = f"{tmpdirname}/tmp.md"
+    _dump(mydoc, infile_path)
+    options = TwineOptions(output_cache=f"{tmpdirname}/outputs",
+                           log=io.StringIO())
+
+    with open(infile_path, "r", encoding="utf8") as ifp:
+      with open(outfile_path, "w", encoding="utf8") as ofp:
+        res = cli_twine(ifp, ofp, options, stream=True)
+
+    assert res == TwineExitStatus.BLOCK_COMPILATION_ERROR
+    assert _slurp(outfile_path) == "2\n"
+    assert os.listdir(f"{tmpdirname}/outputs")
@@ -0,0 +1,118 @@
+"""
+test the event hooks of pytwine.events, and the Chrome trace exporter
+"""
+
+import json
+import os
+
+from io import StringIO
+from tempfile import TemporaryDirectory
+
+from pytwine.batch      import batch_twine, find_documents
+from pytwine.cli        import cli_twine
+from pytwine.events     import (BEGIN, COMPILE, DOCUMENT, END, EXEC, PARSE,
+                                WRITE, EventHooks, traced_chunks)
+from pytwine.parsers    import MarkdownParser
+from pytwine.processors import PythonProcessor
+
+DOC = "text\n```python\nprint(6 * 7)\n```\n"
+
+def test_processor_events():
+  "the document, compilation, execution and writes are bracketed by events"
+
+  events = []
+  hooks = EventHooks([events.append])
+  sink = StringIO()
+  processor = PythonProcessor(sink, log=StringIO(), hooks=hooks,
+                              source_path="doc.pmd")
+  processor.twine(traced_chunks(MarkdownParser(string=DOC).iter_chunks(), hooks))
+
+  assert sink.getvalue() == "text\n42\n"
+  assert [(event.name, event.phase) for event in events] == [
+    (DOCUMENT, BEGIN),
+    (PARSE, BEGIN), (PARSE, END), (WRITE, BEGIN), (WRITE, END),
+    (PARSE, BEGIN), (PARSE, END),
+    (COMPILE, BEGIN), (COMPILE, END), (EXEC, BEGIN), (EXEC, END),
+    (WRITE, BEGIN), (WRITE, END),
+    (PARSE, BEGIN), (PARSE, END),
+    (DOCUMENT, END)]
+  assert events[0].data == {"path": "doc.pmd"}
+  compile_begin = events[7]
+  assert (compile_begin.chunk_number, compile_begin.start_line) == (1, 2)
+  assert events[11].data == {"size": 3}
+  timestamps = [event.timestamp for event in events]
+  assert timestamps == sorted(timestamps)
+
+
+def test_no_listeners():
+  "hooks without listeners are false, and listeners can be removed"
+
+  events = []
+  hooks = EventHooks()
+  assert not hooks
+  hooks.add(events.append)
+  assert hooks
+  hooks.remove(events.append)
+  PythonProcessor(StringIO(), log=StringIO(), hooks=hooks).twine(
+    MarkdownParser(string=DOC).parse())
+  assert not events
+
+
+def _spans(trace):
+  "the names of the trace's duration events, checking they nest"
+
+  names = []
+  open_spans = []
+  for record in trace["traceEvents"]:
+    if record["ph"] == "B":
+      open_spans.append(record["name"])
+      names.append(record["name"])
+    elif record["ph"] == "E":
+      assert open_spans.pop() == record["name"]
+  assert not open_spans
+  return names
+
+
+def test_cli_trace():
+  "cli_twine writes a Chrome trace, with chunk details"
+
+  with TemporaryDirectory() as tmpdirname:
+    trace_path = os.path.join(tmpdirname, "trace.json")
+    cli_twine(StringIO(DOC), StringIO(), log=StringIO(), trace=trace_path)
+    with open(trace_path, encoding="utf8") as ifp:
+      trace = json.load(ifp)
+
+  names = _spans(trace)
+  assert names[0] == "document"
+  assert "compile chunk 1" in names and "exec chunk 1" in names
+  exec_begin = next(record for record in trace["traceEvents"]
+                    if record["name"] == "exec chunk 1")
+  assert exec_begin["args"] == {"chunk": 1, "line": 2}
+  assert exec_begin["cat"] == "exec"
+
+
+def test_batch_trace():
+  "a batch's traces are merged, each document with its own process ID"
+
+  with TemporaryDirectory() as tmpdirname:
+    indir = os.path.join(tmpdirname, "in")
+    os.makedirs(indir)
+    for name in ["a.pmd", "b.pmd"]:
+      with open(os.path.join(indir, name), "w", encoding="utf8") as ofp:
+        ofp.write(DOC)
+    outdir = os.path.join(tmpdirname, "out")
+    trace_path = os.path.join(tmpdirname, "trace.json")
+    batch_twine(find_documents([indir]), outdir, jobs=2, log=StringIO(),
+                trace=trace_path)
+
+    assert os.path.exists(os.path.join(outdir, "a.trace.json"))
+    with open(trace_path, encoding="utf8") as ifp:
+      trace = json.load(ifp)
+
+  process_names = {record["pid"]: record["args"]["name"]
+                   for record in trace["traceEvents"]
+                   if record["name"] == "process_name"}
+  assert sorted(process_names) == [1, 2]
+  assert sorted(os.path.basename(name) for name in process_names.values()) == \
+         ["a.pmd", "b.pmd"]
+  assert _spans(trace).count("exec chunk 1") == 2
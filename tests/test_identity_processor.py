@@ -3,7 +3,10 @@
 test the IdentityProcessor
 """
 
-from io import StringIO
+import os
+
+from io import BytesIO, StringIO
+from tempfile import TemporaryDirectory
 from typing import (
     List,
     cast
@@ -12,31 +15,23 @@ from typing import (
 from hypothesis import given, strategies as st
 
 from custom_hypothesis_strats import doc_chunks, code_chunks
+from sample_docs import SIMPLE_DOC
 
-from pytwine.core import Chunk, DocChunk, CodeChunk, merge_docchunks
+from pytwine.core import (Chunk, ChunkTable, DocChunk, CodeChunk,
+                          LazyDocChunk, merge_docchunks)
 from pytwine.parsers import MarkdownParser
 from pytwine.processors import IdentityProcessor
 
 def test_simple_doc():
   "test a simple document"
 
-  mydoc = """\
-```python .important foo=bar
-print("aaa")
-```
-bar
-```python
-print(2)
-```
-"""
-
-  parser = MarkdownParser(string=mydoc)
+  parser = MarkdownParser(string=SIMPLE_DOC)
   chunks = parser.parse()
   sink = StringIO()
   processor = IdentityProcessor(sink)
   processor.twine(chunks)
 
-  assert sink.getvalue() == mydoc, "should reverse parser"
+  assert sink.getvalue() == SIMPLE_DOC, "should reverse parser"
 
 
 # true if all are docs
@@ -146,3 +141,72 @@ def test_IdentityProcessor_roundtrips_chunks(chunks):
 
   assert normalized_chunks == fixed_new_chunks
 
+
+def test_lazy_doc_chunks_written_without_decoding():
+  """doc chunks from a memory-mapped file are copied to a
+  UTF-8 sink without being decoded"""
+
+  mydoc = "début\n```python\nprint(2)\n```\nfin\n"
+
+  with TemporaryDirectory() as tmpdirname:
+    infile_path   = os.path.join(tmpdirname, "doc.pmd")
+    outfile_path  = os.path.join(tmpdirname, "doc.md")
+    with open(infile_path, "w", encoding="utf8") as ofp:
+      ofp.write(mydoc)
+
+    chunks = MarkdownParser(path=infile_path).parse()
+    with open(outfile_path, "w", encoding="utf8") as ofp:
+      IdentityProcessor(ofp).twine(chunks)
+
+    assert not chunks[0].decoded and not chunks[2].decoded
+    with open(outfile_path, "r", encoding="utf8") as ifp:
+      assert ifp.read() == mydoc
+
+    merged = merge_docchunks([chunks[0], chunks[2]])
+    assert merged.contents == "début\nfin\n"
+    assert isinstance(chunks[0], LazyDocChunk)
+    buffer = chunks[0].buffer
+    adjacent = merge_docchunks([LazyDocChunk(buffer, 0, 4,
+                                              number=1, startLineNum=1),
+                                LazyDocChunk(buffer, 4, 7,
+                                              number=2, startLineNum=1)])
+    assert isinstance(adjacent, LazyDocChunk)
+    assert not adjacent.decoded
+    assert adjacent.contents == "début\n"
+
+@given(st.lists( st.one_of(doc_chunks(), code_chunks()) ))
+def test_ChunkTable_holds_chunks(chunks):
+  """
+  A ChunkTable gives back the chunks put into it, and
+  processing a table gives the same document as processing a list.
+  """
+
+  table = ChunkTable(chunks)
+  assert len(table) == len(chunks)
+  assert table.to_chunks() == chunks
+  assert list(table) == chunks
+  assert chunksToDoc(table) == chunksToDoc(chunks)
+
+def test_ChunkTable_interns_fences():
+  "identical fence lines are stored once, and views have no __dict__"
+
+  mydoc = "```python\nprint(1)\n```\nfoo\n```python\nprint(2)\n```\n" * 100
+  table = MarkdownParser(string=mydoc).parse_table()
+
+  assert len(table) == 300
+  assert table.fence_lines == ["```python\n", "```\n"]
+  assert not hasattr(table[0], "__dict__")
+  assert table[-1].block_start_line == "```python\n"
+  assert table[-1].number == 200
+  assert list(table) == MarkdownParser(string=mydoc).parse()
+
+
+def test_binary_buffer_roundtrips():
+  "a parsed buffer is written back to a binary sink unchanged"
+
+  doc = ("intro é\r\n```python .x\r\nprint(1)\r\n```\r\n"
+         "outro\r").encode("utf-8")
+  for buffer in [doc, bytearray(doc), memoryview(doc)]:
+    sink = BytesIO()
+    IdentityProcessor(sink).twine(MarkdownParser(buffer=buffer).iter_chunks())
+    assert sink.getvalue() == doc
@@ -0,0 +1,168 @@
+"""
+test limits on the resources code chunks use, in pytwine.limits
+"""
+
+import signal
+import sys
+import threading
+
+from io import StringIO
+
+import pytest
+
+from pytwine.core       import TwineExitStatus
+from pytwine.limits     import ResourceLimits
+from pytwine.parsers    import MarkdownParser
+from pytwine.async_processor import AsyncPythonProcessor
+from pytwine.processors import PythonProcessor
+
+try:
+  import resource
+except ImportError:
+  resource = None # type: ignore
+
+# limits can only be enforced on POSIX systems
+pytestmark = pytest.mark.skipif(
+  resource is None or not hasattr(signal, "setitimer"),
+  reason="resource limits need a POSIX system")
+
+def _twine(mydoc : str, processor_class=PythonProcessor, **kwargs):
+  "run mydoc, returning the status, output and log"
+
+  sink = StringIO()
+  log = StringIO()
+  res = processor_class(sink, log=log, **kwargs).twine(
+    MarkdownParser(string=mydoc).parse())
+  return res, sink.getvalue(), log.getvalue()
+
+
+SLOW_DOC = """\
+```python timeout=0.2
+import time
+print("started")
+try:
+  time.sleep(10)
+except Exception:
+  print("caught")
+```
+after
+```python
+print("next")
+```
+"""
+
+def test_chunk_timeout_continues():
+  "a chunk over its own timeout is aborted, and the document continues"
+
+  res, output, log = _twine(SLOW_DOC)
+
+  assert res == TwineExitStatus.RESOURCE_LIMIT_EXCEEDED
+  assert output == "started\nafter\nnext\n"
+  assert "exceeded its wall-clock time limit of 0.2s" in log
+
+
+def test_chunk_timeout_stops():
+  "with the 'stop' policy, nothing after the aborted chunk is processed"
+
+  res, output, log = _twine(SLOW_DOC, limit_policy="stop")
+
+  assert res == TwineExitStatus.RESOURCE_LIMIT_EXCEEDED
+  assert output == "started\n"
+  assert "stopping" in log
+
+
+@pytest.mark.skipif(sys.version_info < (3, 8),
+                    reason="top-level await requires Python 3.8")
+def test_async_chunk_timeout_cancels_chunk():
+  "an async chunk over its timeout doesn't resume in later chunks"
+
+  mydoc = """\
+```python timeout=0.2
+import asyncio
+await asyncio.sleep(0.5)
+print("aborted chunk resumed!")
+```
+```python
+await asyncio.sleep(1)
+print("next")
+```
+"""
+
+  res, output, _ = _twine(mydoc, processor_class=AsyncPythonProcessor)
+
+  assert res == TwineExitStatus.RESOURCE_LIMIT_EXCEEDED
+  assert output == "next\n"
+
+
+def test_document_cpu_limit_stops():
+  "exceeding the document's CPU time limit stops processing"
+
+  mydoc = """\
+```python
+print("spinning")
+while True:
+  pass
+```
+after
+"""
+
+  res, output, log = _twine(mydoc, limits=ResourceLimits(cpu_time=0.2))
+
+  assert res == TwineExitStatus.RESOURCE_LIMIT_EXCEEDED
+  assert output == "spinning\n"
+  assert "exceeded the document's CPU time limit of 0.2s" in log
+
+
+def test_memory_limit():
+  "a chunk allocating past its memory limit is aborted"
+
+  mydoc = """\
+```python memory-limit=8G
+data = bytearray(16 * 2**30)
+```
+```python
+print("still here")
+```
+"""
+
+  res, output, log = _twine(mydoc)
+
+  assert res == TwineExitStatus.RESOURCE_LIMIT_EXCEEDED
+  assert output == "still here\n"
+  assert "memory limit" in log
+
+
+def test_memory_limit_needs_main_thread():
+  "memory limits, which apply to the whole process, can't be set from other threads"
+
+  errors = []
+
+  def run():
+    try:
+      _twine("```python memory-limit=8G\nprint(1)\n```\n")
+    except NotImplementedError as ex:
+      errors.append(ex)
+
+  thread = threading.Thread(target=run)
+  thread.start()
+  thread.join()
+
+  assert len(errors) == 1
+  assert "main thread" in str(errors[0])
+
+
+def test_bad_limit_option_ignored():
+  "unparseable limit options are reported and ignored"
+
+  res, output, log = _twine("```python timeout=soon\nprint(1)\n```\n")
+
+  assert res == TwineExitStatus.SUCCESS
+  assert output == "1\n"
+  assert "bad timeout option: 'soon'" in log
+
+
+def test_limits_rejected_with_concurrent_chunks():
+  "document limits can't be enforced across threads"
+
+  with pytest.raises(ValueError):
+    PythonProcessor(StringIO(), chunk_jobs=2, limits=ResourceLimits(wall_time=1))
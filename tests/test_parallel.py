@@ -0,0 +1,39 @@
+# pylint: disable=protected-access
+
+"""
+test parsing documents in parallel, in pytwine.parallel
+"""
+
+from hypothesis import given, strategies as st
+
+from pytwine.parallel import (_build_chunks, _scan_segment, _split_segments,
+                              _stitch, parse_parallel)
+from pytwine.parsers import MarkdownParser
+
+def _parse_in_segments(doc : str, num_segments : int):
+  """do what parse_parallel does, but in this process"""
+
+  scans = [_scan_segment(segment)
+           for segment in _split_segments(doc, num_segments)]
+  return _build_chunks(doc.splitlines(keepends=True), _stitch(scans))
+
+@given(st.lists(st.sampled_from(["```python\n", "```\n", "````python\n",
+                                 "````\n", "~~~python\n", "~~~\n", " ~~~ \n",
+                                 "x = 1\n", "text\n", "\n", " \n", "\r\n"])),
+       st.integers(min_value=1, max_value=8))
+def test_segmented_parse_matches_sequential(pieces, num_segments):
+  """however the document is split, the chunks are the same as
+  from a sequential parse"""
+
+  doc = "".join(pieces)
+  expected = MarkdownParser(string=doc).parse()
+  assert _parse_in_segments(doc, num_segments) == expected
+
+def test_process_pool_parse():
+  "parsing with a process pool gives the same chunks"
+
+  doc = ("intro\n````python\nx = '''\n```\n'''\n````\n" +
+         "text\n```python\nprint(1)\n```\n" * 200 +
+         "~~~python\nunterminated\n")
+  chunks = parse_parallel(doc, processes=3, min_segment_size=1)
+  assert chunks == MarkdownParser(string=doc).parse()
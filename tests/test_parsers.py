@@ -1,10 +1,22 @@
-# pylint: disable=protected-access, no-self-use
+# pylint: disable=protected-access
 
 """
 test the pytwine.parsers classes.
 """
 
-from pytwine.parsers import MarkdownParser, Chunk, CodeChunk
+import os
+import re
+import time
+
+from io import StringIO
+from tempfile import TemporaryDirectory
+
+import pytest
+
+from hypothesis import given, settings, strategies as st
+
+from pytwine.core import DocChunk, LazyContents
+from pytwine.parsers import IncrementalParser, MarkdownParser, Chunk, CodeChunk
 
 #def raiseChunks(chunks):
 #  mystr = str(chunks)
@@ -403,3 +415,265 @@ print(2)
 
   assert chunks[0].block_start_line == "```python .important foo=bar\n"
 
+
+class TestStreaming:
+  """chunks can be produced from a file, one at a time."""
+
+  def test_chunks_yielded_before_file_fully_read(self):
+    "iter_chunks reads no further than the end of the chunk it yields"
+
+    doc_lines = ["foo\n", "```python\n", "print()\n", "```\n", "bar\n", "baz\n"]
+    lines_read = []
+
+    def infile():
+      for line in doc_lines:
+        lines_read.append(line)
+        yield line
+
+    parser = MarkdownParser(file=infile())
+    chunks = parser.iter_chunks()
+
+    first = next(chunks)
+    assert first == Chunk(chunkType='doc', contents="foo\n",
+                          number=1, startLineNum=1)
+    assert len(lines_read) == 2
+
+    second = next(chunks)
+    assert second.contents == "print()\n"
+    assert len(lines_read) == 4
+
+    rest = list(chunks)
+    assert len(rest) == 1 and rest[0].contents == "bar\nbaz\n"
+
+  @given(st.lists(st.one_of(st.text(),
+                            st.sampled_from(["```python\n", "```\n",
+                                             "~~~python\r\n", "~~~\r",
+                                             "\r", "\n", "\x0c"]))))
+  def test_file_and_string_parses_agree(self, pieces):
+    "parsing a file gives the same chunks as parsing its contents"
+
+    doc = "".join(pieces)
+    from_string = MarkdownParser(string=doc).parse()
+    from_file = MarkdownParser(file=StringIO(doc, newline='')).parse()
+    assert from_file == from_string
+
+class TestFenceScanner:
+  """the FenceScanner recognizes exactly what the
+  ``codeblock_begin`` regex does, in linear time.
+  """
+
+  @given(st.sampled_from(["```", "~~~", "````", "``", "~`~"]),
+         st.text(alphabet=list("`~ \t\n\r\x0c }{.;,=pythonx\"")))
+  def test_agrees_with_codeblock_begin(self, fence, rest):
+    "match_start gives the same groups as the regex"
+
+    parser = MarkdownParser(string="")
+    for line in [fence + rest, fence + "python" + rest,
+                 fence + " .python" + rest]:
+      expected = re.match(parser.codeblock_begin, line)
+      actual = parser._scanner.match_start(line)
+      if expected is None:
+        assert actual is None, line
+      else:
+        assert actual == expected.groups(), line
+
+  def test_custom_codeblock_begin_used(self):
+    "a parser with its own codeblock_begin pattern is matched with it"
+
+    class PyParser(MarkdownParser):
+      "recognizes ``py`` blocks, fenced with plus signs"
+
+      def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.codeblock_begin = r"^(\+{3,})\s*py\s*(.*?)\s*$"
+
+    doc = "intro\n+++ py .important\nprint(1)\n+++\n```python\nx\n```\n"
+    for parser in [PyParser(string=doc), PyParser(buffer=doc.encode())]:
+      chunks = parser.parse()
+      assert [chunk.chunkType for chunk in chunks] == ["doc", "code", "doc"]
+      assert chunks[1].contents == "print(1)\n"
+      assert chunks[1].options.classes == ("important",)
+      assert chunks[2].contents == "```python\nx\n```\n"
+
+  def test_adversarial_lines_parse_quickly(self):
+    """long whitespace runs in fence lines, and many unterminated
+    fences, don't cause quadratic behaviour.
+    """
+
+    long_start = "```python a" + " " * 500_000 + "b\n"
+    doc = (long_start + "~~~python\n" * 5000 + "print()\n" +
+           "```" + " " * 500_000 + "x\n" + "```\n" + "done\n")
+
+    start = time.perf_counter()
+    chunks = MarkdownParser(string=doc).parse()
+    assert time.perf_counter() - start < 10
+
+    assert len(chunks) == 2
+    assert chunks[0].block_start_line == long_start
+    assert chunks[0].block_end_line == "```\n"
+    assert chunks[1].contents == "done\n"
+
+class TestMemoryMapped:
+  """parsing a memory-mapped file gives lazy chunks"""
+
+  @given(st.lists(st.one_of(st.text(alphabet=st.characters(
+                                blacklist_categories=("Cs",),
+                                blacklist_characters="\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029")),
+                            st.sampled_from(["```python\n", "```\n", " ```\n",
+                                             "~~~python\n", "~~~\n", "\n",
+                                             " \n"]))))
+  def test_mmap_and_string_parses_agree(self, pieces):
+    "lazy chunks equal the chunks parsed from a string"
+
+    doc = "".join(pieces)
+    with TemporaryDirectory() as tmpdirname:
+      infile_path = os.path.join(tmpdirname, "doc.pmd")
+      with open(infile_path, "w", encoding="utf8", newline="") as ofp:
+        ofp.write(doc)
+
+      from_path = MarkdownParser(path=infile_path).parse()
+      from_string = MarkdownParser(string=doc).parse()
+      assert from_path == from_string
+
+  def test_contents_are_decoded_lazily(self):
+    "chunk contents are only decoded when read, and keep line endings"
+
+    doc = "foo\r\n```python\r\nprint()\r\n```\r\nbar\r\n"
+    with TemporaryDirectory() as tmpdirname:
+      infile_path = os.path.join(tmpdirname, "doc.pmd")
+      with open(infile_path, "wb") as ofp:
+        ofp.write(doc.encode("utf8"))
+
+      chunks = MarkdownParser(path=infile_path).parse()
+      assert [c.chunkType for c in chunks] == ["doc", "code", "doc"]
+      assert all(isinstance(c, LazyContents) for c in chunks)
+      assert chunks[0]._text is None
+
+      assert chunks[1].contents == "print()\r\n"
+      assert chunks[1].block_start_line == "```python\r\n"
+      assert chunks[2] == DocChunk(contents="bar\r\n", number=2, startLineNum=5)
+
+  def test_empty_file(self):
+    "an empty file can be parsed"
+
+    with TemporaryDirectory() as tmpdirname:
+      infile_path = os.path.join(tmpdirname, "doc.pmd")
+      with open(infile_path, "wb"):
+        pass
+      assert not MarkdownParser(path=infile_path).parse()
+
+class TestIncrementalParser:
+  """editing a document re-parses only part of it"""
+
+  @settings(max_examples=300)
+  @given(st.lists(st.sampled_from(["```python\n", "```\n", "~~~python\n",
+                                   "~~~\n", "x = 1\n", "text\n", "\n", " \n",
+                                   "\r", "\n\r"])),
+         st.integers(min_value=0), st.integers(min_value=0),
+         st.lists(st.sampled_from(["```python\n", "```\n", "~~~\n",
+                                   "y = 2\n", "\n", "more", "\r"])))
+  def test_edits_match_full_parse(self, pieces, first, length, replacement):
+    "after an edit, the chunks are the same as parsing from scratch"
+
+    doc = "".join(pieces)
+    inc = IncrementalParser(doc)
+    old_chunks = list(inc.chunks)
+    num_lines = len(inc.lines)
+    first_line = 1 + first % (num_lines + 1)
+    last_line = min(first_line - 1 + length % 3, num_lines)
+
+    result = inc.edit(first_line, last_line, "".join(replacement))
+    expected = MarkdownParser(string=inc.text).parse()
+    assert result.chunks == expected
+
+    # unchanged chunks are the old objects, or equal to them
+    # apart from renumbering.
+    for idx, chunk in enumerate(result.chunks):
+      if idx not in result.changed:
+        assert any(chunk is old or
+                   (chunk.chunkType, chunk.contents) == (old.chunkType, old.contents)
+                   for old in old_chunks)
+
+  def test_edit_reuses_chunks(self):
+    "chunks before and after an edit are reused"
+
+    doc = "intro\n" + "```python\nx = 1\n```\ntext\n" * 50
+    inc = IncrementalParser(doc)
+    old_chunks = list(inc.chunks)
+
+    result = inc.edit(11, 11, "x = 2\n")
+    assert result.changed == [5]
+    assert result.chunks[5].contents == "x = 2\n"
+    assert all(new is old for idx, (new, old)
+               in enumerate(zip(result.chunks, old_chunks)) if idx != 5)
+
+    result = inc.edit(11, 10, "y = 3\n")
+    assert result.changed == [5]
+    assert result.chunks[5].contents == "y = 3\nx = 2\n"
+    assert result.chunks[4] is old_chunks[4]
+    assert result.chunks[-1].startLineNum == old_chunks[-1].startLineNum + 1
+    assert result.chunks == MarkdownParser(string=inc.text).parse()
+
+
+class TestBlockOptions:
+  "code block options are parsed once, and shared"
+
+  doc = ("intro\n"
+         "```python .important #first startLine=101 animal=\"spotted lynx\"\n"
+         "x = 1\n"
+         "```\n"
+         "middle\n"
+         "```python .important #first startLine=101 animal=\"spotted lynx\"\n"
+         "y = 2\n"
+         "```\n"
+         "~~~python {.quiet}\n"
+         "z = 3\n"
+         "~~~\n")
+
+  def test_options_parsed(self):
+    "options come from the start line"
+
+    code = [chunk for chunk in MarkdownParser(string=self.doc).parse()
+            if chunk.chunkType == "code"]
+    assert code[0].options.classes == ("important",)
+    assert code[0].options.id == "first"
+    assert dict(code[0].options) == {"startLine": "101",
+                                     "animal": "spotted lynx"}
+    assert code[2].options.classes == ("quiet",)
+    assert len(code[2].options) == 0
+
+  def test_options_shared_and_immutable(self):
+    "identical start lines share one immutable options object"
+
+    for chunks in [MarkdownParser(string=self.doc).parse(),
+                   list(MarkdownParser(string=self.doc).parse_table())]:
+      code = [chunk for chunk in chunks if chunk.chunkType == "code"]
+      assert code[0].options is code[1].options
+      with pytest.raises(TypeError):
+        code[0].options["startLine"] = "1" # type: ignore
+      with pytest.raises(AttributeError):
+        code[0].options.classes = () # type: ignore
+
+  def test_options_from_file(self):
+    "memory-mapped parses give the same options"
+
+    with TemporaryDirectory() as tmpdir:
+      path = os.path.join(tmpdir, "doc.md")
+      with open(path, "w", encoding="utf8") as ofp:
+        ofp.write(self.doc)
+      lazy = MarkdownParser(path=path).parse()
+    eager = MarkdownParser(string=self.doc).parse()
+    assert [chunk.options for chunk in lazy if chunk.chunkType == "code"] == \
+           [chunk.options for chunk in eager if chunk.chunkType == "code"]
+
+  def test_options_of_constructed_chunks(self):
+    "chunks built without options parse them on demand"
+
+    chunk = CodeChunk(contents="x\n", number=1, startLineNum=2,
+                      block_start_line="```python startLine=5\n",
+                      block_end_line="```\n")
+    assert chunk.options["startLine"] == "5"
+    parsed = MarkdownParser(string="```python startLine=5\nx\n```\n").parse()[0]
+    assert chunk.options is parsed.options
+    assert (chunk.contents, chunk.block_start_line) == \
+           (parsed.contents, parsed.block_start_line)
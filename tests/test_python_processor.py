@@ -3,58 +3,49 @@
 test the PythonProcessor class
 """
 
+import os
+import pstats
+import sys
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep
+
+import pytest
 
+from sample_docs import BAD_DOC, BAD_DOC_OUTPUT, SIMPLE_DOC, SIMPLE_DOC_OUTPUT
+
+from pytwine.caching import CheckpointStore, OutputCache
+from pytwine.core import TwineExitStatus
 from pytwine.parsers import MarkdownParser
-from pytwine.processors import PythonProcessor
+from pytwine.async_processor import AsyncPythonProcessor
+from pytwine.processors import ProcessorOptions, PythonProcessor
+from pytwine.profiling import ProfileReport
 
 def test_simple_doc():
   "simple doc containing a code block"
 
-  mydoc = """\
-```python .important foo=bar
-print("aaa")
-```
-bar
-```python
-print(2)
-```
-"""
-
-  expected = 'aaa\nbar\n2\n'
-
-  parser = MarkdownParser(string=mydoc)
+  parser = MarkdownParser(string=SIMPLE_DOC)
   chunks = parser.parse()
   sink = StringIO()
   processor = PythonProcessor(sink)
   processor.twine(chunks)
 
-  assert sink.getvalue() == expected, "should process python"
+  assert sink.getvalue() == SIMPLE_DOC_OUTPUT, "should process python"
 
 def test_bad_doc():
   """test with an uncompilable code block -
   should be omitted"""
 
-  mydoc = """\
-```python .important foo=bar
-import
-print(
-```
-bar
-```python
-print(2)
-```
-"""
-
-  expected = 'bar\n2\n'
-
-  parser = MarkdownParser(string=mydoc)
+  parser = MarkdownParser(string=BAD_DOC)
   chunks = parser.parse()
   sink = StringIO()
   processor = PythonProcessor(sink)
   processor.twine(chunks)
 
-  assert sink.getvalue() == expected, "should process python"
+  assert sink.getvalue() == BAD_DOC_OUTPUT, "should process python"
 
 
 
@@ -88,3 +79,672 @@ print(2)
   assert sink.getvalue() == expected, "should process python"
 
 
+
+def test_chunk_table_doc():
+  "a ChunkTable can be processed directly"
+
+  mydoc = """\
+```python
+x = 3
+```
+bar
+```python
+print(x * 2)
+```
+"""
+
+  table = MarkdownParser(string=mydoc).parse_table()
+  sink = StringIO()
+  processor = PythonProcessor(sink)
+  processor.twine(table)
+
+  assert sink.getvalue() == 'bar\n6\n'
+
+
+def test_output_cache_replays_prefix():
+  """with an output cache, an unchanged prefix is replayed, and
+  execution resumes at the first changed chunk"""
+
+  template = """\
+```python
+counter = globals().get("counter", 0) + 1
+print("first", counter)
+```
+```python
+print("second", counter)
+```
+```python
+print("third", {})
+```
+"""
+
+  with TemporaryDirectory() as cache_dir:
+    outputs = []
+    caches = []
+    for third in ["counter", "counter", "counter * 10"]:
+      sink = StringIO()
+      cache = OutputCache(cache_dir)
+      processor = PythonProcessor(sink, log=StringIO(), output_cache=cache)
+      processor.twine(MarkdownParser(string=template.format(third)).parse())
+      outputs.append(sink.getvalue())
+      caches.append(cache)
+
+    assert outputs == ["first 1\nsecond 1\nthird 1\n",
+                       "first 1\nsecond 1\nthird 1\n",
+                       "first 1\nsecond 1\nthird 10\n"]
+
+    # first run executes all, second none, third re-runs the
+    # first two silently before executing the changed chunk
+    assert [(c.hits, c.misses) for c in caches] == [(0, 3), (3, 0), (2, 1)]
+    assert caches[1].bytes_replayed == len(outputs[1])
+
+
+def test_output_cache_skips_failed_chunks():
+  "outputs of chunks that fail to compile aren't cached"
+
+  mydoc = """\
+```python
+print(
+```
+```python
+print(2)
+```
+"""
+
+  with TemporaryDirectory() as cache_dir:
+    for _ in range(2):
+      cache = OutputCache(cache_dir)
+      processor = PythonProcessor(StringIO(), log=StringIO(),
+                                  output_cache=cache)
+      status = processor.twine(MarkdownParser(string=mydoc).parse())
+      assert status.value == 2
+      assert cache.hits == 0
+
+
+CHECKPOINT_DOC = """\
+```python
+import os
+import time
+runs_path = os.path.join({tmpdir!r}, "runs.txt")
+```
+```python .checkpoint
+with open(runs_path, "a") as ofp:
+  ofp.write("load\\n")
+data = list(range(5)){extra}
+```
+```python
+with open(runs_path, "a") as ofp:
+  ofp.write("summary\\n")
+total = sum(data)
+```
+```python
+print(total * {factor})
+```
+"""
+
+def _run_checkpointed(tmpdir : str, extra : str = ""):
+  """twine CHECKPOINT_DOC twice, changing the last chunk; return
+  outputs, the logs and the chunks run"""
+
+  outputs = []
+  log = StringIO()
+  for factor in [1, 2]:
+    sink = StringIO()
+    processor = PythonProcessor(
+      sink, log=log,
+      output_cache=OutputCache(os.path.join(tmpdir, "outputs")),
+      checkpoint_store=CheckpointStore(os.path.join(tmpdir, "ckpt")))
+    doc = CHECKPOINT_DOC.format(tmpdir=tmpdir, factor=factor, extra=extra)
+    processor.twine(MarkdownParser(string=doc).parse())
+    outputs.append(sink.getvalue())
+
+  with open(os.path.join(tmpdir, "runs.txt"), encoding="utf8") as ifp:
+    runs = ifp.read().split()
+  return outputs, log.getvalue(), runs
+
+def test_checkpoint_restored_before_changed_chunk():
+  """with checkpoints, only chunks after the latest checkpoint before
+  the first changed chunk are re-executed"""
+
+  with TemporaryDirectory() as tmpdir:
+    outputs, log, runs = _run_checkpointed(tmpdir)
+
+  assert outputs == ["10\n", "20\n"]
+  assert "Restored checkpoint taken after chunk 2" in log
+  # the "load" chunk isn't re-run the second time
+  assert runs == ["load", "summary", "summary"]
+
+def test_unpicklable_globals_skipped():
+  "unpicklable globals are reported, and left out of checkpoints"
+
+  with TemporaryDirectory() as tmpdir:
+    outputs, log, runs = _run_checkpointed(
+      tmpdir, extra="\nsquare = lambda x: x * x")
+
+  assert outputs == ["10\n", "20\n"]
+  assert "skipped unpicklable globals ofp, square" in log
+  assert "(without unpicklable globals: ofp, square)" in log
+  assert runs == ["load", "summary", "summary"]
+
+
+def test_checkpoint_missing_used_global_not_restored():
+  """a checkpoint that left out a global used later isn't restored:
+  the chunks before it are re-run instead"""
+
+  log = StringIO()
+  outputs = []
+  with TemporaryDirectory() as tmpdir:
+    for addend in ["", " + 1"]:
+      sink = StringIO()
+      processor = PythonProcessor(
+        sink, log=log,
+        output_cache=OutputCache(os.path.join(tmpdir, "outputs")),
+        checkpoint_store=CheckpointStore(os.path.join(tmpdir, "ckpt")))
+      doc = ("```python .checkpoint\ndef f():\n  return 41\n```\n"
+             f"```python\nprint(f(){addend})\n```\n")
+      status = processor.twine(MarkdownParser(string=doc).parse())
+      assert status.value is None
+      outputs.append(sink.getvalue())
+
+  assert outputs == ["41\n", "42\n"]
+  log_text = log.getvalue()
+  assert "Not restoring checkpoint taken after chunk 1" in log_text
+  assert "Restored checkpoint" not in log_text
+  assert "Re-running 1 cached chunks" in log_text
+
+def test_concurrent_chunks():
+  """independent chunks run concurrently, dependent ones in order,
+  and output is in document order"""
+
+  mydoc = """\
+```python
+a_start = perf_counter()
+sleep(0.5)
+a = 1
+a_end = perf_counter()
+print("a")
+```
+```python
+b_start = perf_counter()
+sleep(0.5)
+b = 2
+b_end = perf_counter()
+print("b")
+```
+between
+```python
+c_start = perf_counter()
+sleep(0.5)
+c = 3
+c_end = perf_counter()
+print("c")
+```
+```python
+print(a + b + c)
+```
+"""
+
+  sink = StringIO()
+  processor = PythonProcessor(sink, log=StringIO(), chunk_jobs=3)
+  # (calling functions imported from a module counts as changing its
+  # state, which would serialise the chunks)
+  processor.globals.update(perf_counter=perf_counter, sleep=sleep)
+  status = processor.twine(MarkdownParser(string=mydoc).parse())
+
+  assert status.value is None
+  assert sink.getvalue() == "a\nb\nbetween\nc\n6\n"
+  # all three sleeping chunks were running at once
+  names = processor.globals
+  assert max(names[f"{name}_start"] for name in "abc") < \
+         min(names[f"{name}_end"] for name in "abc")
+
+
+def test_concurrent_chunks_match_sequential():
+  "running chunks concurrently gives the same output as sequentially"
+
+  mydoc = "".join(f"""\
+```python
+x{i} = [{i}] * {i}
+```
+```python
+x{i}.append(len(x{i}))
+print(x{i}, sum(x{i}))
+```
+text {i}
+""" for i in range(20)) + """\
+```python
+print(
+```
+```python
+print(sum(len(v) for k, v in globals().items() if k.startswith("x")))
+```
+"""
+
+  outputs = []
+  statuses = []
+  for jobs in [1, 4]:
+    sink = StringIO()
+    processor = PythonProcessor(sink, log=StringIO(), chunk_jobs=jobs)
+    statuses.append(processor.twine(MarkdownParser(string=mydoc).parse()))
+    outputs.append(sink.getvalue())
+
+  assert outputs[0] == outputs[1]
+  assert statuses[0] == statuses[1]
+
+
+@pytest.mark.parametrize("sources", [
+  ["lst = []", "alias = lst", "sleep(0.2)\nalias.append(1)", "print(lst)"],
+  ["from random import seed, random", "sleep(0.2)\nseed(0)",
+   "print(random())"],
+])
+def test_concurrent_chunks_sharing_state_match_sequential(sources):
+  "chunks sharing objects or module state run in document order"
+
+  mydoc = "".join(f"```python\n{source}\n```\n" for source in sources)
+
+  outputs = []
+  for jobs in [1, 4]:
+    sink = StringIO()
+    processor = PythonProcessor(sink, log=StringIO(), chunk_jobs=jobs)
+    processor.globals["sleep"] = sleep
+    processor.twine(MarkdownParser(string=mydoc).parse())
+    outputs.append(sink.getvalue())
+
+  assert outputs[0] == outputs[1]
+
+class _RecordingSink(StringIO):
+  "a sink recording what had been written each time it's flushed"
+
+  def __init__(self):
+    super().__init__()
+    self.flushes = []
+
+  def flush(self):
+    self.flushes.append(self.getvalue())
+
+
+def test_streamed_output_written_before_chunk_ends():
+  "with streaming, output reaches the sink while the chunk is still running"
+
+  mydoc = """\
+intro
+```python
+print("first")
+seen = sink.getvalue()
+print("second")
+```
+"""
+
+  sink = _RecordingSink()
+  processor = PythonProcessor(sink, log=StringIO(), stream_output=True)
+  processor.globals["sink"] = sink
+  processor.twine(MarkdownParser(string=mydoc).parse())
+
+  assert processor.globals["seen"] == "intro\nfirst\n"
+  assert sink.getvalue() == "intro\nfirst\nsecond\n"
+  # the doc chunk was flushed before the code chunk started running
+  assert sink.flushes[0] == "intro\n"
+
+
+def test_options_overridden_by_keywords():
+  "keyword arguments override the fields of a processor's options"
+
+  options = ProcessorOptions(chunk_jobs=2, flush_size=10)
+  processor = PythonProcessor(StringIO(), log=StringIO(), options=options,
+                              chunk_jobs=1, stream_output=True)
+
+  assert processor.options == options._replace(
+    chunk_jobs=1, stream_output=True, pstats_prefix="pytwine")
+  with pytest.raises(ValueError):
+    PythonProcessor(StringIO(), options=options, stream_output=True)
+
+
+def test_streamed_output_matches_captured():
+  "streaming output, with or without an output cache, gives the same output"
+
+  mydoc = """\
+```python
+for i in range(100):
+  print(i)
+```
+text
+```python
+print(
+```
+"""
+
+  outputs = []
+  for kwargs in [{}, {"stream_output": True},
+                 {"stream_output": True, "flush_size": 64}]:
+    sink = StringIO()
+    PythonProcessor(sink, log=StringIO(), **kwargs).twine(
+      MarkdownParser(string=mydoc).parse())
+    outputs.append(sink.getvalue())
+  with TemporaryDirectory() as tmpdir:
+    for _ in range(2):
+      sink = StringIO()
+      PythonProcessor(sink, log=StringIO(), stream_output=True,
+                      output_cache=OutputCache(tmpdir)).twine(
+        MarkdownParser(string=mydoc).parse())
+      outputs.append(sink.getvalue())
+
+  assert all(output == outputs[0] for output in outputs)
+
+
+class _BlockSink(StringIO):
+  "a sink recording the size of each write"
+
+  def __init__(self):
+    super().__init__()
+    self.sizes = []
+
+  def write(self, s):
+    self.sizes.append(len(s))
+    return super().write(s)
+
+
+class _SmallSpoolBlocks(PythonProcessor):
+  "a processor copying spooled output in small blocks"
+
+  SPOOL_BLOCK_SIZE = 100
+
+
+def test_spooled_output_matches_captured():
+  "spooling output, in memory or spilled to disk, gives the same output"
+
+  mydoc = """\
+```python
+for i in range(100):
+  print(i, "\u00e9")
+```
+text
+```python
+print("short")
+```
+"""
+
+  expected = StringIO()
+  PythonProcessor(expected, log=StringIO()).twine(
+    MarkdownParser(string=mydoc).parse())
+
+  for spool_size in [10, 10000]:
+    sink = _BlockSink()
+    processor = _SmallSpoolBlocks(sink, log=StringIO(), spool_size=spool_size)
+    processor.twine(MarkdownParser(string=mydoc).parse())
+    assert sink.getvalue() == expected.getvalue()
+    # spilled output is copied in blocks
+    assert max(sink.sizes) == (100 if spool_size == 10 else 490)
+
+  with TemporaryDirectory() as tmpdir:
+    for _ in range(2):
+      sink = StringIO()
+      PythonProcessor(sink, log=StringIO(), spool_size=10,
+                      output_cache=OutputCache(tmpdir)).twine(
+        MarkdownParser(string=mydoc).parse())
+      assert sink.getvalue() == expected.getvalue()
+
+
+def _threaded_doc(num : int) -> str:
+  "a document whose output would interleave with others' if mixed"
+
+  return f"""\
+doc {num}
+```python
+import time
+for i in range(50):
+  print({num}, i)
+  time.sleep(0)
+```
+text
+```python
+print("done", {num})
+```
+"""
+
+@pytest.mark.parametrize("processor_class, kwargs", [
+  (PythonProcessor, {}),
+  (PythonProcessor, {"stream_output": True}),
+  (PythonProcessor, {"spool_size": 64}),
+  (PythonProcessor, {"chunk_jobs": 2}),
+  (AsyncPythonProcessor, {}),
+])
+def test_documents_in_threads_match_serial(processor_class, kwargs):
+  "documents processed in threads at once each get just their own output"
+
+  if processor_class is AsyncPythonProcessor and sys.version_info < (3, 8):
+    pytest.skip("top-level await requires Python 3.8")
+
+  num_docs = 8
+  docs = [_threaded_doc(num) for num in range(num_docs)]
+
+  def run(doc : str) -> str:
+    sink = StringIO()
+    processor_class(sink, log=StringIO(), **kwargs).twine(
+      MarkdownParser(string=doc).parse())
+    return sink.getvalue()
+
+  serial = [run(doc) for doc in docs]
+  barrier = threading.Barrier(num_docs)
+
+  def run_together(doc : str) -> str:
+    barrier.wait()
+    return run(doc)
+
+  with ThreadPoolExecutor(max_workers=num_docs) as pool:
+    concurrent = list(pool.map(run_together, docs))
+
+  assert concurrent == serial
+
+
+def test_output_outside_chunks_not_captured(capsys):
+  "printing outside code chunks still reaches stdout"
+
+  mydoc = """\
+```python
+print("captured")
+```
+"""
+
+  sink = StringIO()
+  PythonProcessor(sink, log=StringIO()).twine(MarkdownParser(string=mydoc).parse())
+  print("not captured")
+
+  assert sink.getvalue() == "captured\n"
+  assert capsys.readouterr().out == "not captured\n"
+
+
+def test_output_from_chunk_threads_captured():
+  "output from threads started by code in a chunk goes to that chunk"
+
+  mydoc = """\
+```python
+import threading
+from concurrent.futures import ThreadPoolExecutor
+thread = threading.Thread(target=lambda: print("from thread"))
+thread.start()
+thread.join()
+with ThreadPoolExecutor(2) as pool:
+  pool.submit(print, "from pool").result()
+```
+"""
+
+  sink = StringIO()
+  PythonProcessor(sink, log=StringIO()).twine(MarkdownParser(string=mydoc).parse())
+
+  assert sink.getvalue() == "from thread\nfrom pool\n"
+
+def test_shared_executor_output_not_misrouted():
+  """output from a thread pool shared by documents processed at once
+  doesn't go to the document that happened to start its threads"""
+
+  shared = {"barrier": threading.Barrier(2)}
+  docs = {"A": """\
+```python
+from concurrent.futures import ThreadPoolExecutor
+shared["pool"] = ThreadPoolExecutor(1)
+shared["barrier"].wait()
+shared["pool"].submit(print, "A via pool").result()
+shared["barrier"].wait()
+```
+""", "B": """\
+```python
+shared["barrier"].wait()
+shared["pool"].submit(print, "B via pool").result()
+shared["barrier"].wait()
+```
+"""}
+
+  def run(name : str) -> str:
+    sink = StringIO()
+    processor = PythonProcessor(sink, log=StringIO())
+    processor.globals["shared"] = shared
+    processor.twine(MarkdownParser(string=docs[name]).parse())
+    return sink.getvalue()
+
+  with ThreadPoolExecutor(max_workers=2) as pool:
+    outputs = dict(zip(docs, pool.map(run, docs)))
+  shared["pool"].shutdown()
+
+  assert outputs == {"A": "", "B": ""}
+
+# top-level await is new in Python 3.8
+requires_top_level_await = pytest.mark.skipif(
+  sys.version_info < (3, 8), reason="top-level await requires Python 3.8")
+
+@requires_top_level_await
+def test_async_tasks_overlap_across_chunks():
+  "tasks started by one chunk run while later chunks await"
+
+  mydoc = """\
+```python
+import asyncio
+import time
+spans = {}
+async def fetch(name):
+  start = time.perf_counter()
+  await asyncio.sleep(0.4)
+  spans[name] = (start, time.perf_counter())
+  return name
+first = asyncio.create_task(fetch("first"))
+```
+some text
+```python
+second = asyncio.create_task(fetch("second"))
+print(await second)
+```
+```python
+print(await first)
+```
+"""
+
+  sink = StringIO()
+  processor = AsyncPythonProcessor(sink, log=StringIO())
+  res = processor.twine(MarkdownParser(string=mydoc).parse())
+
+  assert res == TwineExitStatus.SUCCESS
+  assert sink.getvalue() == "some text\nsecond\nfirst\n"
+  # the two fetches were sleeping at the same time
+  first, second = processor.globals["spans"]["first"], processor.globals["spans"]["second"]
+  assert first[0] < second[1] and second[0] < first[1]
+
+
+@requires_top_level_await
+def test_async_pending_tasks_cancelled():
+  "tasks still running at the end of the document are cancelled"
+
+  mydoc = """\
+```python
+import asyncio
+async def forever():
+  try:
+    await asyncio.sleep(3600)
+  finally:
+    cancelled.append(True)
+cancelled = []
+task = asyncio.create_task(forever())
+await asyncio.sleep(0)
+```
+"""
+
+  processor = AsyncPythonProcessor(StringIO(), log=StringIO())
+  processor.twine(MarkdownParser(string=mydoc).parse())
+
+  assert processor.globals["cancelled"] == [True]
+
+
+@requires_top_level_await
+def test_async_executor_output_captured():
+  "output from run_in_executor goes to the chunk"
+
+  mydoc = """\
+```python
+import asyncio
+await asyncio.get_running_loop().run_in_executor(None, print, "from executor")
+```
+"""
+
+  sink = StringIO()
+  AsyncPythonProcessor(sink, log=StringIO()).twine(MarkdownParser(string=mydoc).parse())
+
+  assert sink.getvalue() == "from executor\n"
+
+def test_profile_report():
+  "each executed chunk gets a profile, with its output size and allocations"
+
+  mydoc = """\
+```python
+data = bytearray(4 * 2**20)
+print("é")
+```
+text
+```python
+print(
+```
+```python
+import time
+time.sleep(0.1)
+```
+"""
+
+  profile = ProfileReport()
+  log = StringIO()
+  PythonProcessor(StringIO(), log=log, profile=profile).twine(
+    MarkdownParser(string=mydoc).parse())
+
+  # the chunk that fails to compile isn't executed, so isn't profiled
+  assert [(record.number, record.start_line) for record in profile.records] == \
+         [(1, 1), (3, 9)]
+  first, last = profile.records[0], profile.records[-1]
+  assert first.output_bytes == 3
+  assert first.net_bytes >= 4 * 2**20
+  assert last.wall_seconds >= 0.1
+  assert "profile (slowest chunks first)" in log.getvalue()
+
+
+def test_cprofile_chunk():
+  "chunks with class .cprofile are profiled, with the document's line numbers"
+
+  mydoc = """\
+intro
+```python
+def unprofiled():
+  pass
+```
+```python .cprofile
+def square(x):
+  return x * x
+square(3)
+```
+"""
+
+  with TemporaryDirectory() as tmpdirname:
+    source_path = os.path.join(tmpdirname, "doc.pmd")
+    log = StringIO()
+    PythonProcessor(StringIO(), log=log, source_path=source_path).twine(
+      MarkdownParser(string=mydoc).parse())
+
+    assert os.listdir(tmpdirname) == ["doc.chunk2.pstats"]
+    stats = pstats.Stats(os.path.join(tmpdirname, "doc.chunk2.pstats"))
+    functions = set(stats.stats) # type: ignore
+    assert (source_path, 7, "square") in functions
+    assert "Wrote profile of chunk 2" in log.getvalue()
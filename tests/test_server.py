@@ -0,0 +1,140 @@
+"""
+test the pytwine server and client, in pytwine.server
+"""
+
+import os
+import socket
+import threading
+
+from contextlib import contextmanager
+from io import BytesIO, StringIO
+from tempfile import TemporaryDirectory
+
+import pytest
+
+from pytwine        import server
+from pytwine.core   import TwineExitStatus
+from pytwine.server import client_twine
+
+pytestmark = pytest.mark.skipif(not server.HAVE_UNIX_SOCKETS,
+                                reason="needs Unix domain sockets")
+
+@contextmanager
+def _running(server_class):
+  "run a server of class ``server_class`` in a thread, yielding its path"
+
+  with TemporaryDirectory() as tmpdirname:
+    path = os.path.join(tmpdirname, "pytwine.sock")
+    twine_server = server_class(path, preload=["json"])
+    thread = threading.Thread(target=twine_server.serve_forever, daemon=True)
+    thread.start()
+    try:
+      yield path
+    finally:
+      twine_server.shutdown()
+      twine_server.server_close()
+      thread.join()
+
+@pytest.fixture(name="socket_path")
+def fixture_socket_path():
+  "a running server, listening on the returned path"
+
+  with _running(server.TwineServer) as path:
+    yield path
+
+
+def test_served_output_matches_cli(socket_path):
+  "a document processed by the server gives the output cli_twine would"
+
+  mydoc = """\
+café
+```python
+print("é" * 5000)
+```
+```python
+print(
+```
+"""
+
+  ofp = StringIO()
+  log = StringIO()
+  res = client_twine(socket_path, StringIO(mydoc), ofp, log=log)
+
+  assert res == TwineExitStatus.BLOCK_COMPILATION_ERROR
+  assert ofp.getvalue() == "café\n" + "é" * 5000 + "\n"
+  assert "Processing chunk 2" in log.getvalue()
+
+
+def test_requests_get_fresh_namespaces(socket_path):
+  "globals from one document aren't visible to the next"
+
+  outputs = []
+  for mydoc in ["```python\nx = 1\nprint('x' in globals())\n```\n",
+                "```python\nprint('x' in globals())\n```\n"]:
+    ofp = StringIO()
+    client_twine(socket_path, StringIO(mydoc), ofp, log=StringIO())
+    outputs.append(ofp.getvalue())
+
+  assert outputs == ["True\n", "False\n"]
+
+
+def test_binary_mode(socket_path):
+  "in binary mode, doc chunks are passed through byte for byte"
+
+  mydoc = b"a\r\nb\r\n```python\nprint(1)\n```\n"
+
+  ofp = BytesIO()
+  res = client_twine(socket_path, BytesIO(mydoc), ofp, log=StringIO(),
+                     binary=True)
+
+  assert res == TwineExitStatus.SUCCESS
+  assert ofp.getvalue() == b"a\r\nb\r\n1\n"
+
+
+def test_only_stale_sockets_replaced(socket_path):
+  "a server only replaces a socket no other server is listening on"
+
+  with pytest.raises(FileExistsError):
+    server.TwineServer(socket_path)
+  ofp = StringIO()
+  client_twine(socket_path, StringIO("```python\nprint(1)\n```\n"), ofp,
+               log=StringIO())
+  assert ofp.getvalue() == "1\n"
+
+  with TemporaryDirectory() as tmpdirname:
+    path = os.path.join(tmpdirname, "report.md")
+    with open(path, "w", encoding="utf8") as ofp:
+      ofp.write("keep me")
+    with pytest.raises(FileExistsError):
+      server.TwineServer(path)
+    with open(path, encoding="utf8") as ifp:
+      assert ifp.read() == "keep me"
+
+    path = os.path.join(tmpdirname, "stale.sock")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+      sock.bind(path)
+    twine_server = server.TwineServer(path)
+    twine_server.server_close()
+
+
+@pytest.mark.skipif(not server.HAVE_FORK, reason="needs os.fork()")
+def test_forked_requests_dont_share_modules():
+  "with a forking server, changes to modules don't outlive a request"
+
+  mydoc = """\
+```python
+import json
+print(hasattr(json, "pytwine_marker"))
+json.pytwine_marker = True
+```
+"""
+
+  outputs = []
+  with _running(server.ForkingTwineServer) as path:
+    for _ in range(2):
+      ofp = StringIO()
+      res = client_twine(path, StringIO(mydoc), ofp, log=StringIO())
+      assert res == TwineExitStatus.SUCCESS
+      outputs.append(ofp.getvalue())
+
+  assert outputs == ["False\n", "False\n"]